@@ -0,0 +1,85 @@
+from collections import OrderedDict
+import numpy as np
+
+
+class LRUCache(object):
+    """
+    Least recently used cache with a budget in bytes. The size of each value is given when it is put.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, n_bytes), least recently used first
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        :param key:
+        :return: the value, None if it is not cached
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry  # most recently used
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, n_bytes):
+        """
+        Adds a value, the least recently used values are evicted to stay within the budget.
+        Values larger than the whole budget are not cached.
+        """
+        if key in self._entries:
+            self.n_bytes -= self._entries.pop(key)[1]
+        if n_bytes > self.max_bytes:
+            return
+        while self._entries and self.n_bytes + n_bytes > self.max_bytes:
+            self.n_bytes -= self._entries.popitem(last=False)[1][1]
+        self._entries[key] = (value, n_bytes)
+        self.n_bytes += n_bytes
+
+    def clear(self):
+        self._entries.clear()
+        self.n_bytes = 0
+
+
+class ActivationSnapshot(object):
+    """
+    Copies of everything the view reads after a forward pass: the blobs of the layers, the probs blob and the
+    input image. The input blob is kept as well, at full precision, so that the net can be brought back to this
+    state for backward passes.
+    The generation identifies the forward pass the snapshot was taken from.
+    Without copy, the blobs of the net are referenced instead, e.g. for camera frames, which are replaced by the next
+    frame anyway. dtype is ignored then, and the snapshot changes with the next forward pass.
+    """
+
+    def __init__(self, net, blob_names, data_blob_name, input_image, generation, dtype=np.float32, copy=True):
+        self.generation = generation
+        if copy:
+            self.blobs = dict((blob_name, np.array(net.blobs[blob_name].data[0], dtype=dtype))
+                              for blob_name in blob_names)
+            self.data = np.array(net.blobs[data_blob_name].data[0], dtype=np.float32)
+        else:
+            self.blobs = dict((blob_name, net.blobs[blob_name].data[0]) for blob_name in blob_names)
+            self.data = net.blobs[data_blob_name].data[0]
+        self.input_image = input_image
+
+    @property
+    def n_bytes(self):
+        return sum(blob.nbytes for blob in self.blobs.values()) + self.data.nbytes + self.input_image.nbytes
+
+    def get_blob(self, blob_name):
+        """
+        :return: the blob of the first input, as float32
+        """
+        blob = self.blobs[blob_name]
+        return blob if blob.dtype == np.float32 else blob.astype(np.float32)
@@ -1,20 +1,103 @@
 from PyQt5.QtCore import pyqtSignal, QThread
 import time
+import itertools
+import threading
+import traceback
 import sys, os
 
 
+class CommandQueue(object):
+    """
+    Commands for the controller thread, taken by priority, then in the order they were put.
+    A command replaces the queued one of the same name, e.g. only the last selected input image is forwarded.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._commands = {}  # name -> (priority, sequence number, function, args)
+        self._sequence_numbers = itertools.count()
+        self._running = False
+
+    def put(self, name, priority, function, *args):
+        """
+        :param name:
+        :param priority: lower first
+        :param function: called with args by the thread that takes the command
+        """
+        with self._condition:
+            self._commands[name] = (priority, next(self._sequence_numbers), function, args)
+            self._condition.notify_all()
+
+    def cancel(self, *names):
+        """
+        Remove queued commands, a command that is already running is finished.
+        """
+        with self._condition:
+            for name in names:
+                self._commands.pop(name, None)
+            self._condition.notify_all()
+
+    def get(self):
+        """
+        Wait for the next command. Call task_done() when it is finished.
+        :return: (name, function, args)
+        """
+        with self._condition:
+            while not self._commands:
+                self._condition.wait()
+            name = min(self._commands, key=lambda name: self._commands[name][:2])
+            priority, sequence_number, function, args = self._commands.pop(name)
+            self._running = True
+            return name, function, args
+
+    def task_done(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """
+        Wait until all commands are finished. Commands that put new ones, e.g. the camera frames, keep it busy.
+        :param timeout: in seconds, None to wait forever
+        :return: True if all commands are finished
+        """
+        end_time = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._commands or self._running:
+                if end_time is None:
+                    self._condition.wait()
+                elif end_time <= time.time():
+                    return False
+                else:
+                    self._condition.wait(end_time - time.time())
+            return True
+
+
 class CNN_Vis_Demo_Ctl(QThread):
     isBusy = pyqtSignal(bool)
+    deconvReady = pyqtSignal(int, object)  # request id, deconv/backprop result
+
+    # priorities of the commands, lower first
+    PRIORITY_UNIT = 0  # the user waits for the unit view
+    PRIORITY_SOURCE = 1  # model and input source, the inputs depend on them
+    PRIORITY_INPUT = 2
+    PRIORITY_BACKGROUND = 3
 
     def __init__(self, model):
         super(QThread, self).__init__()
         self.model = model
-        self.FLAG_set_model = False
-        self.FLAG_set_input = False
         self.model_name = ''
         self.input_image_name = ''
-        self.FLAG_video = False
-        self.camera_as_source = False  # True for Video; False for Image
+        self.FLAG_video = False  # only changed by the controller thread
+        self._busy_count = 0  # isBusy(True) minus isBusy(False) emitted by this thread
+        self._commands = CommandQueue()
+        self._deconv_request_ids = itertools.count(1)
+
+        # (layer name, unit index, units per row, backprop mode) of the unit shown in deconv mode, None otherwise
+        self.precompute_focus = None
+        self._precompute_key = None  # (focus, generation) the candidates below belong to
+        self._precompute_units = []
+        self._precompute_bytes = 0
 
     def run(self):
         """ ops must be run here to avoid conflict """
@@ -22,28 +105,84 @@ class CNN_Vis_Demo_Ctl(QThread):
         import caffe
         if self.model.settings.use_GPU:
             caffe.set_mode_gpu()  # otherwise caffe will run with cpu in this thread
-            caffe.set_device(self.settings.gpu_id)
+            caffe.set_device(self.model.settings.gpu_id)
         while True:
-            if self.FLAG_set_model:
-                self._set_model(self.model_name)
-            self._switch_source(self.camera_as_source)
-            if self.FLAG_video:
-                self._set_input_image(None, True)
-            else:
-                if self.FLAG_set_input:
-                    self._set_input_image(self.input_image_name)
-            time.sleep(0.03)
+            name, function, args = self._commands.get()
+            if function is None:  # stop
+                self._commands.task_done()
+                return
+            busy_count = self._busy_count
+            try:
+                function(*args)
+            except Exception:
+                # a failed command must not stop the thread, the next ones would never run
+                print('Error in controller command %s:' % name)
+                traceback.print_exc()
+                while self._busy_count > busy_count:
+                    self._emit_busy(False)
+            finally:
+                self._commands.task_done()
+
+    def stop(self):
+        """
+        Stop the thread after the running command, the queued ones are dropped.
+        """
+        self._commands.put('stop', self.PRIORITY_UNIT - 1, None)
+
+    def wait_idle(self, timeout=None):
+        """
+        Block until the controller has finished all commands, see CommandQueue.wait_idle
+        """
+        return self._commands.wait_idle(timeout)
 
     def set_model(self, model_name):
-        self.FLAG_set_model = True
         self.model_name = model_name
+        # the requested units belong to the last model
+        self._commands.cancel('deconv', 'precompute')
+        self._commands.put('set_model', self.PRIORITY_SOURCE, self._set_model, model_name)
 
     def set_input_image(self, image_name):
-        self.FLAG_set_input = True
         self.input_image_name = image_name
+        self._commands.put('set_input', self.PRIORITY_INPUT, self._set_input_image, image_name)
 
     def switch_source(self, source):
-        self.camera_as_source = source == 'Video'  # True for Video; False for Image
+        self._commands.put('switch_source', self.PRIORITY_SOURCE, self._switch_source,
+                           source == 'Video')  # True for Video; False for Image
+
+    def request_deconv(self, layer_name, unit_index, backprop_mode):
+        """
+        Compute the backprop/deconv of one unit in this thread, the GUI is not blocked meanwhile. The result is sent
+        with deconvReady, together with the returned request id. A request that was not started yet is replaced by
+        the next one, its result is never sent.
+        :param layer_name:
+        :param unit_index:
+        :param backprop_mode:
+        :return: request id
+        """
+        request_id = next(self._deconv_request_ids)
+        self._commands.put('deconv', self.PRIORITY_UNIT, self._compute_deconv, request_id, str(layer_name),
+                           unit_index, backprop_mode)
+        return request_id
+
+    def set_precompute_focus(self, layer_name, unit_index, units_per_row, backprop_mode):
+        """
+        Tell which unit is shown in deconv mode. While idle, the deconvs of the units that are likely to be clicked
+        next are computed in advance, see CNN_Vis_Demo_Model.get_precompute_candidates.
+        :param layer_name:
+        :param unit_index:
+        :param units_per_row: number of units in a row of the layer view
+        :param backprop_mode:
+        """
+        self.precompute_focus = (str(layer_name), unit_index, units_per_row, backprop_mode)
+        self._commands.put('precompute', self.PRIORITY_BACKGROUND, self._precompute_next_deconv)
+
+    def clear_precompute_focus(self):
+        self.precompute_focus = None
+        self._commands.cancel('precompute')
+
+    def _emit_busy(self, busy):
+        self._busy_count += 1 if busy else -1
+        self.isBusy.emit(busy)
 
     def _switch_source(self, source):
         """
@@ -55,21 +194,73 @@ class CNN_Vis_Demo_Ctl(QThread):
             if source:
                 self.model.switch_camera(True)
                 self.FLAG_video = True
-                self.isBusy.emit(True)  # always busy when using camera as source
+                self._emit_busy(True)  # always busy when using camera as source
+                self._commands.put('video_frame', self.PRIORITY_INPUT, self._next_video_frame)
             else:
+                self._commands.cancel('video_frame')
                 self.model.switch_camera(False)
                 self.FLAG_video = False
-                self.isBusy.emit(False)
+                self._emit_busy(False)
+                if self.input_image_name:
+                    # back to the selected image, it is still in the activation cache
+                    self.set_input_image(self.input_image_name)
+
+    def _next_video_frame(self):
+        if self.FLAG_video:
+            self._set_input_image(None, True)
+            # the next frame goes after the clicks of the user
+            self._commands.put('video_frame', self.PRIORITY_INPUT, self._next_video_frame)
+
+    def _compute_deconv(self, request_id, layer_name, unit_index, backprop_mode):
+        if not self.model.online:
+            self.deconvReady.emit(request_id, None)
+            return
+        show_busy = not self.FLAG_video  # always busy when using camera as source
+        if show_busy:
+            self._emit_busy(True)
+        try:
+            result = self.model.get_deconv(layer_name, unit_index, backprop_mode)
+        finally:
+            if show_busy:
+                self._emit_busy(False)
+        self.deconvReady.emit(request_id, result)
+
+    def _precompute_next_deconv(self):
+        """
+        Compute the deconv of the next candidate unit. One unit per command, so that the commands of the user wait
+        for at most one backward pass.
+        """
+        focus = self.precompute_focus
+        if focus is None or self.FLAG_video or not self.model.online:
+            return
+
+        layer_name, unit_index, units_per_row, backprop_mode = focus
+        key = (focus, self.model.get_generation())
+        if key != self._precompute_key:
+            # another unit was clicked or the input changed
+            self._precompute_key = key
+            self._precompute_units = self.model.get_precompute_candidates(
+                layer_name, unit_index, units_per_row, self.model.settings.precompute_deconv_units)
+            self._precompute_bytes = 0
+
+        if not self._precompute_units or self._precompute_bytes >= self.model.settings.precompute_deconv_mb * 2 ** 20:
+            return
+        self._precompute_bytes += self.model.precompute_deconv(layer_name, self._precompute_units.pop(0),
+                                                               backprop_mode)
+        self._commands.put('precompute', self.PRIORITY_BACKGROUND, self._precompute_next_deconv)
 
     def _set_model(self, model_name):
-        self.FLAG_set_model = False
-        self.isBusy.emit(True)
+        self._emit_busy(True)
         if model_name and model_name != '':
             self.model.set_model(model_name)
-        self.isBusy.emit(False)
+        self._emit_busy(False)
 
     def _set_input_image(self, image_name, video=False):
-        self.FLAG_set_input = False
-        self.isBusy.emit(True)
+        if self.FLAG_video and not video:
+            return  # the selected image is forwarded when the camera is switched off
+        self._emit_busy(True)
         self.model.set_input_and_forward(image_name, video)
-        self.isBusy.emit(False)
+        self._emit_busy(False)
+        if self.precompute_focus is not None:
+            # the candidates of the new input
+            self._commands.put('precompute', self.PRIORITY_BACKGROUND, self._precompute_next_deconv)
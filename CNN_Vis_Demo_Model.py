@@ -5,7 +5,10 @@ import os, sys
 import cv2
 from enum import Enum
 import time
+import itertools
+import threading
 from Settings import Settings
+from CNN_Vis_Demo_Cache import LRUCache, ActivationSnapshot
 
 
 # TODO: Improve the notification mechanism between model and view
@@ -53,6 +56,18 @@ class CNN_Vis_Demo_Model(QObject):
 
         self.online = False  # indicates if the network has finished classifying an image
 
+        # blobs of recently shown images, keyed by (model name, image path, mtime)
+        self._activation_cache = LRUCache(self.settings.activation_cache_mb * 2 ** 20)
+        self._snapshot = None  # what the view reads, see ActivationSnapshot
+        self._net_snapshot = None  # the snapshot the blobs of the net belong to
+        self._generations = itertools.count()  # every forward pass gives its snapshot a new generation
+
+        # backprop/deconv results, keyed by (generation, layer name, unit index, backprop mode)
+        self._deconv_cache = LRUCache(self.settings.deconv_cache_mb * 2 ** 20)
+
+        # the net is used by the controller thread and by the GUI thread
+        self._net_lock = threading.RLock()
+
     def set_model(self, model_name):
         """
         set the network model
@@ -74,13 +89,18 @@ class CNN_Vis_Demo_Model(QObject):
         self._labels = np.loadtxt(self.settings.label_file, str, delimiter='\n')
 
         processed_prototxt = self._process_network_proto(self._model_def)  # enable deconvolution
-        self._net = caffe.Classifier(processed_prototxt, self._model_weights, mean=self.settings.mean, raw_scale=255.0,
-                                     channel_swap=self.settings.channel_swap)
-        current_input_shape = self._net.blobs[self._net.inputs[0]].shape
-        current_input_shape[0] = 1
-        self._net.blobs[self._net.inputs[0]].reshape(*current_input_shape)
-        self._net.reshape()
-        self._get_layers_info()
+        with self._net_lock:
+            self._snapshot = None
+            self._net_snapshot = None
+            self._deconv_cache.clear()
+
+            self._net = caffe.Classifier(processed_prototxt, self._model_weights, mean=self.settings.mean,
+                                         raw_scale=255.0, channel_swap=self.settings.channel_swap)
+            current_input_shape = self._net.blobs[self._net.inputs[0]].shape
+            current_input_shape[0] = 1
+            self._net.blobs[self._net.inputs[0]].reshape(*current_input_shape)
+            self._net.reshape()
+            self._get_layers_info()
         self.dataChanged.emit(self.data_idx_layer_names)
 
         # get the names of demo-images
@@ -106,12 +126,26 @@ class CNN_Vis_Demo_Model(QObject):
         sys.path.insert(0, os.path.join(self.caffevis_caffe_root, 'python'))
         import caffe
 
-        def _forward_image(_image):
+        def _forward_image(_image, cache_key=None, input_image_path=None):
             input_image = caffe.io.resize(_image, self._input_dims, mode='constant', cval=0)
-            self._input_image = (input_image * 255).astype(np.uint8)
+            input_image_uint8 = (input_image * 255).astype(np.uint8)
             transformed_image = self._transformer.preprocess(self._data_blob_name, input_image)
-            self._net.blobs[self._data_blob_name].data[...] = transformed_image
-            self._net.forward()
+            with self._net_lock:
+                self._net.blobs[self._data_blob_name].data[...] = transformed_image
+                self._net.forward()
+
+                # camera frames are never shown again, so they are not cached and not copied
+                dtype = np.float16 if cache_key is not None and self.settings.activation_cache_float16 else np.float32
+                self._snapshot = ActivationSnapshot(self._net, self._layer_list + [self._props_blob_name],
+                                                    self._data_blob_name, input_image_uint8, next(self._generations),
+                                                    dtype, copy=cache_key is not None)
+                self._net_snapshot = self._snapshot
+                self._input_image = input_image_uint8
+                if input_image_path is not None:
+                    self._input_image_path = input_image_path
+            if cache_key is not None:
+                self._activation_cache.put(cache_key, self._snapshot, self._snapshot.n_bytes)
+
             self.online = True
             self.dataChanged.emit(self.data_idx_new_input)
 
@@ -168,18 +202,30 @@ class CNN_Vis_Demo_Model(QObject):
             _forward_image(cv2.flip(squared_image[:, :, (2, 1, 0)], 1))  # RGB
         else:
             if self._input_image_names.__contains__(input_image_name):
-                self._input_image_path = os.path.join(self.settings.input_image_path, input_image_name)
-                image = caffe.io.load_image(self._input_image_path)  # RGB
+                input_image_path = os.path.join(self.settings.input_image_path, input_image_name)
+                cache_key = (self._model_name, input_image_path, os.path.getmtime(input_image_path))
+                snapshot = self._activation_cache.get(cache_key)
+                if snapshot is not None:
+                    # seen recently, no need to run the net
+                    with self._net_lock:
+                        self._snapshot = snapshot
+                        self._input_image = snapshot.input_image
+                        self._input_image_path = input_image_path
+                    self.online = True
+                    self.dataChanged.emit(self.data_idx_new_input)
+                    return
+                image = caffe.io.load_image(input_image_path)  # RGB
                 image = _square(image)
-                _forward_image(image)
+                _forward_image(image, cache_key, input_image_path)
 
     def get_data(self, data_idx):
         """
         Use the data index to get the data.
         The intend was to add control logic in access. But, this seems to be useless.
         :param data_idx:
-        :return: Desired data
+        :return: Desired data, None if it needs an input that was not forwarded yet
         """
+        snapshot = self._snapshot
         if data_idx == self.data_idx_model_names:
             return self.settings.model_names
         elif data_idx == self.data_idx_layer_names:
@@ -187,7 +233,7 @@ class CNN_Vis_Demo_Model(QObject):
         elif data_idx == self.data_idx_layer_output_sizes:
             return self._layer_output_sizes
         elif data_idx == self.data_idx_probs:
-            return self._net.blobs[self._props_blob_name].data.flatten()
+            return snapshot.get_blob(self._props_blob_name).flatten() if snapshot is not None else None
         elif data_idx == self.data_idx_input_image_names:
             return self._input_image_names
         elif data_idx == self.data_idx_labels:
@@ -195,27 +241,29 @@ class CNN_Vis_Demo_Model(QObject):
         elif data_idx == self.data_idx_input_image_path:
             return self._input_image_path
         elif data_idx == self.data_idx_input_image:
-            return self._input_image
+            return snapshot.input_image if snapshot is not None else None
 
     def get_activations(self, layer_name):
         """
         Get all the activations of one layer
         :param layer_name:
-        :return: activations (N, H, W)
+        :return: activations (N, H, W), None without input
         """
-        if self.online and self._layer_list.__contains__(layer_name):
-            activations = self._net.blobs[layer_name].data[0]
+        snapshot = self._snapshot
+        if self.online and snapshot is not None and self._layer_list.__contains__(layer_name):
+            activations = snapshot.get_blob(layer_name)
             return activations
 
     def get_activation(self, layer_name, unit_index):
         """
         Get the activation of a neuron
         :param layer_name:
-        :return: activations (H, W)
+        :return: activations (H, W), None without input
         """
-        if self.online and self._layer_list.__contains__(layer_name) and unit_index < \
+        snapshot = self._snapshot
+        if self.online and snapshot is not None and self._layer_list.__contains__(layer_name) and unit_index < \
                 self._layer_output_sizes[layer_name][0]:
-            activation = self._net.blobs[layer_name].data[0][unit_index]
+            activation = snapshot.get_blob(layer_name)[unit_index]
             return activation
 
     def get_top_k_images_of_unit(self, layer_name, unit_index, k, get_deconv):
@@ -263,12 +311,86 @@ class CNN_Vis_Demo_Model(QObject):
 
     def get_deconv(self, layer_name, unit_index, backprop_mode):
         """
-        Compute the backprop/deconv of one unit
+        Compute the backprop/deconv of one unit. Results are cached until the input or the model changes.
         :param layer_name:
         :param unit_index:
         :param backprop_mode: Avaliable options: self.BackpropModeOption
-        :return: result
+        :return: result, read-only. None without input or if the unit is not in the current model
+        """
+        with self._net_lock:
+            if not self._is_valid_deconv_unit(layer_name, unit_index):
+                return None
+            cache_key = self._get_deconv_cache_key(layer_name, unit_index, backprop_mode)
+            result = self._deconv_cache.get(cache_key)
+            if result is None:
+                result = self._compute_deconv(cache_key, layer_name, unit_index, backprop_mode)
+            return result
+
+    def precompute_deconv(self, layer_name, unit_index, backprop_mode):
+        """
+        Compute the backprop/deconv of one unit into the cache, before it is clicked. Does not count as hit or miss.
+        :return: the number of bytes added to the cache, 0 if it was cached already
+        """
+        with self._net_lock:
+            if not self._is_valid_deconv_unit(layer_name, unit_index):
+                return 0
+            cache_key = self._get_deconv_cache_key(layer_name, unit_index, backprop_mode)
+            if cache_key in self._deconv_cache:
+                return 0
+            result = self._compute_deconv(cache_key, layer_name, unit_index, backprop_mode)
+            return result.nbytes if result is not None else 0
+
+    def get_precompute_candidates(self, layer_name, unit_index, units_per_row, max_units):
+        """
+        Units that are likely to be clicked next: the neighbours of the clicked unit in the layer view, nearest first,
+        and the most strongly activated units of the layer.
+        :param layer_name:
+        :param unit_index: the clicked unit, not a candidate itself
+        :param units_per_row: number of units in a row of the layer view
+        :param max_units:
+        :return: list of unit indices
+        """
+        activations = self.get_activations(layer_name)
+        if activations is None or max_units <= 0:
+            return []
+        n_units = activations.shape[0]
+        row, column = divmod(unit_index, units_per_row)
+
+        def _neighbours(distance):
+            return [r * units_per_row + c
+                    for r in range(row - distance, row + distance + 1)
+                    for c in range(column - distance, column + distance + 1)
+                    if max(abs(r - row), abs(c - column)) == distance and 0 <= c < units_per_row
+                    and 0 <= r * units_per_row + c < n_units]
+
+        strongest = list(np.argsort(-activations.reshape(n_units, -1).max(axis=1)))
+        candidates = []
+        for candidate in _neighbours(1) + strongest[:max_units // 2] + _neighbours(2) + strongest[max_units // 2:]:
+            if len(candidates) == max_units:
+                break
+            if candidate != unit_index and candidate not in candidates:
+                candidates.append(int(candidate))
+        return candidates
+
+    def get_generation(self):
+        """
+        :return: the generation of the current input, changes with every forward pass. None without input
         """
+        snapshot = self._snapshot
+        return snapshot.generation if snapshot is not None else None
+
+    def _is_valid_deconv_unit(self, layer_name, unit_index):
+        # requests may belong to the previous model or input
+        return self._snapshot is not None and self._layer_list.__contains__(layer_name) and \
+               0 <= unit_index < self._layer_output_sizes[layer_name][0]
+
+    def _get_deconv_cache_key(self, layer_name, unit_index, backprop_mode):
+        # a cached input image keeps its generation, so its results are found again when it is shown again
+        return self._snapshot.generation, str(layer_name), unit_index, backprop_mode
+
+    def _compute_deconv(self, cache_key, layer_name, unit_index, backprop_mode):
+        self._restore_net_state()
+
         diffs = self._net.blobs[layer_name].diff[0]
         diffs = diffs * 0
         data = self._net.blobs[layer_name].data[0]
@@ -285,9 +407,29 @@ class CNN_Vis_Demo_Model(QObject):
         else:
             result = None
         if result is not None:
-            result = np.transpose(result[self._net.inputs[0]][0], (1, 2, 0))
+            # the result is a view of the diff blob, which the next backward pass overwrites
+            result = np.transpose(result[self._net.inputs[0]][0], (1, 2, 0)).copy()
+            result.flags.writeable = False
+            self._deconv_cache.put(cache_key, result, result.nbytes)
         return result
 
+    def get_cache_stats(self):
+        """
+        :return: dict cache name -> (hits, misses, number of entries, bytes) of the activation and deconv caches
+        """
+        return dict((name, (cache.hits, cache.misses, len(cache), cache.n_bytes))
+                    for name, cache in [('activation', self._activation_cache), ('deconv', self._deconv_cache)])
+
+    def _restore_net_state(self):
+        """
+        After a cache hit the net still holds the blobs of an earlier input. Forward the input of the current
+        snapshot again, the backward passes need its blobs.
+        """
+        if self._net_snapshot is not self._snapshot:
+            self._net.blobs[self._data_blob_name].data[0] = self._snapshot.data
+            self._net.forward()
+            self._net_snapshot = self._snapshot
+
     def _process_network_proto(self, prototxt):
         processed_prototxt = prototxt + ".processed_by_deepvis"
 
@@ -392,6 +392,10 @@ class CNN_Vis_Demo_View(QMainWindow):
         self.ctl = ctl
         self.model.dataChanged[int].connect(self.update_data)
         self.ctl.isBusy[bool].connect(self.set_busy)
+        self.ctl.deconvReady.connect(self.display_deconv)
+        self._deconv_request_id = None  # the deconv to be shown in the unit view
+        self._deconv_request_time = None
+        self._click_latencies = []  # ms from selecting a unit to its deconv being shown
         self.initUI()
         self.ctl.start(priority=QThread.NormalPriority)
 
@@ -640,7 +644,8 @@ class CNN_Vis_Demo_View(QMainWindow):
         self.move(qr.topLeft())
 
     def closeEvent(self, QCloseEvent):
-        self.ctl.quit()  # stop the controller thread
+        self.ctl.stop()  # stop the controller thread
+        self.ctl.wait()
 
     def update_data(self, data_idx):
         """
@@ -711,6 +716,8 @@ class CNN_Vis_Demo_View(QMainWindow):
                 self.combo_unit_overlay.setEnabled(True)
                 self.combo_unit_backprop_view.setEnabled(False)
                 self.combo_unit_backprop_mode.setEnabled(False)
+                self._deconv_request_id = None
+                self.ctl.clear_precompute_focus()
                 data = self.model.get_activations(self.selected_layer_name)
                 try:
                     data = self._prepare_data_for_display(data)
@@ -723,14 +730,37 @@ class CNN_Vis_Demo_View(QMainWindow):
                 self.combo_unit_overlay.setEnabled(False)
                 self.combo_unit_backprop_view.setEnabled(True)
                 self.combo_unit_backprop_mode.setEnabled(True)
-                data = self.model.get_deconv(self.selected_layer_name, self.selected_unit_index,
-                                             self.combo_unit_backprop_mode.currentText())
-                try:
-                    self.detailed_unit_view.display_deconv(data)
-                except AttributeError:
-                    pass
+                # stops the precomputation for the last unit, the controller continues with the neighbours of this one
+                self.ctl.set_precompute_focus(self.selected_layer_name, self.selected_unit_index,
+                                              int(self.layer_view.n_w), self.combo_unit_backprop_mode.currentText())
+                # computed by the controller thread, see display_deconv
+                self._deconv_request_time = time.time()
+                self._deconv_request_id = self.ctl.request_deconv(self.selected_layer_name, self.selected_unit_index,
+                                                                  self.combo_unit_backprop_mode.currentText())
             self.set_busy(False)
 
+    def display_deconv(self, request_id, data):
+        """
+        Show the deconv computed by the controller thread, unless another unit or mode was selected meanwhile
+        :param request_id: returned by CNN_Vis_Demo_Ctl.request_deconv
+        :param data: deconv/backprop result, None if there is none, e.g. after the model was changed
+        :return:
+        """
+        if request_id != self._deconv_request_id:
+            return
+        if data is None:
+            # don't leave the deconv of the last unit
+            self.detailed_unit_view.clear()
+            return
+        self.detailed_unit_view.display_deconv(data)
+
+        if self.model.settings.print_click_latency:
+            self.detailed_unit_view.repaint()  # the pixels are on the screen now
+            self._click_latencies.append((time.time() - self._deconv_request_time) * 1000)
+            print('Unit click to deconv shown: %.1f ms (median %.1f ms, max %.1f ms of %d clicks)' % (
+                self._click_latencies[-1], np.median(self._click_latencies), max(self._click_latencies),
+                len(self._click_latencies)))
+
     def _prepare_data_for_display(self, data):
         max = data.max()
         min = data.min()
@@ -799,6 +829,8 @@ class CNN_Vis_Demo_View(QMainWindow):
     def refresh(self):
         # get input image
         input_data = self.model.get_data(CNN_Vis_Demo_Model.data_idx_input_image)
+        if input_data is None:
+            return  # the model was changed meanwhile
         if input_data.dtype != np.uint8:
             input_data = input_data.astype(np.uint8)
         image = QImage(input_data.tobytes(), input_data.shape[0], input_data.shape[1], input_data.shape[1] * 3,
@@ -16,6 +16,18 @@ class Settings:
         self.gpu_id = self.main_settings['GPU_ID']
         self.camera_id = self.main_settings['Camera_ID']
         self.caffevis_caffe_root = self.main_settings['caffevis_caffe_root']
+        self.activation_cache_mb = self.main_settings[
+            'Activation_cache_MB'] if 'Activation_cache_MB' in self.main_settings else 512
+        self.activation_cache_float16 = self.main_settings[
+            'Activation_cache_float16'] if 'Activation_cache_float16' in self.main_settings else False
+        self.deconv_cache_mb = self.main_settings[
+            'Deconv_cache_MB'] if 'Deconv_cache_MB' in self.main_settings else 128
+        self.precompute_deconv_units = self.main_settings[
+            'Precompute_deconv_units'] if 'Precompute_deconv_units' in self.main_settings else 16
+        self.precompute_deconv_mb = self.main_settings[
+            'Precompute_deconv_MB'] if 'Precompute_deconv_MB' in self.main_settings else 32
+        self.print_click_latency = self.main_settings[
+            'Print_click_latency'] if 'Print_click_latency' in self.main_settings else False
         for key in self.main_settings['Model_config_path']:
             self.model_names.append(key)
 
@@ -32,12 +44,41 @@ class Settings:
         self.channel_swap = configs['channel_swap'] if 'channel_swap' in configs else [0, 1, 2]
         self.mean = np.array(configs['mean'] if 'mean' in configs else [103.939, 116.779, 123.68])
         self.data_dir = configs['data_dir'] if 'data_dir' in configs else None
-        self.find_maxes_output_file = os.path.join(self.deepvis_outputs_path, 'find_max_acts_output.pickled') if self.deepvis_outputs_path else None
+        self.find_maxes_output_file = os.path.join(self.deepvis_outputs_path, 'find_max_acts_output') if self.deepvis_outputs_path else None
+        self.find_maxes_checkpoint_file = os.path.join(self.deepvis_outputs_path, 'find_max_acts_checkpoint.pickled') if self.deepvis_outputs_path else None
+        self.find_maxes_manifest_file = os.path.join(self.deepvis_outputs_path, 'find_max_acts_manifest.json') if self.deepvis_outputs_path else None
+        self.dataset_index_file = os.path.join(self.deepvis_outputs_path, 'dataset_index.json') if self.deepvis_outputs_path else None
+        self.timing_reports_path = os.path.join(self.deepvis_outputs_path, 'timing_reports') if self.deepvis_outputs_path else None
+        self.max_tracker_autotune_file = os.path.join(self.deepvis_outputs_path, 'max_tracker_autotune.json') if self.deepvis_outputs_path else None
         self.N = configs['N'] if 'N' in configs else 9
         self.layers_to_output_in_offline_scripts = configs[
             'layers_to_output_in_offline_scripts'] if 'layers_to_output_in_offline_scripts' in configs else []
         self.search_min = configs['search_min'] if 'search_min' in configs else False
         self.max_tracker_batch_size = configs['max_tracker_batch_size'] if 'max_tracker_batch_size' in configs else 1
+        self.max_tracker_decode_workers = configs[
+            'max_tracker_decode_workers'] if 'max_tracker_decode_workers' in configs else 0
+        self.max_tracker_prefetch_batches = configs[
+            'max_tracker_prefetch_batches'] if 'max_tracker_prefetch_batches' in configs else 2
+        self.max_tracker_fast_decode = configs[
+            'max_tracker_fast_decode'] if 'max_tracker_fast_decode' in configs else False
+        self.max_tracker_autotune_memory_mb = configs[
+            'max_tracker_autotune_memory_mb'] if 'max_tracker_autotune_memory_mb' in configs else 4096
+        self.max_tracker_progress_seconds = configs[
+            'max_tracker_progress_seconds'] if 'max_tracker_progress_seconds' in configs else 30
+        self.max_tracker_checkpoint_images = configs[
+            'max_tracker_checkpoint_images'] if 'max_tracker_checkpoint_images' in configs else 0
+        self.max_tracker_checkpoint_seconds = configs[
+            'max_tracker_checkpoint_seconds'] if 'max_tracker_checkpoint_seconds' in configs else 600
+        self.max_tracker_capture_patches = configs[
+            'max_tracker_capture_patches'] if 'max_tracker_capture_patches' in configs else False
+        self.max_tracker_channel_correlation = configs[
+            'max_tracker_channel_correlation'] if 'max_tracker_channel_correlation' in configs else True
+        self.max_tracker_plot_backend = configs[
+            'max_tracker_plot_backend'] if 'max_tracker_plot_backend' in configs else 'matplotlib'
+        self.max_tracker_plot_workers = configs[
+            'max_tracker_plot_workers'] if 'max_tracker_plot_workers' in configs else 4
+        self.max_tracker_save_text = configs[
+            'max_tracker_save_text'] if 'max_tracker_save_text' in configs else False
         self.max_tracker_do_maxes = configs['max_tracker_do_maxes'] if 'max_tracker_do_maxes' in configs else True
         self.max_tracker_do_deconv = configs['max_tracker_do_deconv'] if 'max_tracker_do_deconv' in configs else False
         self.max_tracker_do_deconv_norm = configs[
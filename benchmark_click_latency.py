@@ -0,0 +1,107 @@
+"""
+Measures the time from clicking a unit in deconv mode to its deconv being drawn in the unit view, on the synchronous
+path of older versions, where the GUI thread computed the deconv, and on the controller thread, which computes it now.
+Also measures the longest time the GUI thread could not handle other events, e.g. further clicks.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+from PyQt5.QtWidgets import QApplication
+
+from CNN_Vis_Demo_Model import CNN_Vis_Demo_Model
+from CNN_Vis_Demo_Ctl import CNN_Vis_Demo_Ctl
+from CNN_Vis_Demo_View import DetailedUnitViewWidget
+
+
+def click_synchronous(model, unit_view, layer_name, unit_index, backprop_mode):
+    """
+    The GUI thread computes the deconv and draws it.
+    :return: (ms until the deconv is drawn, longest ms the GUI thread was blocked)
+    """
+    start_time = time.time()
+    data = model.get_deconv(layer_name, unit_index, backprop_mode)
+    unit_view.display_deconv(data)
+    unit_view.repaint()
+    latency = (time.time() - start_time) * 1000
+    return latency, latency
+
+
+def click_controller(app, ctl, shown_times, layer_name, unit_index, backprop_mode):
+    """
+    The controller thread computes the deconv, the GUI thread handles events until deconvReady has drawn it.
+    :param shown_times: request id -> time the deconv was drawn, filled by the slot of deconvReady
+    :return: (ms until the deconv is drawn, longest ms the GUI thread was blocked)
+    """
+    start_time = time.time()
+    request_id = ctl.request_deconv(layer_name, unit_index, backprop_mode)
+    longest_block = time.time() - start_time
+    while request_id not in shown_times:
+        event_start_time = time.time()
+        app.processEvents()
+        longest_block = max(longest_block, time.time() - event_start_time)
+    return (shown_times.pop(request_id) - start_time) * 1000, longest_block * 1000
+
+
+def print_latencies(name, results):
+    latencies, blocks = np.array(results).T
+    print('%-18s click to deconv drawn: median %7.1f ms, max %7.1f ms | GUI blocked: median %7.1f ms, max %7.1f ms' % (
+        name, np.median(latencies), latencies.max(), np.median(blocks), blocks.max()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares the latency of a unit click in deconv mode, computed on the GUI thread as in older '
+                    'versions and on the controller thread.')
+    parser.add_argument('--model', help='Model name (default: the first one of main_settings.yaml).')
+    parser.add_argument('--image', help='Input image name (default: the first one of the model).')
+    parser.add_argument('--layer', help='Layer of the clicked units (default: the first layer of the model).')
+    parser.add_argument('--mode', default=CNN_Vis_Demo_Model.BackpropModeOption.GUIDED.value,
+                        choices=[option.value for option in CNN_Vis_Demo_Model.BackpropModeOption])
+    parser.add_argument('--clicks', type=int, default=20, help='Number of clicks on each path (default: 20).')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    model = CNN_Vis_Demo_Model()
+    model.settings.precompute_deconv_units = 0  # measure the clicked units only
+
+    model.set_model(args.model or model.settings.model_names[0])
+    model.set_input_and_forward(args.image or sorted(model.get_data(CNN_Vis_Demo_Model.data_idx_input_image_names))[0])
+    layer_name = args.layer or model.get_data(CNN_Vis_Demo_Model.data_idx_layer_names)[0]
+    n_units = model.get_data(CNN_Vis_Demo_Model.data_idx_layer_output_sizes)[layer_name][0]
+
+    unit_view = DetailedUnitViewWidget()
+    unit_view.show()
+
+    ctl = CNN_Vis_Demo_Ctl(model)
+    shown_times = {}
+
+    def _on_deconv_ready(request_id, data):
+        # as CNN_Vis_Demo_View.display_deconv
+        unit_view.display_deconv(data)
+        unit_view.repaint()
+        shown_times[request_id] = time.time()
+
+    ctl.deconvReady.connect(_on_deconv_ready)
+    ctl.start()
+
+    paths = [('GUI thread', lambda unit_index: click_synchronous(model, unit_view, layer_name, unit_index, args.mode)),
+             ('controller thread', lambda unit_index: click_controller(app, ctl, shown_times, layer_name, unit_index,
+                                                                      args.mode))]
+    try:
+        print('%d clicks on units of %s, %s' % (args.clicks, layer_name, args.mode))
+        for name, click in paths:
+            results = []
+            for click_idx in range(args.clicks + 1):
+                # every click computes its deconv
+                model._deconv_cache.clear()
+                results.append(click(click_idx % n_units))
+            print_latencies(name, results[1:])  # the first click allocates the diffs of the net
+    finally:
+        ctl.stop()
+        ctl.wait()
+
+
+if __name__ == '__main__':
+    main()
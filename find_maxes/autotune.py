@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import multiprocessing
+from image_loader import ImageBatchLoader
+from misc import set_net_batch_size, predict_to_layer, get_forward_end_layer, layer_name_to_top_name
+
+AUTOTUNE_VERSION = 1
+
+# candidates of the trials, in increasing order of memory use
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64, 128]
+WORKER_COUNTS = [0, 1, 2, 4, 8, 16, 32]
+
+# rough resident memory of a decode worker process, which imports caffe
+WORKER_MEMORY_MB = 150
+
+# larger batch sizes are not tried once the throughput falls this far below the best one
+STOP_FRACTION = 0.9
+
+
+def autotune_settings(settings, net, datadir, image_filenames, mode, save=False, trial_seconds=10, trial_images=512):
+    '''
+    Runs short timed trials over candidate batch sizes and decode worker counts, and sets max_tracker_batch_size and
+    max_tracker_decode_workers of settings to the fastest configuration that fits into
+    max_tracker_autotune_memory_mb. The batch size is tuned first, with half of the CPUs decoding, then the number
+    of workers with the best batch size.
+    :param settings:
+    :param net: is reshaped by the trials, set the batch size again afterwards
+    :param datadir: the images of the trials are the first ones of image_filenames
+    :param image_filenames:
+    :param mode: 'scan' times the forward pass of find_max_act.py, 'crop' adds the backward passes of
+    crop_max_patches.py
+    :param save: write the choice to max_tracker_autotune_file, later runs in the same mode use it
+    :param trial_seconds: duration of a trial, after its first batch
+    :param trial_images: maximum number of images of a trial
+    :return: list of dicts with batch_size, decode_workers, memory_mb and images_per_sec of each trial
+    '''
+    assert mode in ['scan', 'crop'], 'Unknown autotune mode %s' % mode
+
+    layers = settings.layers_to_output_in_offline_scripts
+    end_layer = get_forward_end_layer(net, settings, layers)
+    backward_types = get_backward_types(settings) if mode == 'crop' else []
+
+    worker_counts = [num_workers for num_workers in WORKER_COUNTS if num_workers <= multiprocessing.cpu_count()]
+    stage_workers = max(num_workers for num_workers in worker_counts if num_workers <= multiprocessing.cpu_count() / 2)
+
+    print 'Autotuning %s on up to %d images, %d seconds per trial, memory limit %d MB' % (
+        mode, min(trial_images, len(image_filenames)), trial_seconds, settings.max_tracker_autotune_memory_mb)
+    print '%10s %8s %10s %12s' % ('batch size', 'workers', 'memory MB', 'images/sec')
+
+    results = []
+
+    def try_configuration(batch_size, num_workers):
+        set_net_batch_size(net, batch_size)
+        result = {'batch_size': batch_size, 'decode_workers': num_workers,
+                  'memory_mb': estimate_memory_mb(settings, net, batch_size, num_workers, len(backward_types) > 0),
+                  'images_per_sec': None}
+        if result['memory_mb'] > settings.max_tracker_autotune_memory_mb:
+            print '%10d %8d %10d %12s' % (batch_size, num_workers, result['memory_mb'], 'over limit')
+            return None
+
+        result['images_per_sec'] = run_trial(settings, net, datadir, image_filenames, end_layer, layers,
+                                             backward_types, batch_size, num_workers, trial_seconds, trial_images)
+        if result['images_per_sec'] is None:
+            print '%10d %8d %10d %12s' % (batch_size, num_workers, result['memory_mb'], 'too few images')
+            return None
+
+        print '%10d %8d %10d %12.2f' % (batch_size, num_workers, result['memory_mb'], result['images_per_sec'])
+        results.append(result)
+        return result
+
+    # memory grows with both, so the first configuration over the limit ends a stage
+    best = None
+    for batch_size in BATCH_SIZES:
+        result = try_configuration(batch_size, stage_workers)
+        if result is None:
+            break
+        if best is None or result['images_per_sec'] > best['images_per_sec']:
+            best = result
+        elif result['images_per_sec'] < STOP_FRACTION * best['images_per_sec']:
+            break
+
+    assert best is not None, 'No configuration could be tried, check max_tracker_autotune_memory_mb and the data dir'
+
+    for num_workers in worker_counts:
+        if num_workers == stage_workers:
+            continue
+        result = try_configuration(best['batch_size'], num_workers)
+        if result is None:
+            if num_workers > stage_workers:
+                break
+            continue
+        if result['images_per_sec'] > best['images_per_sec']:
+            best = result
+
+    print 'Best: batch size %d, %d decode workers, %.2f images/sec' % (
+        best['batch_size'], best['decode_workers'], best['images_per_sec'])
+    settings.max_tracker_batch_size = best['batch_size']
+    settings.max_tracker_decode_workers = best['decode_workers']
+
+    if save:
+        save_autotune_file(settings, mode, best)
+
+    return results
+
+
+def run_trial(settings, net, datadir, image_filenames, end_layer, layers, backward_types, batch_size, num_workers,
+              trial_seconds, trial_images):
+    '''
+    Decodes and forwards images with one configuration, returns the images/sec, None if there are too few images.
+    The first batch starts the workers and allocates the blobs, it is not timed.
+    '''
+    net_input_dims = net.blobs['data'].data.shape[2:4]
+    n_images = min(len(image_filenames), max(trial_images, 3 * batch_size))
+
+    loader = ImageBatchLoader(settings.caffevis_caffe_root, net_input_dims, num_workers=num_workers,
+                              queue_depth=settings.max_tracker_prefetch_batches,
+                              fast_decode=settings.max_tracker_fast_decode)
+
+    start_time = None
+    n_timed_images = 0
+    with loader:
+        for loaded_batch in loader.iter_batches(datadir, image_filenames, batch_size, image_indices=xrange(n_images)):
+            predict_to_layer(net, [im for image_idx, filename, im in loaded_batch], end_layer)
+            for backward_type in backward_types:
+                for layer_name in layers:
+                    run_backward_pass(net, backward_type, layer_name, len(loaded_batch))
+
+            if start_time is None:
+                start_time = time.time()
+                continue
+            n_timed_images += len(loaded_batch)
+            if time.time() - start_time >= trial_seconds:
+                break
+
+    if n_timed_images == 0:
+        return None
+    return n_timed_images / (time.time() - start_time)
+
+
+def run_backward_pass(net, backward_type, layer_name, n_rows):
+    '''A backward pass from the first unit of layer_name in each row, like a pass of output_gradient_patches().'''
+    top_name = layer_name_to_top_name(net, layer_name)
+    diffs = net.blobs[top_name].diff * 0
+    diffs.reshape(diffs.shape[0], -1)[:n_rows, 0] = 1.0
+
+    if backward_type == 'deconv':
+        net.deconv_from_layer(layer_name, diffs, zero_higher=True, deconv_type='Guided Backprop')
+    else:
+        net.backward_from_layer(layer_name, diffs)
+
+
+def get_backward_types(settings):
+    backward_types = []
+    if settings.max_tracker_do_deconv or settings.max_tracker_do_deconv_norm:
+        backward_types.append('deconv')
+    if settings.max_tracker_do_backprop or settings.max_tracker_do_backprop_norm:
+        backward_types.append('backprop')
+    return backward_types
+
+
+def estimate_memory_mb(settings, net, batch_size, num_workers, with_diffs):
+    '''
+    Rough memory use of a configuration: the blobs of the net, the images decoded ahead and the worker processes.
+    The weights are the same for all configurations and are not counted. The net must be reshaped to batch_size.
+    :param with_diffs: count the diffs of the blobs as well, they are only allocated by backward passes
+    '''
+    blob_bytes = sum(blob.count for blob in net.blobs.values()) * 4
+    if with_diffs:
+        blob_bytes *= 2
+
+    height, width = net.blobs['data'].data.shape[2:4]
+    image_bytes = height * width * 3 * (1 if settings.max_tracker_fast_decode else 4)
+    # the batch in the net and the ones decoded ahead
+    queue_bytes = (settings.max_tracker_prefetch_batches + 1) * batch_size * image_bytes
+
+    return (blob_bytes + queue_bytes) / float(2 ** 20) + num_workers * WORKER_MEMORY_MB
+
+
+def get_autotune_config(settings, mode):
+    '''What the choice of the autotuner depends on, besides the model.'''
+    config = {'prototxt': settings.prototxt,
+              'use_GPU': settings.use_GPU,
+              'cpu_count': multiprocessing.cpu_count(),
+              'fast_decode': settings.max_tracker_fast_decode,
+              'prefetch_batches': settings.max_tracker_prefetch_batches,
+              'memory_mb': settings.max_tracker_autotune_memory_mb}
+    if mode == 'crop':
+        config['backward_types'] = get_backward_types(settings)
+    return config
+
+
+def load_autotune_file(filename):
+    if not os.path.exists(filename):
+        return {'version': AUTOTUNE_VERSION, 'modes': {}}
+    with open(filename, 'rt') as autotune_file:
+        data = json.load(autotune_file)
+    assert data['version'] == AUTOTUNE_VERSION, 'Unsupported autotune file version %s' % data['version']
+    return data
+
+
+def save_autotune_file(settings, mode, best):
+    filename = settings.max_tracker_autotune_file
+    data = load_autotune_file(filename)
+    data['modes'][mode] = {'batch_size': best['batch_size'],
+                           'decode_workers': best['decode_workers'],
+                           'images_per_sec': best['images_per_sec'],
+                           'config': get_autotune_config(settings, mode)}
+
+    dir_name = os.path.dirname(filename)
+    if dir_name and not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wt') as autotune_file:
+        json.dump(data, autotune_file, indent=1)
+    os.rename(temp_filename, filename)
+    print 'Saved the choice to %s' % filename
+
+
+def apply_autotune_file(settings, mode):
+    '''
+    Sets max_tracker_batch_size and max_tracker_decode_workers of settings to the ones saved by an earlier
+    autotune_settings(save=True) in the same mode, if it was tuned for the current configuration.
+    :return: True if settings were changed
+    '''
+    filename = settings.max_tracker_autotune_file
+    if filename is None or not os.path.exists(filename):
+        return False
+
+    entry = load_autotune_file(filename)['modes'].get(mode)
+    if entry is None:
+        return False
+    if entry['config'] != get_autotune_config(settings, mode):
+        print 'Ignoring %s, it was tuned for a different configuration. Run with --autotune to tune again' % filename
+        return False
+
+    settings.max_tracker_batch_size = entry['batch_size']
+    settings.max_tracker_decode_workers = entry['decode_workers']
+    print 'Using batch size %d and %d decode workers from %s' % (entry['batch_size'], entry['decode_workers'],
+                                                                  filename)
+    return True
@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+
+import argparse
+import time
+import numpy as np
+from misc import get_files_list
+from data_sources import is_shard_source, ShardReader
+from image_loader import load_image_for_net
+
+# add parent folder to search path, to enable import of core modules like settings
+import os, sys, inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Settings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares the ms/image of the full decode of dataset images with the reduced-resolution uint8 decode (max_tracker_fast_decode).')
+    parser.add_argument('--model')
+    parser.add_argument('--num-images', type=int, default=100, help='Number of images to decode.')
+    parser.add_argument('--size', type=int, nargs=2, default=[224, 224], help='Net input size, height and width.')
+    args = parser.parse_args()
+    settings = Settings.Settings()
+    settings.load_settings(args.model)
+
+    sys.path.insert(0, os.path.join(settings.caffevis_caffe_root, 'python'))
+
+    # read the files first, so that only the decoding is timed
+    image_filenames = get_files_list(settings.data_dir, settings.dataset_index_file)[0][:args.num_images]
+    if is_shard_source(settings.data_dir):
+        datas = [data for filename, data in ShardReader(settings.data_dir).iter_images(image_filenames)]
+    else:
+        datas = []
+        for filename in image_filenames:
+            with open(os.path.join(settings.data_dir, filename), 'rb') as image_file:
+                datas.append(image_file.read())
+    print 'Read %d images, decoding to %dx%d' % (len(datas), args.size[0], args.size[1])
+
+    results = dict()
+    for name, fast_decode in [('caffe.io.load_image, float', False), ('draft decode, uint8', True)]:
+        start_time = time.time()
+        results[fast_decode] = [load_image_for_net(None, args.size, data, fast_decode=fast_decode) for data in datas]
+        seconds = time.time() - start_time
+        print '%-28s %8.2f ms/image' % (name, seconds * 1000 / len(datas))
+
+    # how far the fast decode is from the full one, in units of the uint8 image
+    differences = [np.abs(fast.astype(np.float32) - full * 255).mean()
+                   for full, fast in zip(results[False], results[True]) if full is not None and fast is not None]
+    print 'Mean abs difference of the pixels: %.2f of 255' % np.mean(differences)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+
+import argparse
+import time
+import numpy as np
+from image_loader import ImageBatchLoader
+from misc import load_network, get_files_list, can_preprocess_batch, preprocess_batch, set_net_batch_size
+
+# add parent folder to search path, to enable import of core modules like settings
+import os, sys, inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Settings
+
+
+def time_per_batch(function, batches, repeats):
+    start_time = time.time()
+    for _ in range(repeats):
+        for im_batch in batches:
+            function(im_batch)
+    return (time.time() - start_time) / (repeats * len(batches))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares the images/sec of net.predict with the batched preprocessing used by the offline scripts.')
+    parser.add_argument('--model')
+    parser.add_argument('--num-batches', type=int, default=10, help='Number of batches to load from the data dir.')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times each batch is run.')
+    args = parser.parse_args()
+    settings = Settings.Settings()
+    settings.load_settings(args.model)
+
+    net = load_network(settings)
+
+    # set network batch size
+    batch_size = settings.max_tracker_batch_size
+    set_net_batch_size(net, batch_size)
+
+    net_input_dims = net.blobs['data'].data.shape[2:4]
+
+    image_filenames, image_labels = get_files_list(settings.data_dir, settings.dataset_index_file)
+    batches = []
+    with ImageBatchLoader(settings.caffevis_caffe_root, net_input_dims) as loader:
+        for loaded_batch in loader.iter_batches(settings.data_dir, image_filenames, batch_size):
+            batches.append([im for image_idx, filename, im in loaded_batch])
+            if len(batches) == args.num_batches:
+                break
+    print 'Loaded %d images in %d batches of up to %d' % (sum(len(im_batch) for im_batch in batches), len(batches),
+                                                           batch_size)
+
+    assert can_preprocess_batch(net, batches[0]), 'The batched preprocessing does not apply to this net'
+
+    # both paths must give the same input blob
+    net.predict(batches[0], oversample=False)
+    predict_data = net.blobs['data'].data.copy()
+    preprocess_batch(net, batches[0])
+    print 'Max abs difference of the input blobs: %g' % np.abs(net.blobs['data'].data - predict_data).max()
+
+    results = [
+        ('net.predict', lambda im_batch: net.predict(im_batch, oversample=False)),
+        ('preprocess_batch + forward', lambda im_batch: (preprocess_batch(net, im_batch), net.forward())),
+        ('net.transformer.preprocess only', lambda im_batch: [net.transformer.preprocess(net.inputs[0], im)
+                                                               for im in im_batch]),
+        ('preprocess_batch only', lambda im_batch: preprocess_batch(net, im_batch))]
+
+    for name, function in results:
+        seconds = time_per_batch(function, batches, args.repeats)
+        print '%-32s %8.2f ms/batch %10.1f images/sec' % (name, seconds * 1000, batch_size / seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import numpy as np
+
+# smallest histogram bin width is 2 ** MIN_BIN_EXPONENT, used for channels that only had a single value so far
+MIN_BIN_EXPONENT = -30
+
+# histogram values are clipped to +-MAX_HISTOGRAM_VALUE, so bin indices fit into int64
+MAX_HISTOGRAM_VALUE = 2.0 ** 32
+
+
+class ChannelStats(object):
+    '''
+    Streaming statistics of the per-input max activation of each channel of a layer.
+    Covers the whole dataset in O(channels^2) memory, no matter how many inputs are added.
+
+    Histograms: n_bins bins per channel of width 2 ** exponent, aligned to multiples of the width. When values
+    fall outside the bins, the width is doubled (pairs of bins are merged) and the window is moved, until all
+    values fit. The result does not depend on the order of the inputs, so merged stats equal those of a
+    single scan.
+
+    Moments: mean and co-moment matrix, updated per batch with the formulas of Welford and Chan et al.
+    The co-moment matrix gives the variances and the correlation matrix of the channels.
+    '''
+
+    def __init__(self, n_channels, n_bins=50, track_correlation=True):
+        self.n_channels = n_channels
+        self.n_bins = n_bins
+        self.track_correlation = track_correlation
+
+        self.count = 0
+        self.mean = np.zeros(n_channels, dtype=np.float64)
+        if track_correlation:
+            self.comoment = np.zeros((n_channels, n_channels), dtype=np.float64)
+        else:
+            # only the diagonal, for the variances
+            self.comoment = np.zeros(n_channels, dtype=np.float64)
+
+        self.hist_counts = np.zeros((n_channels, n_bins), dtype=np.int64)
+        self.hist_exponents = np.zeros(n_channels, dtype=np.int64)
+        self.hist_offsets = np.zeros(n_channels, dtype=np.int64)  # index of the first bin on the grid of its width
+        self.hist_has_range = np.zeros(n_channels, dtype=bool)
+
+    def update(self, values):
+        '''
+        Adds a batch of inputs.
+        :param values: max activation per input and channel, (n_inputs, n_channels). Inputs with nan/inf values
+                       are skipped.
+        :return:
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values).all(1)]
+        if values.shape[0] == 0:
+            return
+
+        self._add_moments(values.shape[0], values.mean(0), values - values.mean(0))
+        self._add_to_histograms(np.clip(values, -MAX_HISTOGRAM_VALUE, MAX_HISTOGRAM_VALUE))
+
+    def merge(self, other):
+        '''Adds the inputs of other, stats of the same layer built from a disjoint set of inputs.'''
+        assert other.n_channels == self.n_channels and other.n_bins == self.n_bins, 'Stats must be of the same layer'
+        assert other.track_correlation == self.track_correlation, 'Stats must have the same track_correlation'
+
+        if other.count > 0:
+            n_a, n_b = self.count, other.count
+            delta = other.mean - self.mean
+            self.count = n_a + n_b
+            self.mean += delta * (float(n_b) / self.count)
+            self.comoment += other.comoment + self._outer(delta, delta) * (float(n_a) * n_b / self.count)
+
+        for channel_idx in np.flatnonzero(other.hist_has_range):
+            exponent = other.hist_exponents[channel_idx]
+            bins = other.hist_offsets[channel_idx] + np.arange(self.n_bins)
+            occupied = np.flatnonzero(other.hist_counts[channel_idx])
+            if len(occupied) == 0:
+                continue
+            self._fit_range(channel_idx, exponent, bins[occupied[0]], bins[occupied[-1]])
+            shift = self.hist_exponents[channel_idx] - exponent
+            new_bins = (bins >> shift) - self.hist_offsets[channel_idx]
+            self.hist_counts[channel_idx] += np.bincount(new_bins[occupied],
+                                                         weights=other.hist_counts[channel_idx][occupied],
+                                                         minlength=self.n_bins).astype(np.int64)
+
+    def variance(self):
+        if self.count == 0:
+            return np.zeros(self.n_channels)
+        return self._diagonal() / self.count
+
+    def correlation(self):
+        '''Correlation matrix of the channels, like np.corrcoef on all inputs. nan for constant channels.'''
+        assert self.track_correlation, 'Correlation was not tracked'
+        std = np.sqrt(self._diagonal())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.comoment / np.outer(std, std)
+
+    def histogram(self, channel_idx):
+        '''Returns (hist, bin_edges) of the channel, like np.histogram, limited to the bins that hold values.'''
+        if not self.hist_has_range[channel_idx]:
+            return np.zeros(1, dtype=np.int64), np.array([0.0, 1.0])
+
+        counts = self.hist_counts[channel_idx]
+        occupied = np.flatnonzero(counts)
+        first, last = occupied[0], occupied[-1]
+        width = np.ldexp(1.0, int(self.hist_exponents[channel_idx]))
+        bin_edges = (self.hist_offsets[channel_idx] + np.arange(first, last + 2)) * width
+        return counts[first:last + 1], bin_edges
+
+    def _outer(self, a, b):
+        return np.outer(a, b) if self.track_correlation else a * b
+
+    def _diagonal(self):
+        return np.diag(self.comoment) if self.track_correlation else self.comoment
+
+    def _add_moments(self, n_b, mean_b, centered_b):
+        if self.track_correlation:
+            comoment_b = np.dot(centered_b.T, centered_b)
+        else:
+            comoment_b = (centered_b ** 2).sum(0)
+
+        n_a = self.count
+        delta = mean_b - self.mean
+        self.count = n_a + n_b
+        self.mean += delta * (float(n_b) / self.count)
+        self.comoment += comoment_b + self._outer(delta, delta) * (float(n_a) * n_b / self.count)
+
+    def _add_to_histograms(self, values):
+        lows = values.min(0)
+        highs = values.max(0)
+
+        # grow the range of the channels that got values outside their bins
+        widths = np.ldexp(1.0, self.hist_exponents)
+        out_of_range = np.logical_not(self.hist_has_range) | \
+                       (np.floor(lows / widths) < self.hist_offsets) | \
+                       (np.floor(highs / widths) >= self.hist_offsets + self.n_bins)
+        for channel_idx in np.flatnonzero(out_of_range):
+            self._fit_range_of_values(channel_idx, lows[channel_idx], highs[channel_idx])
+
+        widths = np.ldexp(1.0, self.hist_exponents)
+        bins = np.floor(values / widths).astype(np.int64) - self.hist_offsets
+        flat_bins = bins + np.arange(self.n_channels) * self.n_bins
+        self.hist_counts += np.bincount(flat_bins.ravel(),
+                                        minlength=self.n_channels * self.n_bins).reshape(self.n_channels, self.n_bins)
+
+    def _fit_range_of_values(self, channel_idx, low, high):
+        if high > low:
+            exponent = max(int(np.floor(np.log2((high - low) / self.n_bins))), MIN_BIN_EXPONENT)
+        else:
+            exponent = MIN_BIN_EXPONENT
+        width = np.ldexp(1.0, exponent)
+        self._fit_range(channel_idx, exponent, int(np.floor(low / width)), int(np.floor(high / width)))
+
+    def _fit_range(self, channel_idx, exponent, low_bin, high_bin):
+        '''
+        Makes the bins of the channel cover the bins low_bin to high_bin on the grid of 2 ** exponent, together with
+        the values it already holds. Uses the smallest width that fits.
+        '''
+        if self.hist_has_range[channel_idx]:
+            old_exponent = self.hist_exponents[channel_idx]
+            old_bins = self.hist_offsets[channel_idx] + np.arange(self.n_bins)
+            occupied = np.flatnonzero(self.hist_counts[channel_idx])
+        else:
+            old_exponent = exponent
+            old_bins = None
+            occupied = []
+
+        # bring both to the wider grid, then double the width until everything fits
+        new_exponent = max(exponent, old_exponent)
+        while True:
+            lows = [low_bin >> (new_exponent - exponent)]
+            highs = [high_bin >> (new_exponent - exponent)]
+            if len(occupied) > 0:
+                lows.append(old_bins[occupied[0]] >> (new_exponent - old_exponent))
+                highs.append(old_bins[occupied[-1]] >> (new_exponent - old_exponent))
+            if max(highs) - min(lows) + 1 <= self.n_bins:
+                break
+            new_exponent += 1
+
+        new_offset = min(lows)
+        new_counts = np.zeros(self.n_bins, dtype=np.int64)
+        if len(occupied) > 0:
+            new_bins = (old_bins[occupied] >> (new_exponent - old_exponent)) - new_offset
+            new_counts += np.bincount(new_bins, weights=self.hist_counts[channel_idx][occupied],
+                                      minlength=self.n_bins).astype(np.int64)
+
+        self.hist_counts[channel_idx] = new_counts
+        self.hist_exponents[channel_idx] = new_exponent
+        self.hist_offsets[channel_idx] = new_offset
+        self.hist_has_range[channel_idx] = True
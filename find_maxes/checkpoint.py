@@ -0,0 +1,82 @@
+import os
+import time
+import cPickle as pickle
+from misc import mkdir_p
+from profiling import profiler
+
+CHECKPOINT_VERSION = 2
+
+
+class ScanCheckpointer(object):
+    '''
+    Periodically saves the state of a running scan, so that an interrupted find_max_act.py can be resumed.
+    A checkpoint is written every every_images images or every every_seconds seconds, whichever comes first.
+    0 disables the respective trigger.
+    '''
+
+    def __init__(self, filename, every_images=0, every_seconds=0):
+        self.filename = filename
+        self.every_images = every_images
+        self.every_seconds = every_seconds
+        self.images_since_save = 0
+        self.last_save_time = time.time()
+
+    def enabled(self):
+        return self.filename is not None and (self.every_images > 0 or self.every_seconds > 0)
+
+    def maybe_save(self, net_max_tracker, next_position, n_new_images):
+        '''
+        Saves a checkpoint if one is due.
+        :param net_max_tracker:
+        :param next_position: index of the first image in net_max_tracker.image_filenames that is not yet scanned
+        :param n_new_images: number of images scanned since the last call
+        :return:
+        '''
+        if not self.enabled():
+            return
+
+        self.images_since_save += n_new_images
+        due_by_images = self.every_images > 0 and self.images_since_save >= self.every_images
+        due_by_time = self.every_seconds > 0 and time.time() - self.last_save_time >= self.every_seconds
+        if due_by_images or due_by_time:
+            save_checkpoint(self.filename, net_max_tracker, next_position)
+            self.images_since_save = 0
+            self.last_save_time = time.time()
+
+
+def save_checkpoint(filename, net_max_tracker, next_position):
+    '''Saves the tracker and the scan position atomically, a crash during saving keeps the previous checkpoint.'''
+
+    mkdir_p(os.path.dirname(filename))
+
+    # seen_inputs are not part of the pickled trackers, but are needed to continue the scan
+    checkpoint = {'version': CHECKPOINT_VERSION,
+                  'next_position': next_position,
+                  'net_max_tracker': net_max_tracker,
+                  'seen_inputs': {}}
+    for layer_name, max_tracker in net_max_tracker.max_trackers.items():
+        checkpoint['seen_inputs'][layer_name] = max_tracker.seen_inputs
+
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as ff, profiler.timer('pickle'):
+        pickle.dump(checkpoint, ff, -1)
+        ff.flush()
+        os.fsync(ff.fileno())
+    os.rename(temp_filename, filename)
+
+    print 'Saved checkpoint at image %d/%d to %s' % (next_position, len(net_max_tracker.image_filenames), filename)
+
+
+def load_checkpoint(filename):
+    '''Returns the tracker and the index of the first image that still has to be scanned.'''
+
+    with open(filename, 'rb') as ff:
+        checkpoint = pickle.load(ff)
+
+    assert checkpoint['version'] == CHECKPOINT_VERSION, 'Unsupported checkpoint version %s' % checkpoint['version']
+
+    net_max_tracker = checkpoint['net_max_tracker']
+    for layer_name, max_tracker in net_max_tracker.max_trackers.items():
+        max_tracker.seen_inputs = checkpoint['seen_inputs'][layer_name]
+
+    return net_max_tracker, checkpoint['next_position']
@@ -0,0 +1,41 @@
+#! /usr/bin/env python
+
+import argparse
+import cPickle as pickle
+from jby_misc import WithTimer
+from find_max_act import save_max_tracker_to_file
+
+# add parent folder to search path, to enable import of core modules like settings
+import os, sys, inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Settings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Converts a pickled NetMaxTracker of older versions into the tracker directory format.')
+    parser.add_argument('--model')
+    parser.add_argument('--input', default=None,
+                        help='Pickled tracker (default: the find_max_act.py output file with extension .pickled).')
+    parser.add_argument('--output', default=None, help='Tracker directory (default: the find_max_act.py output file).')
+    parser.add_argument('--text', action='store_true', help='Also write the tops as text to OUTPUT.txt.')
+    args = parser.parse_args()
+    settings = Settings.Settings()
+    settings.load_settings(args.model)
+
+    input_file = args.input if args.input else settings.find_maxes_output_file + '.pickled'
+    output_file = args.output if args.output else settings.find_maxes_output_file
+
+    with WithTimer('Loading %s' % input_file):
+        with open(input_file, 'rb') as tracker_file:
+            net_max_tracker = pickle.load(tracker_file)
+
+    save_max_tracker_to_file(output_file, net_max_tracker, save_text=args.text or settings.max_tracker_save_text)
+    print 'Saved %s, the pickled tracker can be removed' % output_file
+
+
+if __name__ == '__main__':
+    main()
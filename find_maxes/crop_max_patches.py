@@ -8,9 +8,11 @@ matplotlib.use('Agg')
 
 import argparse
 from jby_misc import WithTimer
-from max_tracker import output_max_patches
+from max_tracker import output_max_patches, get_tracker_files_list, MaxPatchesJob
 from find_max_act import load_max_tracker_from_file
-from misc import load_network
+from misc import load_network, set_net_batch_size, get_files_list
+from autotune import autotune_settings, apply_autotune_file
+from profiling import save_report_at_exit
 # add parent folder to search path, to enable import of core modules like settings
 
 import os, sys, inspect
@@ -23,51 +25,69 @@ import Settings
 
 def main():
     parser = argparse.ArgumentParser(
-        description='Loads a pickled NetMaxTracker and outputs one or more of {the patches of the image, a deconv patch, a backprop patch} associated with the maxes.')
+        description='Loads a saved NetMaxTracker and outputs one or more of {the patches of the image, a deconv patch, a backprop patch} associated with the maxes.')
     parser.add_argument('--model')
     parser.add_argument('--idx-begin', type=int, default=None, help='Start at this unit (default: all units).')
     parser.add_argument('--idx-end', type=int, default=None, help='End at this unit (default: all units).')
+    parser.add_argument('--autotune', action='store_true',
+                        help='Time short trials of batch sizes and decode worker counts first, then run with the fastest.')
+    parser.add_argument('--save-autotune', action='store_true',
+                        help='With --autotune, save the choice to max_tracker_autotune_file. Later runs use it.')
+    parser.add_argument('--autotune-seconds', type=int, default=10, help='Duration of each autotune trial (default: 10).')
     args = parser.parse_args()
     settings = Settings.Settings()
     settings.load_settings(args.model)
+    save_report_at_exit(settings.timing_reports_path, 'crop_max_patches')
 
     net = load_network(settings)
 
+    if args.autotune:
+        autotune_settings(settings, net, settings.data_dir,
+                          get_files_list(settings.data_dir, settings.dataset_index_file)[0], 'crop',
+                          save=args.save_autotune, trial_seconds=args.autotune_seconds)
+    else:
+        apply_autotune_file(settings, 'crop')
+
     # set network batch size
-    current_input_shape = net.blobs[net.inputs[0]].shape
-    current_input_shape[0] = settings.max_tracker_batch_size
-    net.blobs[net.inputs[0]].reshape(*current_input_shape)
-    net.reshape()
+    set_net_batch_size(net, settings.max_tracker_batch_size)
 
     assert settings.max_tracker_do_maxes or settings.max_tracker_do_deconv or settings.max_tracker_do_deconv_norm or settings.max_tracker_do_backprop or settings.max_tracker_do_backprop_norm, 'Specify at least one do_* option to output.'
 
-    nmt = load_max_tracker_from_file(settings.find_maxes_output_file)
+    # only the arrays of the top images that are cropped are read from disk
+    nmt = load_max_tracker_from_file(settings.find_maxes_output_file,
+                                     layers=settings.layers_to_output_in_offline_scripts, mmap_mode='r')
+
+    image_filenames = get_tracker_files_list(nmt, settings.data_dir)
 
+    # collect the units of all layers, so that every top image is loaded and forwarded only once
+    jobs = []
     for layer_name in settings.layers_to_output_in_offline_scripts:
+        n_units = nmt.max_trackers[layer_name].max_vals.shape[0]
+
+        idx_begin = args.idx_begin if args.idx_begin is not None else 0
+        idx_end = args.idx_end if args.idx_end is not None else n_units
+
+        jobs.extend(make_max_patches_jobs(settings, nmt, layer_name, idx_begin, idx_end))
 
-        print 'Started work on layer %s' % (layer_name)
+    with WithTimer('Saved %d images per unit for layers %s.' % (
+            settings.N, ', '.join(settings.layers_to_output_in_offline_scripts))):
 
-        mt = nmt.max_trackers[layer_name]
+        output_max_patches(settings, net, jobs, settings.N, settings.data_dir, settings.deepvis_outputs_path,
+                           get_do_which(settings), image_filenames=image_filenames)
 
-        if args.idx_begin is None:
-            idx_begin = 0
-        if args.idx_end is None:
-            idx_end = mt.max_vals.shape[0]
 
-        with WithTimer('Saved %d images per unit for %s units %d:%d.' % (settings.N, layer_name, idx_begin, idx_end)):
+def make_max_patches_jobs(settings, nmt, layer_name, idx_begin, idx_end):
+    '''The jobs of units idx_begin:idx_end of a layer, for the maxes and, with search_min, for the mins.'''
+    mt = nmt.max_trackers[layer_name]
+    jobs = [MaxPatchesJob(layer_name, mt, idx_begin, idx_end, search_min=False)]
+    if settings.search_min:
+        jobs.append(MaxPatchesJob(layer_name, mt, idx_begin, idx_end, search_min=True))
+    return jobs
 
-            output_max_patches(settings, mt, net, layer_name, idx_begin, idx_end,
-                               settings.N, settings.data_dir, settings.deepvis_outputs_path, False,
-                               (settings.max_tracker_do_maxes, settings.max_tracker_do_deconv,
-                                settings.max_tracker_do_deconv_norm, settings.max_tracker_do_backprop,
-                                settings.max_tracker_do_backprop_norm, True))
 
-            if settings.search_min:
-                output_max_patches(settings, mt, net, layer_name, idx_begin, idx_end,
-                                   settings.N, settings.data_dir, settings.deepvis_outputs_path, True,
-                                   (settings.max_tracker_do_maxes, settings.max_tracker_do_deconv,
-                                    settings.max_tracker_do_deconv_norm, settings.max_tracker_do_backprop,
-                                    settings.max_tracker_do_backprop_norm, True))
+def get_do_which(settings):
+    return (settings.max_tracker_do_maxes, settings.max_tracker_do_deconv, settings.max_tracker_do_deconv_norm,
+            settings.max_tracker_do_backprop, settings.max_tracker_do_backprop_norm, True)
 
 
 if __name__ == '__main__':
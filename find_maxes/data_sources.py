@@ -0,0 +1,141 @@
+import os
+import time
+import glob
+import tarfile
+import zipfile
+import itertools
+
+# images in shards are named <shard file name>::<member name>
+SHARD_SEPARATOR = '::'
+
+SHARD_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.zip')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def is_shard_source(data_dir):
+    '''
+    True if data_dir names tar/zip shards instead of a directory of image files: a list of shard files or glob
+    patterns, or a single one.
+    '''
+    if isinstance(data_dir, (list, tuple)):
+        return True
+    return data_dir.lower().endswith(SHARD_EXTENSIONS) and not os.path.isdir(data_dir)
+
+
+def get_shard_patterns(data_dir):
+    return list(data_dir) if isinstance(data_dir, (list, tuple)) else [data_dir]
+
+
+def get_shard_paths(data_dir):
+    '''Returns the shard files of data_dir in the given order, glob patterns are expanded in sorted order.'''
+    shard_paths = []
+    for pattern in get_shard_patterns(data_dir):
+        matches = sorted(glob.glob(pattern))
+        assert len(matches) > 0, 'No shards found for %s' % pattern
+        shard_paths.extend(matches)
+
+    # image names only keep the file name of their shard
+    shard_names = [os.path.basename(shard_path) for shard_path in shard_paths]
+    assert len(set(shard_names)) == len(shard_names), 'Shards must have distinct file names'
+    return shard_paths
+
+
+def get_image_path(data_dir, filename):
+    '''Where the image comes from, for messages.'''
+    if is_shard_source(data_dir):
+        return filename
+    return os.path.join(data_dir, filename)
+
+
+def get_shard_image_name(shard_path, member_name):
+    return os.path.basename(shard_path) + SHARD_SEPARATOR + member_name
+
+
+def split_shard_image_name(filename):
+    '''Returns (shard file name, member name) of an image in a shard.'''
+    shard_name, member_name = filename.split(SHARD_SEPARATOR, 1)
+    return shard_name, member_name
+
+
+def list_shard_images(shard_path, with_data=False):
+    '''
+    Yields (member name, size, mtime, data) of the images in the shard, in the order they are stored.
+    data is the content of the member if with_data is set, None otherwise.
+    '''
+    if shard_path.lower().endswith('.zip'):
+        with zipfile.ZipFile(shard_path) as zip_file:
+            for info in sorted(zip_file.infolist(), key=lambda info: info.header_offset):
+                if info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    data = zip_file.read(info) if with_data else None
+                    yield info.filename, info.file_size, zip_mtime(info), data
+    else:
+        # stream mode reads the tar front to back, compressed or not
+        with tarfile.open(shard_path, 'r|*') as tar_file:
+            for member in tar_file:
+                if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                    data = tar_file.extractfile(member).read() if with_data else None
+                    yield member.name, member.size, float(member.mtime), data
+
+
+def zip_mtime(info):
+    # zip files keep the local time, without time zone
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+class ShardReader(object):
+    '''
+    Reads images from tar/zip shards with sequential reads only. Images of the same shard that are requested one
+    after the other are read in a single pass over the shard, so they should be requested in the order of the shard,
+    like the file lists of DatasetIndex.
+    '''
+
+    def __init__(self, data_dir):
+        self.shard_paths = dict((os.path.basename(shard_path), shard_path) for shard_path in get_shard_paths(data_dir))
+
+    def iter_images(self, filenames):
+        '''
+        Yields (filename, data) for the given image names in the same order. data is None for missing images.
+        '''
+        for shard_name, run in itertools.groupby(filenames, key=lambda filename: split_shard_image_name(filename)[0]):
+            run = list(run)
+            if shard_name not in self.shard_paths:
+                for filename in run:
+                    yield filename, None
+                continue
+
+            wanted = set(split_shard_image_name(filename)[1] for filename in run)
+            found = dict()
+            position = 0
+            for member_name, data in self._iter_members(self.shard_paths[shard_name], wanted):
+                found[member_name] = data
+
+                # pass on the images that are complete in request order, keep the others until their turn
+                while position < len(run) and split_shard_image_name(run[position])[1] in found:
+                    yield run[position], found.pop(split_shard_image_name(run[position])[1])
+                    position += 1
+
+                if len(found) == 0 and position == len(run):
+                    break
+
+            for filename in run[position:]:
+                yield filename, found.pop(split_shard_image_name(filename)[1], None)
+
+    def _iter_members(self, shard_path, wanted):
+        '''Yields (member name, data) of the wanted members, in the order they are stored.'''
+        remaining = set(wanted)
+
+        if shard_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(shard_path) as zip_file:
+                infos = [info for info in zip_file.infolist() if info.filename in remaining]
+                for info in sorted(infos, key=lambda info: info.header_offset):
+                    yield info.filename, zip_file.read(info)
+            return
+
+        with tarfile.open(shard_path, 'r|*') as tar_file:
+            for member in tar_file:
+                if member.name in remaining:
+                    remaining.discard(member.name)
+                    yield member.name, tar_file.extractfile(member).read()
+                    if len(remaining) == 0:
+                        break
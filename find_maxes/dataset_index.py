@@ -0,0 +1,190 @@
+import os
+import json
+from StringIO import StringIO
+from data_sources import IMAGE_EXTENSIONS, is_shard_source, get_shard_patterns, get_shard_paths, list_shard_images, \
+    get_shard_image_name
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2, use the scandir package if it is installed
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+INDEX_VERSION = 1
+
+
+class DatasetIndex(object):
+    '''
+    List of the image files of a data dir and its subdirectories, in a stable order: sorted by name, directory by
+    directory. Each entry keeps the path relative to the data dir, the size and the mtime of the file, and its
+    height and width if the index was built with dimensions.
+    The mtimes of the directories are kept as well. Adding, removing or renaming files changes the mtime of their
+    directory, so is_current() can check the index with one stat per directory instead of one per file.
+
+    For tar/zip shards (see data_sources.py) the images are listed shard by shard in the order they are stored, and
+    the mtimes of the shard files are kept instead.
+    '''
+
+    def __init__(self, data_dir, entries=None, dir_mtimes=None):
+        self.data_dir = data_dir
+        self.entries = entries if entries is not None else []
+        self.dir_mtimes = dir_mtimes if dir_mtimes is not None else {}
+
+    @property
+    def filenames(self):
+        return [entry['path'] for entry in self.entries]
+
+    @staticmethod
+    def build(data_dir, with_dimensions=False):
+        '''Walks data_dir and its subdirectories and indexes all images.'''
+        index = DatasetIndex(data_dir)
+
+        if is_shard_source(data_dir):
+            for shard_path in get_shard_paths(data_dir):
+                index.dir_mtimes[shard_path] = os.stat(shard_path).st_mtime
+                for member_name, size, mtime, data in list_shard_images(shard_path, with_data=with_dimensions):
+                    entry = {'path': get_shard_image_name(shard_path, member_name), 'size': size, 'mtime': mtime}
+                    if with_dimensions:
+                        dimensions = read_image_dimensions(StringIO(data))
+                        if dimensions is not None:
+                            entry['height'], entry['width'] = dimensions
+                    index.entries.append(entry)
+            return index
+
+        for path, stat in walk_image_files(data_dir, index.dir_mtimes):
+            entry = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+            if with_dimensions:
+                dimensions = read_image_dimensions(os.path.join(data_dir, path))
+                if dimensions is not None:
+                    entry['height'], entry['width'] = dimensions
+            index.entries.append(entry)
+        return index
+
+    def is_current(self, data_dir):
+        '''True if the index is of data_dir and no files were added, removed or renamed since it was built.'''
+        if is_shard_source(data_dir) != is_shard_source(self.data_dir):
+            return False
+        if is_shard_source(data_dir):
+            # the order of the shards is the order of the images, and glob patterns may match new shards
+            if get_shard_patterns(data_dir) != get_shard_patterns(self.data_dir) or \
+                    set(get_shard_paths(data_dir)) != set(self.dir_mtimes.keys()):
+                return False
+        elif os.path.abspath(data_dir) != os.path.abspath(self.data_dir):
+            return False
+
+        for dir_path, mtime in self.dir_mtimes.iteritems():
+            path = dir_path if is_shard_source(data_dir) else os.path.join(data_dir, dir_path)
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def save(self, filename):
+        dir_name = os.path.dirname(filename)
+        if dir_name and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wt') as index_file:
+            json.dump({'version': INDEX_VERSION, 'data_dir': self.data_dir, 'dir_mtimes': self.dir_mtimes,
+                       'entries': self.entries}, index_file)
+        os.rename(temp_filename, filename)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rt') as index_file:
+            data = json.load(index_file)
+        assert data['version'] == INDEX_VERSION, 'Unsupported dataset index version %s' % data['version']
+        # json gives unicode paths, the file lists use byte strings
+        for entry in data['entries']:
+            entry['path'] = entry['path'].encode('utf-8')
+        dir_mtimes = dict((dir_path.encode('utf-8'), mtime) for dir_path, mtime in data['dir_mtimes'].iteritems())
+        data_dir = data['data_dir']
+        if isinstance(data_dir, list):
+            data_dir = [shard_path.encode('utf-8') for shard_path in data_dir]
+        else:
+            data_dir = data_dir.encode('utf-8')
+        return DatasetIndex(data_dir, data['entries'], dir_mtimes)
+
+
+def get_dataset_files(data_dir, index_filename=None, rescan=False):
+    '''
+    Returns the image files of data_dir and its subdirectories, relative to data_dir, in a stable order.
+    With index_filename, the list is taken from the index saved there by an earlier call while no files were added
+    or removed since. Otherwise data_dir is walked and the index is saved, if index_filename can be written.
+    :param data_dir:
+    :param index_filename: file of the cached DatasetIndex, None to always walk data_dir
+    :param rescan: walk data_dir even if the index is current
+    :return: DatasetIndex
+    '''
+    if index_filename is not None and not rescan and os.path.exists(index_filename):
+        index = DatasetIndex.load(index_filename)
+        if index.is_current(data_dir):
+            print 'Using dataset index %s' % index_filename
+            return index
+        print 'Dataset index %s is outdated' % index_filename
+
+    index = DatasetIndex.build(data_dir)
+    if index_filename is not None:
+        try:
+            index.save(index_filename)
+        except (IOError, OSError) as e:
+            # e.g. a read-only output dir, the list is just not cached
+            print 'WARNING: could not save the dataset index to %s: %s' % (index_filename, e)
+    return index
+
+
+def walk_image_files(data_dir, dir_mtimes=None):
+    '''
+    Yields (path relative to data_dir, stat) of all images in data_dir and its subdirectories. Each directory
+    is listed once with scandir and its entries are sorted by name. Subdirectories follow the files of their parent.
+    :param data_dir:
+    :param dir_mtimes: dict that receives the mtime of each directory, by path relative to data_dir ('' for data_dir)
+    :return:
+    '''
+    pending_dirs = ['']
+    while pending_dirs:
+        dir_path = pending_dirs.pop()
+        full_dir_path = os.path.join(data_dir, dir_path)
+        if dir_mtimes is not None:
+            dir_mtimes[dir_path] = os.stat(full_dir_path).st_mtime
+
+        files = []
+        sub_dirs = []
+        for name, is_dir, stat in list_dir(full_dir_path):
+            if is_dir:
+                sub_dirs.append(os.path.join(dir_path, name))
+            elif name.lower().endswith(IMAGE_EXTENSIONS):
+                files.append((os.path.join(dir_path, name), stat))
+
+        for path, stat in sorted(files):
+            yield path, stat()
+
+        # reversed, so that the directories are popped in sorted order
+        pending_dirs.extend(sorted(sub_dirs, reverse=True))
+
+
+def list_dir(dir_path):
+    '''Yields (name, is_dir, stat) of the entries of dir_path. stat is a function, called only for the images.'''
+    if scandir is not None:
+        for entry in scandir(dir_path):
+            # the type comes from the directory listing, no stat needed
+            yield entry.name, entry.is_dir(), entry.stat
+    else:
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            yield name, os.path.isdir(path), lambda path=path: os.stat(path)
+
+
+def read_image_dimensions(image_file):
+    '''Returns (height, width) from the image header without decoding the pixels, None for bad inputs.'''
+    from PIL import Image
+    try:
+        width, height = Image.open(image_file).size
+        return height, width
+    except Exception:
+        return None
@@ -0,0 +1,84 @@
+import os
+import json
+from misc import mkdir_p
+
+MANIFEST_VERSION = 1
+
+
+class DatasetManifest(object):
+    '''
+    Maps the files of a dataset to stable image indices.
+    Entries are only ever appended, so the image_idx of a file stays valid when the dataset grows.
+    Each entry keeps the path relative to the data dir, the size and the mtime of the file.
+    '''
+
+    def __init__(self, entries=None):
+        self.entries = entries if entries is not None else []
+
+    @property
+    def filenames(self):
+        return [entry['path'] for entry in self.entries]
+
+    def add_files(self, datadir, filenames, current_entries=None):
+        '''
+        Appends the files to the manifest, they get the next free image indices.
+        :param datadir:
+        :param filenames:
+        :param current_entries: dict path -> entry with the current size and mtime, e.g. from a DatasetIndex.
+                                Needed for images in shards. Default: stat the files
+        :return:
+        '''
+        for filename in filenames:
+            self.entries.append(get_current_entry(datadir, filename, current_entries))
+
+    def compare(self, datadir, filenames, current_entries=None):
+        '''
+        Compares the manifest with the current files of the dataset.
+        :param datadir:
+        :param filenames: current files, relative to datadir, in dataset order
+        :param current_entries: see add_files()
+        :return: (new files in the order of filenames, files that changed since they were added, files that are gone)
+        '''
+        current = set(filenames)
+        known = set()
+        changed_files = []
+        missing_files = []
+        for entry in self.entries:
+            known.add(entry['path'])
+            if entry['path'] not in current:
+                missing_files.append(entry['path'])
+                continue
+            if get_current_entry(datadir, entry['path'], current_entries) != entry:
+                changed_files.append(entry['path'])
+
+        new_files = [filename for filename in filenames if filename not in known]
+        return new_files, changed_files, missing_files
+
+    def save(self, filename):
+        mkdir_p(os.path.dirname(filename))
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wt') as manifest_file:
+            json.dump({'version': MANIFEST_VERSION, 'entries': self.entries}, manifest_file)
+        os.rename(temp_filename, filename)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rt') as manifest_file:
+            data = json.load(manifest_file)
+        assert data['version'] == MANIFEST_VERSION, 'Unsupported manifest version %s' % data['version']
+        # json gives unicode paths, the file lists use the byte strings of os.listdir
+        for entry in data['entries']:
+            entry['path'] = entry['path'].encode('utf-8')
+        return DatasetManifest(data['entries'])
+
+
+def stat_dataset_file(datadir, filename):
+    stat = os.stat(os.path.join(datadir, filename))
+    return {'path': filename, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def get_current_entry(datadir, filename, current_entries=None):
+    if current_entries is None:
+        return stat_dataset_file(datadir, filename)
+    current_entry = current_entries[filename]
+    return {'path': filename, 'size': current_entry['size'], 'mtime': current_entry['mtime']}
@@ -4,8 +4,14 @@ matplotlib.use('Agg')
 
 import os
 from jby_misc import WithTimer
-from max_tracker import scan_images_for_maxes
-from misc import mkdir_p
+from max_tracker import scan_images_for_maxes, merge_net_max_trackers
+from dataset_manifest import DatasetManifest
+from dataset_index import get_dataset_files
+from data_sources import is_shard_source
+from tracker_store import is_tracker_dir, save_tracker_dir, load_tracker_dir, save_tracker_text
+from misc import mkdir_p, get_files_list, set_net_batch_size
+from profiling import profiler, save_report_at_exit
+from autotune import autotune_settings, apply_autotune_file
 import cPickle as pickle
 from misc import load_network
 import argparse
@@ -21,50 +27,161 @@ import Settings
 
 def main():
     parser = argparse.ArgumentParser(
-        description='Finds images in a training set that cause max activation for a network; saves results in a pickled NetMaxTracker.')
+        description='Finds images in a training set that cause max activation for a network; saves results in a NetMaxTracker directory.')
     parser.add_argument('--model')
+    parser.add_argument('--resume', action='store_true', help='Continue from the checkpoint of an interrupted run.')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='Split the dataset into this many shards, to be scanned by separate runs (default: 1).')
+    parser.add_argument('--shard-index', type=int, default=0, help='Shard to scan, 0 to num-shards - 1 (default: 0).')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only scan files that are not in the manifest of the last run and merge them into its results.')
+    parser.add_argument('--rescan', action='store_true',
+                        help='List the data dir again, even if the cached dataset index looks current.')
+    parser.add_argument('--autotune', action='store_true',
+                        help='Time short trials of batch sizes and decode worker counts first, then run with the fastest.')
+    parser.add_argument('--save-autotune', action='store_true',
+                        help='With --autotune, save the choice to max_tracker_autotune_file. Later runs use it.')
+    parser.add_argument('--autotune-seconds', type=int, default=10, help='Duration of each autotune trial (default: 10).')
     args = parser.parse_args()
     settings = Settings.Settings()
     settings.load_settings(args.model)
+    save_report_at_exit(settings.timing_reports_path, 'find_max_act')
+    assert not (args.incremental and args.num_shards > 1), '--incremental can not be combined with --num-shards'
+
+    if settings.max_tracker_capture_patches and (args.incremental or args.num_shards > 1):
+        # the patches of a partial scan would overwrite the ones of the whole dataset
+        print 'Patches are not captured for incremental or sharded scans, run crop_max_patches.py afterwards'
+        settings.max_tracker_capture_patches = False
+
+    image_filenames = None
+    output_file = settings.find_maxes_output_file
+    if args.incremental:
+        manifest = DatasetManifest.load(settings.find_maxes_manifest_file)
+        # always list the data dir, an index of unchanged directories would hide files that were modified in place
+        dataset_index = get_dataset_files(settings.data_dir, settings.dataset_index_file, rescan=True)
+        new_files, changed_files, missing_files = manifest.compare(
+            settings.data_dir, dataset_index.filenames,
+            current_entries=dict((entry['path'], entry) for entry in dataset_index.entries))
+        for filename in changed_files:
+            print 'WARNING: %s changed since it was scanned, its old results are kept. Run a full scan to update them.' % filename
+        for filename in missing_files:
+            print 'WARNING: %s is missing, its old results are kept. Run a full scan to remove them.' % filename
+        if len(new_files) == 0:
+            print 'No new files in %s, nothing to do' % settings.data_dir
+            return
+        print 'Found %d new files' % len(new_files)
+        image_filenames = new_files
+        if settings.find_maxes_checkpoint_file is not None:
+            # the checkpoint of a full scan must not be resumed as an incremental one, and vice versa
+            base, ext = os.path.splitext(settings.find_maxes_checkpoint_file)
+            settings.find_maxes_checkpoint_file = '%s.incremental%s' % (base, ext)
+
+    elif args.num_shards > 1:
+        assert 0 <= args.shard_index < args.num_shards, 'shard-index must be in [0, num-shards)'
+        # the list has a stable order, so that all shards split the same list
+        image_filenames = get_files_list(settings.data_dir, settings.dataset_index_file, rescan=args.rescan)[0]
+        n_files = len(image_filenames)
+        image_filenames = image_filenames[args.shard_index * n_files / args.num_shards:
+                                          (args.shard_index + 1) * n_files / args.num_shards]
+        output_file = get_shard_filename(settings.find_maxes_output_file, args.shard_index, args.num_shards)
+        if settings.find_maxes_checkpoint_file is not None:
+            settings.find_maxes_checkpoint_file = get_shard_filename(settings.find_maxes_checkpoint_file,
+                                                                     args.shard_index, args.num_shards)
+        print 'Scanning shard %d of %d' % (args.shard_index, args.num_shards)
+
+    elif args.rescan:
+        image_filenames = get_files_list(settings.data_dir, settings.dataset_index_file, rescan=True)[0]
+
     net = load_network(settings)
 
+    if args.autotune:
+        trial_filenames = image_filenames
+        if trial_filenames is None:
+            trial_filenames = get_files_list(settings.data_dir, settings.dataset_index_file)[0]
+        autotune_settings(settings, net, settings.data_dir, trial_filenames, 'scan', save=args.save_autotune,
+                          trial_seconds=args.autotune_seconds)
+    else:
+        apply_autotune_file(settings, 'scan')
+
     # set network batch size
-    current_input_shape = net.blobs[net.inputs[0]].shape
-    current_input_shape[0] = settings.max_tracker_batch_size
-    net.blobs[net.inputs[0]].reshape(*current_input_shape)
-    net.reshape()
+    set_net_batch_size(net, settings.max_tracker_batch_size)
 
     with WithTimer('Scanning images'):
-        net_max_tracker = scan_images_for_maxes(settings, net, settings.data_dir, settings.N, settings.deepvis_outputs_path, settings.search_min)
+        net_max_tracker = scan_images_for_maxes(settings, net, settings.data_dir, settings.N, settings.deepvis_outputs_path, settings.search_min,
+                                                resume=args.resume, image_filenames=image_filenames)
 
-    save_max_tracker_to_file(settings.find_maxes_output_file, net_max_tracker)
+    if args.incremental:
+        # new files get the next image indices, the old ones keep theirs
+        previous_net_max_tracker = load_max_tracker_from_file(settings.find_maxes_output_file)
+        assert previous_net_max_tracker.image_filenames == manifest.filenames, \
+            'Results and manifest are out of sync, run a full scan'
+        net_max_tracker = merge_net_max_trackers([previous_net_max_tracker, net_max_tracker],
+                                                 image_filenames=manifest.filenames + image_filenames)
 
+    save_max_tracker_to_file(output_file, net_max_tracker, save_text=settings.max_tracker_save_text)
 
-def save_max_tracker_to_file(filename, net_max_tracker):
+    if args.num_shards == 1:
+        save_manifest_of_tracker(settings, net_max_tracker)
 
-    dir_name = os.path.dirname(filename)
-    mkdir_p(dir_name)
+    # the checkpoint is obsolete once the results are saved
+    if settings.find_maxes_checkpoint_file is not None and os.path.exists(settings.find_maxes_checkpoint_file):
+        os.remove(settings.find_maxes_checkpoint_file)
+
+
+def get_shard_filename(filename, shard_index, num_shards):
+    # e.g. find_max_acts_output -> find_max_acts_output.shard_001_of_004
+    base, ext = os.path.splitext(filename)
+    return '%s.shard_%03d_of_%03d%s' % (base, shard_index, num_shards, ext)
 
-    with WithTimer('Saving maxes'):
-        with open(filename, 'wb') as ff:
-            pickle.dump(net_max_tracker, ff, -1)
-        # save text version of pickle file for easier debugging
-        pickle_to_text(filename)
 
+def save_manifest_of_tracker(settings, net_max_tracker):
+    '''Saves the manifest of the files the tracker refers to, used by --incremental.'''
+    current_entries = None
+    if is_shard_source(settings.data_dir):
+        # images in shards can not be stat'ed, take their size and mtime from the index
+        dataset_index = get_dataset_files(settings.data_dir, settings.dataset_index_file)
+        current_entries = dict((entry['path'], entry) for entry in dataset_index.entries)
+
+    manifest = DatasetManifest()
+    manifest.add_files(settings.data_dir, net_max_tracker.image_filenames, current_entries)
+    manifest.save(settings.find_maxes_manifest_file)
+
+
+def save_max_tracker_to_file(filename, net_max_tracker, save_text=False):
+    '''
+    Saves the tracker as directory of arrays, see tracker_store.py.
+    :param filename:
+    :param net_max_tracker:
+    :param save_text: also save a text version of the tops to filename.txt, for easier debugging
+    :return:
+    '''
+
+    dir_name = os.path.dirname(filename)
+    mkdir_p(dir_name)
 
-def pickle_to_text(pickle_filename):
-    with open(pickle_filename, 'rb') as pickle_file:
-        data = pickle.load(pickle_file)
+    with WithTimer('Saving maxes'), profiler.timer('save'):
+        save_tracker_dir(filename, net_max_tracker)
+        if save_text:
+            save_tracker_text(filename + '.txt', net_max_tracker)
 
-    data_dict = data.__dict__.copy()
 
-    with open(pickle_filename + ".txt", 'wt') as text_file:
-        text_file.write(str(data_dict))
+def load_max_tracker_from_file(filename, layers=None, mmap_mode=None):
+    '''
+    Loads a tracker saved by save_max_tracker_to_file(), or a pickled one of older versions.
+    :param filename:
+    :param layers: layers to load, default: all. Only used for tracker directories
+    :param mmap_mode: e.g. 'r' to map the arrays instead of reading them. Only used for tracker directories
+    :return:
+    '''
 
-    return
+    # older versions saved a pickle next to the current default location
+    if not os.path.exists(filename) and os.path.exists(filename + '.pickled'):
+        filename = filename + '.pickled'
 
+    if is_tracker_dir(filename):
+        return load_tracker_dir(filename, layers=layers, mmap_mode=mmap_mode)
 
-def load_max_tracker_from_file(filename):
+    print 'Loading pickled tracker %s, convert it with convert_max_tracker.py to load it faster' % filename
     with open(filename, 'rb') as tracker_file:
         net_max_tracker = pickle.load(tracker_file)
 
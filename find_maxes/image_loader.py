@@ -0,0 +1,175 @@
+import os
+import sys
+import multiprocessing
+from itertools import izip
+from collections import deque
+from StringIO import StringIO
+import numpy as np
+from misc import resize_without_fit
+from profiling import profiler
+from data_sources import is_shard_source, ShardReader
+
+
+def load_image_for_net(path, net_input_dims, data=None, fast_decode=False):
+    '''
+    Loads an image and resizes it (without fit) to the net input dims. Returns None for bad/missing inputs.
+    :param path: image file, not used if data is given
+    :param net_input_dims:
+    :param data: content of the image file, e.g. read from a shard
+    :param fast_decode: use load_image_uint8_for_net()
+    :return: float32 image in [0, 1], or uint8 image with fast_decode
+    '''
+    if data is not None:
+        path = StringIO(data)
+    elif path is None:
+        return None
+
+    if fast_decode:
+        return load_image_uint8_for_net(path, net_input_dims)
+
+    import caffe
+
+    try:
+        im = caffe.io.load_image(path, color=True)
+        with profiler.timer('resize'):
+            im = resize_without_fit(im, net_input_dims)
+        return im.astype(np.float32)
+    except:
+        return None
+
+
+def load_image_uint8_for_net(path, net_input_dims):
+    '''
+    Faster version of load_image_for_net(), returns a uint8 image in [0, 255]. JPEGs are decoded at the smallest
+    scale (1/2, 1/4 or 1/8) that is still at least the net input size, and the image stays uint8 until the
+    preprocessing of the batch. The result differs slightly from the full decode.
+    Returns None for bad/missing inputs.
+    '''
+    from PIL import Image
+
+    try:
+        image = Image.open(path)
+        image.draft('RGB', (net_input_dims[1], net_input_dims[0]))
+        # gray and alpha images become RGB, like in caffe.io.load_image
+        im = np.asarray(image.convert('RGB'))
+        with profiler.timer('resize'):
+            return resize_without_fit(im, net_input_dims)
+    except:
+        return None
+
+
+def _init_worker(caffevis_caffe_root):
+    caffe_python_path = os.path.join(caffevis_caffe_root, 'python')
+    # also called for every loader of the calling process
+    if caffe_python_path not in sys.path:
+        sys.path.insert(0, caffe_python_path)
+
+
+def _load_image_job(job):
+    path, data, net_input_dims, fast_decode = job
+    return load_image_for_net(path, net_input_dims, data, fast_decode)
+
+
+def _load_image_job_in_worker(job):
+    '''Runs in a worker process, returns the image and the timings of the worker, which are merged by _collect.'''
+    profiler.stats.clear()
+    return _load_image_job(job), profiler.stats
+
+
+class ImageBatchLoader(object):
+    '''
+    Decodes and resizes images in a pool of worker processes, ahead of the consumer.
+    At most queue_depth batches are decoded ahead, so memory use stays bounded.
+    With num_workers=0 the images are decoded on the calling thread, as before.
+    With fast_decode, images are uint8, see load_image_uint8_for_net().
+    '''
+
+    def __init__(self, caffevis_caffe_root, net_input_dims, num_workers=0, queue_depth=2, fast_decode=False):
+        self.caffevis_caffe_root = caffevis_caffe_root
+        self.net_input_dims = tuple(net_input_dims)
+        self.fast_decode = fast_decode
+        self.num_workers = num_workers
+        self.queue_depth = max(queue_depth, 1)
+        self.pool = None
+
+        _init_worker(caffevis_caffe_root)
+        if self.num_workers > 0:
+            self.pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker,
+                                             initargs=(caffevis_caffe_root,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def iter_batches(self, datadir, image_filenames, batch_size, image_indices=None):
+        '''
+        Yields lists of (image_idx, filename, im), in image order.
+        Every list holds batch_size images, except for the last one. Bad/missing inputs are skipped.
+        :param datadir: directory of the images, or tar/zip shards, see data_sources.py
+        :param image_filenames: all file names, image_idx is the index in this list
+        :param batch_size:
+        :param image_indices: the image_idx to load, default: all
+        :return:
+        '''
+        if image_indices is None:
+            image_indices = xrange(len(image_filenames))
+
+        max_pending = self.queue_depth * batch_size
+        pending = deque()
+        batch = []
+
+        for image_idx, job in self._iter_jobs(datadir, image_filenames, image_indices):
+            if self.pool is not None:
+                pending.append((image_idx, self.pool.apply_async(_load_image_job_in_worker, (job,))))
+            else:
+                pending.append((image_idx, _load_image_job(job)))
+
+            # wait for the oldest image once enough images are in flight
+            if len(pending) >= max_pending:
+                batch = self._collect(pending.popleft(), image_filenames, batch)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+
+        while pending:
+            batch = self._collect(pending.popleft(), image_filenames, batch)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def _iter_jobs(self, datadir, image_filenames, image_indices):
+        '''Yields (image_idx, job). Images in shards are read here, in order, and only decoded by the workers.'''
+        if is_shard_source(datadir):
+            image_indices = list(image_indices)
+            images = ShardReader(datadir).iter_images(image_filenames[image_idx] for image_idx in image_indices)
+            for image_idx, (filename, data) in izip(image_indices, images):
+                yield image_idx, (None, data, self.net_input_dims, self.fast_decode)
+        else:
+            for image_idx in image_indices:
+                yield image_idx, (os.path.join(datadir, image_filenames[image_idx]), None, self.net_input_dims,
+                                  self.fast_decode)
+
+    def _collect(self, pending_image, image_filenames, batch):
+        image_idx, result = pending_image
+        if self.pool is not None:
+            im, worker_stats = result.get()
+            profiler.merge(worker_stats, prefix='workers/')
+        else:
+            im = result
+        if im is None:
+            # skip bad/missing inputs
+            print "WARNING: skipping bad/missing input:", image_filenames[image_idx]
+        else:
+            batch.append((image_idx, image_filenames[image_idx], im))
+        return batch
@@ -0,0 +1,35 @@
+#! /usr/bin/env python
+
+import argparse
+from jby_misc import WithTimer
+from dataset_index import DatasetIndex
+
+# add parent folder to search path, to enable import of core modules like settings
+import os, sys, inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Settings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Lists the images of the data dir and its subdirectories and saves the dataset index, which the offline scripts reuse while no files are added or removed.')
+    parser.add_argument('--model')
+    parser.add_argument('--dimensions', action='store_true',
+                        help='Also read the height and width of each image from its header.')
+    args = parser.parse_args()
+    settings = Settings.Settings()
+    settings.load_settings(args.model)
+
+    with WithTimer('Indexing %s' % settings.data_dir):
+        index = DatasetIndex.build(settings.data_dir, with_dimensions=args.dimensions)
+    index.save(settings.dataset_index_file)
+
+    print 'Indexed %d images in %d directories, saved to %s' % (len(index.entries), len(index.dir_mtimes),
+                                                                settings.dataset_index_file)
+
+
+if __name__ == '__main__':
+    main()
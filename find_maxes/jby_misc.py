@@ -3,6 +3,12 @@
 
 import time
 
+try:
+    process_time = time.process_time
+except AttributeError:
+    # time.process_time is new in Python 3.3, time.clock was removed in 3.8
+    process_time = time.clock
+
 
 class WithTimer:
     def __init__(self, title = '', quiet = False):
@@ -10,14 +16,14 @@ class WithTimer:
         self.quiet = quiet
         
     def elapsed(self):
-        return time.time() - self.wall, time.clock() - self.proc
+        return time.time() - self.wall, process_time() - self.proc
 
     def enter(self):
         '''Manually trigger enter'''
         self.__enter__()
     
     def __enter__(self):
-        self.proc = time.clock()
+        self.proc = process_time()
         self.wall = time.time()
         return self
         
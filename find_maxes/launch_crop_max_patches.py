@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+
+# this import must comes first to make sure we use the non-display backend
+import matplotlib
+
+matplotlib.use('Agg')
+
+import argparse
+import time
+import multiprocessing
+import numpy as np
+from max_tracker import output_max_patches, get_tracker_files_list
+from find_max_act import load_max_tracker_from_file
+from crop_max_patches import make_max_patches_jobs, get_do_which
+from autotune import apply_autotune_file
+from profiling import profiler, save_report_at_exit
+from misc import load_network, process_network_proto, set_net_batch_size
+
+# add parent folder to search path, to enable import of core modules like settings
+import os, sys, inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Settings
+
+# net and tracker of a worker process, set by _init_worker
+_worker = dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Runs crop_max_patches.py on all units of layers_to_output_in_offline_scripts in a pool of worker processes, each with its own net. The layers are split into unit ranges of about the same number of top records.')
+    parser.add_argument('--model')
+    parser.add_argument('--num-workers', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of worker processes (default: number of CPUs).')
+    parser.add_argument('--ranges-per-worker', type=int, default=4,
+                        help='Split the units into this many ranges per worker, more ranges balance better but share fewer images (default: 4).')
+    args = parser.parse_args()
+    settings = Settings.Settings()
+    settings.load_settings(args.model)
+    save_report_at_exit(settings.timing_reports_path, 'launch_crop_max_patches')
+
+    assert settings.max_tracker_do_maxes or settings.max_tracker_do_deconv or settings.max_tracker_do_deconv_norm or settings.max_tracker_do_backprop or settings.max_tracker_do_backprop_norm, 'Specify at least one do_* option to output.'
+
+    nmt = load_max_tracker_from_file(settings.find_maxes_output_file,
+                                     layers=settings.layers_to_output_in_offline_scripts, mmap_mode='r')
+
+    layer_records = [(layer_name, count_unit_records(settings, nmt, layer_name))
+                     for layer_name in settings.layers_to_output_in_offline_scripts]
+    unit_ranges = split_unit_ranges(layer_records, args.num_workers * args.ranges_per_worker)
+
+    # largest ranges first, so that no worker starts a large one at the end
+    unit_ranges.sort(key=lambda unit_range: unit_range[3], reverse=True)
+
+    n_records = sum(unit_range[3] for unit_range in unit_ranges)
+    print 'Cropping %d top records of %d units in %d ranges with %d workers' % (
+        n_records, sum(len(unit_records) for layer_name, unit_records in layer_records), len(unit_ranges),
+        args.num_workers)
+
+    # listed once, the workers must all use the same list
+    image_filenames = get_tracker_files_list(nmt, settings.data_dir)
+
+    # processed once, the workers only read it
+    processed_prototxt = process_network_proto(settings.prototxt, settings.caffevis_caffe_root)
+
+    pool = multiprocessing.Pool(args.num_workers, initializer=_init_worker,
+                                initargs=(settings, image_filenames, processed_prototxt))
+    try:
+        start_time = time.time()
+        n_done_records = 0
+        for n_done_ranges, (unit_range, seconds, worker_stats) in enumerate(
+                pool.imap_unordered(_crop_unit_range, unit_ranges), 1):
+            layer_name, idx_begin, idx_end, n_range_records = unit_range
+            n_done_records += n_range_records
+            profiler.count('records', n_range_records)
+            profiler.add('range', seconds)
+            profiler.merge(worker_stats, prefix='range/')
+            elapsed = time.time() - start_time
+            records_per_sec = n_done_records / elapsed if elapsed > 0 else 0
+            print 'Progress: %d/%d ranges, %d/%d records, %.1f records/sec, about %d s left (%s units %d:%d took %.1f s)' % (
+                n_done_ranges, len(unit_ranges), n_done_records, n_records, records_per_sec,
+                (n_records - n_done_records) / records_per_sec if records_per_sec > 0 else 0,
+                layer_name, idx_begin, idx_end, seconds)
+
+        elapsed = time.time() - start_time
+        print 'Cropped %d records in %.1f s, %.1f records/sec' % (n_records, elapsed,
+                                                                  n_records / elapsed if elapsed > 0 else 0)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def count_unit_records(settings, nmt, layer_name):
+    '''
+    Number of valid top records of each unit of the layer among the N that are cropped, for the maxes and, with
+    search_min, the mins. Tops without an image are skipped by crop_max_patches.py and cost nothing.
+    '''
+    mt = nmt.max_trackers[layer_name]
+    unit_records = np.zeros(mt.max_vals.shape[0], dtype=np.int64)
+
+    locs_list = [mt.max_locs]
+    if settings.search_min:
+        locs_list.append(mt.min_locs)
+    for locs in locs_list:
+        # the best tops are at the end
+        unit_records += (locs[:, max(locs.shape[1] - settings.N, 0):, 0] >= 0).sum(axis=1)
+    return unit_records
+
+
+def split_unit_ranges(layer_records, n_ranges):
+    '''
+    Splits the units of each layer into ranges of consecutive units with about the same number of records.
+    :param layer_records: list of (layer_name, number of records of each unit)
+    :param n_ranges: number of ranges to aim for, layers with few records get fewer
+    :return: list of (layer_name, idx_begin, idx_end, number of records)
+    '''
+    n_records = sum(unit_records.sum() for layer_name, unit_records in layer_records)
+    records_per_range = max(float(n_records) / n_ranges, 1)
+
+    unit_ranges = []
+    for layer_name, unit_records in layer_records:
+        idx_begin = 0
+        range_records = 0
+        for idx, records in enumerate(unit_records):
+            range_records += records
+            if range_records >= records_per_range:
+                unit_ranges.append((layer_name, idx_begin, idx + 1, int(range_records)))
+                idx_begin = idx + 1
+                range_records = 0
+        if idx_begin < len(unit_records):
+            unit_ranges.append((layer_name, idx_begin, len(unit_records), int(range_records)))
+    return unit_ranges
+
+
+def _init_worker(settings, image_filenames, processed_prototxt):
+    # workers of a pool can't have processes of their own, so the images are decoded by the worker itself
+    apply_autotune_file(settings, 'crop')
+    settings.max_tracker_decode_workers = 0
+
+    net = load_network(settings, processed_prototxt)
+    set_net_batch_size(net, settings.max_tracker_batch_size)
+
+    _worker['settings'] = settings
+    _worker['image_filenames'] = image_filenames
+    _worker['net'] = net
+    _worker['nmt'] = load_max_tracker_from_file(settings.find_maxes_output_file,
+                                                layers=settings.layers_to_output_in_offline_scripts, mmap_mode='r')
+
+
+def _crop_unit_range(unit_range):
+    settings, net, nmt = _worker['settings'], _worker['net'], _worker['nmt']
+    layer_name, idx_begin, idx_end, n_records = unit_range
+
+    # the timings of each range are sent to the launcher
+    profiler.stats.clear()
+
+    start_time = time.time()
+    output_max_patches(settings, net, make_max_patches_jobs(settings, nmt, layer_name, idx_begin, idx_end),
+                       settings.N, settings.data_dir, settings.deepvis_outputs_path, get_do_which(settings),
+                       image_filenames=_worker['image_filenames'])
+    return unit_range, time.time() - start_time, profiler.stats
+
+
+if __name__ == '__main__':
+    main()
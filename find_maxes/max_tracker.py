@@ -1,10 +1,15 @@
-import re
 import os
-import sys
 from jby_misc import WithTimer
-from misc import layer_name_to_top_name, get_files_list, resize_without_fit, mkdir_p, get_max_data_extent, \
-    compute_data_layer_focus_area, extract_patch_from_image, save_caffe_image
-from datetime import datetime
+from profiling import profiler, ProgressReporter
+from image_loader import ImageBatchLoader
+from data_sources import get_image_path
+from checkpoint import ScanCheckpointer, load_checkpoint
+from channel_stats import ChannelStats
+from stats_rendering import PlotRenderer, stats_digest, layer_plots_are_current, save_layer_digest, \
+    render_max_histograms, render_correlation_matrix
+from misc import layer_name_to_top_name, get_files_list, get_legacy_files_list, mkdir_p, get_max_data_extent, \
+    get_receptive_field_table, extract_patch_from_image, save_caffe_image, get_forward_end_layer, \
+    predict_to_layer
 import numpy as np
 
 
@@ -16,7 +21,8 @@ class MaxTrackerCropBatchRecord(object):
                  selected_input_index=None, ii=None, jj=None, recorded_val=None,
                  out_ii_start=None, out_ii_end=None, out_jj_start=None, out_jj_end=None, data_ii_start=None,
                  data_ii_end=None, data_jj_start=None, data_jj_end=None, im=None,
-                 denormalized_layer_name=None, denormalized_top_name=None, layer_format=None):
+                 denormalized_layer_name=None, denormalized_top_name=None, layer_format=None, filename=None,
+                 size_ii=None, size_jj=None):
         self.cc = cc
         self.channel_idx = channel_idx
         self.info_filename = info_filename
@@ -45,6 +51,9 @@ class MaxTrackerCropBatchRecord(object):
         self.denormalized_layer_name = denormalized_layer_name
         self.denormalized_top_name = denormalized_top_name
         self.layer_format = layer_format
+        self.filename = filename
+        self.size_ii = size_ii
+        self.size_jj = size_jj
 
 
 class MaxTrackerBatchRecord(object):
@@ -55,71 +64,90 @@ class MaxTrackerBatchRecord(object):
         self.im = im
 
 
-def scan_images_for_maxes(settings, net, datadir, n_top, outdir, search_min):
-    image_filenames, image_labels = get_files_list(datadir)
-    print 'Scanning %d files' % len(image_filenames)
-    print '  First file', os.path.join(datadir, image_filenames[0])
-
-    sys.path.insert(0, os.path.join(settings.caffevis_caffe_root, 'python'))
-    import caffe
+def scan_images_for_maxes(settings, net, datadir, n_top, outdir, search_min, resume=False, image_filenames=None):
 
-    tracker = NetMaxTracker(settings, n_top=n_top, layers=settings.layers_to_output_in_offline_scripts,
-                            search_min=search_min)
+    checkpointer = ScanCheckpointer(settings.find_maxes_checkpoint_file,
+                                    every_images=settings.max_tracker_checkpoint_images,
+                                    every_seconds=settings.max_tracker_checkpoint_seconds)
 
-    net_input_dims = net.blobs['data'].data.shape[2:4]
+    if image_filenames is None:
+        image_filenames, image_labels = get_files_list(datadir, settings.dataset_index_file)
 
-    # prepare variables used for batches
-    batch = [None] * settings.max_tracker_batch_size
-    for i in range(0, settings.max_tracker_batch_size):
-        batch[i] = MaxTrackerBatchRecord()
-
-    batch_index = 0
+    tracker = None
+    if resume and os.path.exists(settings.find_maxes_checkpoint_file):
+        tracker, start_position = load_checkpoint(settings.find_maxes_checkpoint_file)
+        if tracker.image_filenames != image_filenames:
+            # e.g. the checkpoint of a full scan, when resuming an incremental one
+            print 'WARNING: the checkpoint at %s is of a scan of other files, starting from scratch' % \
+                  settings.find_maxes_checkpoint_file
+            tracker = None
+        else:
+            tracker.settings = settings
+            print 'Resuming scan of %d files at image %d' % (len(image_filenames), start_position)
+    elif resume:
+        print 'WARNING: no checkpoint found at %s, starting from scratch' % settings.find_maxes_checkpoint_file
+
+    if tracker is None:
+        start_position = 0
+        tracker = NetMaxTracker(settings, n_top=n_top, layers=settings.layers_to_output_in_offline_scripts,
+                                search_min=search_min, image_filenames=image_filenames,
+                                capture_patches=settings.max_tracker_capture_patches,
+                                channel_correlation=settings.max_tracker_channel_correlation)
+        print 'Scanning %d files' % len(image_filenames)
+    print '  First file', get_image_path(datadir, image_filenames[0])
 
-    for image_idx in xrange(len(image_filenames)):
+    net_input_dims = net.blobs['data'].data.shape[2:4]
 
-        batch[batch_index].image_idx = image_idx
-        batch[batch_index].filename = image_filenames[image_idx]
+    # no need to run the layers above the tracked ones
+    end_layer = get_forward_end_layer(net, settings, tracker.layers)
+    print 'Forward pass ends at layer %s' % (end_layer if end_layer is not None else 'the net output')
 
-        do_print = (batch[batch_index].image_idx % 100 == 0)
-        if do_print:
-            print '%s   Image %d/%d' % (datetime.now().ctime(), batch[batch_index].image_idx, len(image_filenames))
+    # images are decoded by a pool of workers while the net runs
+    loader = ImageBatchLoader(settings.caffevis_caffe_root, net_input_dims,
+                              num_workers=settings.max_tracker_decode_workers,
+                              queue_depth=settings.max_tracker_prefetch_batches,
+                              fast_decode=settings.max_tracker_fast_decode)
 
-        with WithTimer('Load image', quiet=not do_print):
-            try:
-                batch[batch_index].im = caffe.io.load_image(os.path.join(datadir, batch[batch_index].filename),
-                                                            color=True)
-                batch[batch_index].im = resize_without_fit(batch[batch_index].im, net_input_dims)
-                batch[batch_index].im = batch[batch_index].im.astype(np.float32)
-            except:
-                # skip bad/missing inputs
-                print "WARNING: skipping bad/missing input:", batch[batch_index].filename
-                continue
+    progress = ProgressReporter('images', len(image_filenames), n_done=start_position,
+                                interval=settings.max_tracker_progress_seconds)
 
-        batch_index += 1
+    with loader:
+        loaded_batches = loader.iter_batches(datadir, image_filenames, settings.max_tracker_batch_size,
+                                             image_indices=xrange(start_position, len(image_filenames)))
+        for loaded_batch in profiler.iter_timed('load', loaded_batches):
 
-        # if current batch is full
-        if batch_index == settings.max_tracker_batch_size \
-                or image_idx == len(image_filenames) - 1:  # or last iteration
+            batch = [MaxTrackerBatchRecord(image_idx, filename, im) for image_idx, filename, im in loaded_batch]
 
             # batch predict
-            with WithTimer('Predict on batch  ', quiet=not do_print):
+            with profiler.timer('predict'):
                 im_batch = [record.im for record in batch]
-                net.predict(im_batch, oversample=False)  # Just take center crop
+                predict_to_layer(net, im_batch, end_layer)  # Just take center crop
+
+            # update statistics with the whole batch at once
+            with profiler.timer('update'):
+                tracker.update_batch(net, [record.image_idx for record in batch],
+                                     net_unique_input_sources=[record.filename for record in batch])
 
-            # go over batch and update statistics
-            for i in range(0, batch_index):
-                with WithTimer('Update    ', quiet=not do_print):
-                    tracker.update(net, batch[i].image_idx, net_unique_input_source=batch[i].filename, batch_index=i)
+            checkpointer.maybe_save(tracker, batch[-1].image_idx + 1, len(batch))
 
-            batch_index = 0
+            # bad inputs are skipped, so the position is taken from the image index
+            progress.update(batch[-1].image_idx + 1 - progress.n_done)
+
+    if tracker.capture_patches:
+        with WithTimer('Save captured patches'), profiler.timer('save'):
+            tracker.save_captured_patches(outdir)
 
     print 'done!'
     return tracker
 
 
 class NetMaxTracker(object):
-    def __init__(self, settings, layers, n_top=10, initial_val=-1e99, dtype='float32', search_min=False):
+    def __init__(self, settings, layers, n_top=10, initial_val=-1e99, dtype='float32', search_min=False,
+                 image_filenames=None, capture_patches=False, channel_correlation=True):
         self.layers = layers
+        self.image_filenames = image_filenames  # image_idx in the locations is the index in this list
+        self.capture_patches = capture_patches  # keep the input patches of the tops, see save_captured_patches()
+        self.channel_correlation = channel_correlation  # keep the channel co-moments, needed for calculate_correlation
         self.init_done = False
         self.n_top = n_top
         self.search_min = search_min
@@ -141,10 +169,34 @@ class NetMaxTracker(object):
             if layer_name not in self.max_trackers:
                 self.max_trackers[layer_name] = MaxTracker(is_spatial, blob.shape[1], n_top=self.n_top,
                                                            initial_val=self.initial_val,
-                                                           dtype=blob.dtype, search_min=self.search_min)
+                                                           dtype=blob.dtype, search_min=self.search_min,
+                                                           track_correlation=self.channel_correlation)
+
+                if self.capture_patches:
+                    size_ii, size_jj = get_max_data_extent(net, self.settings, layer_name, is_spatial)
+                    self.max_trackers[layer_name].init_patches((3, size_ii, size_jj))
+                    print 'capturing patches of %dx%d pixels for layer %s' % (size_ii, size_jj, layer_name)
 
         self.init_done = True
 
+    def _get_patch_extractor(self, net, layer_name):
+        '''Returns a function that crops the receptive field of a unit of layer_name from the current data blob.'''
+
+        is_spatial = self.max_trackers[layer_name].is_spatial
+        size_ii, size_jj = self.max_trackers[layer_name].max_patches.shape[3:5]
+        data = net.blobs['data'].data
+        receptive_field_table = get_receptive_field_table(net, self.settings)
+
+        def extract_patch(batch_index, ii, jj):
+            [out_ii_start, out_ii_end, out_jj_start, out_jj_end,
+             data_ii_start, data_ii_end, data_jj_start, data_jj_end] = \
+                receptive_field_table.focus_area(layer_name, is_spatial, ii, jj)
+            return extract_patch_from_image(data[batch_index], net, -1, self.settings,
+                                            data_ii_end, data_ii_start, data_jj_end, data_jj_start,
+                                            out_ii_end, out_ii_start, out_jj_end, out_jj_start, size_ii, size_jj)
+
+        return extract_patch
+
     def update(self, net, image_idx, net_unique_input_source, batch_index):
         '''Updates the maxes found so far with the state of the given net. If a new max is found, it is stored together with the image_idx.'''
 
@@ -162,25 +214,84 @@ class NetMaxTracker(object):
 
         pass
 
-    def calculate_histograms(self, outdir):
+    def update_batch(self, net, image_indices, net_unique_input_sources):
+        '''Updates the maxes found so far with the first len(image_indices) inputs of the net batch at once.
 
-        print "calculate_histograms on network"
+        Gives the same result as calling update() for every input in batch order.
+        '''
+
+        if not self.init_done:
+            self._init_with_net(net)
+
+        n_inputs = len(image_indices)
         for layer_name in self.layers:
-            print "calculate_histogram on layer %s" % layer_name
 
-            self.max_trackers[layer_name].calculate_histogram(layer_name, outdir)
+            top_name = layer_name_to_top_name(net, layer_name)
+            blob = net.blobs[top_name].data
+
+            patch_extractor = self._get_patch_extractor(net, layer_name) if self.capture_patches else None
+
+            self.max_trackers[layer_name].update_batch(blob[:n_inputs], image_indices, -1,
+                                                       net_unique_input_sources, layer_name,
+                                                       patch_extractor=patch_extractor)
 
         pass
 
-    def calculate_correlation(self, outdir):
+    def save_captured_patches(self, outdir):
+        '''
+        Writes the captured patches and the info files as the maxim_*.png and info.txt files of
+        crop_max_patches.py, then frees the patches. crop_max_patches.py skips the units whose files exist.
+        '''
 
-        print "calculate_correlation on network"
         for layer_name in self.layers:
-            print "calculate_correlation on layer %s" % layer_name
+            print 'saving captured patches of layer %s' % layer_name
+            self.max_trackers[layer_name].save_patches(layer_name, outdir, self.settings, self.image_filenames)
+
+        self.capture_patches = False
+
+    def calculate_histograms(self, outdir, backend='matplotlib', num_workers=0, force=False):
+        '''
+        Plots the max histogram of each unit and the activity of each layer.
+        Layers whose statistics did not change since the last plots are skipped, unless force is set.
+        :param outdir:
+        :param backend: 'matplotlib' or 'opencv'
+        :param num_workers: number of processes that render the plots, 0 to render on the calling process
+        :param force:
+        :return:
+        '''
+
+        print "calculate_histograms on network"
+        with PlotRenderer(backend, num_workers) as renderer:
+            digests = []
+            for layer_name in self.layers:
+                print "calculate_histogram on layer %s" % layer_name
 
-            self.max_trackers[layer_name].calculate_correlation(layer_name, outdir)
+                digests.append(self.max_trackers[layer_name].calculate_histogram(layer_name, outdir, renderer, force))
 
-        pass
+            renderer.wait()
+
+        # only mark the layers as done once all of their plots are written
+        for digest in digests:
+            if digest is not None:
+                save_layer_digest(*digest)
+
+    def calculate_correlation(self, outdir, backend='matplotlib', num_workers=0, force=False):
+        '''Plots the correlation matrix of the channels of each layer, see calculate_histograms() for the options.'''
+
+        print "calculate_correlation on network"
+        with PlotRenderer(backend, num_workers) as renderer:
+            digests = []
+            for layer_name in self.layers:
+                print "calculate_correlation on layer %s" % layer_name
+
+                digests.append(self.max_trackers[layer_name].calculate_correlation(layer_name, outdir, renderer,
+                                                                                   force))
+
+            renderer.wait()
+
+        for digest in digests:
+            if digest is not None:
+                save_layer_digest(*digest)
 
     def __getstate__(self):
         # Copy the object's state from self.__dict__ which contains
@@ -200,7 +311,8 @@ class NetMaxTracker(object):
 
 class MaxTracker(object):
 
-    def __init__(self, is_spatial, n_channels, n_top=10, initial_val=-1e99, dtype='float32', search_min=False):
+    def __init__(self, is_spatial, n_channels, n_top=10, initial_val=-1e99, dtype='float32', search_min=False,
+                 track_correlation=True):
         self.is_spatial = is_spatial
         self.n_top = n_top
         self.search_min = search_min
@@ -221,12 +333,16 @@ class MaxTracker(object):
         # set of seen inputs, used to avoid updating on the same input twice
         self.seen_inputs = set()
 
-        # will hold a list of np array, each containing the max values of all the channels for one input
-        self.all_max_vals = list()
+        # statistics of the max values of all the channels over all inputs, for the histograms and correlation
+        self.channel_stats = ChannelStats(n_channels, track_correlation=track_correlation)
 
         # keeps a map between channel index and histogram values
         self.channel_to_histogram = [None] * n_channels
 
+        # input patches of the tops, (n_channels, n_top, 3, H, W). Only kept if patches are captured during the scan
+        self.max_patches = None
+        self.min_patches = None
+
     def __getstate__(self):
         # Copy the object's state from self.__dict__ which contains
         # all our instance attributes. Always use the dict.copy()
@@ -234,7 +350,6 @@ class MaxTracker(object):
         state = self.__dict__.copy()
         # Remove the unpicklable entries.
         del state['seen_inputs']
-        del state['all_max_vals']
         return state
 
     def __setstate__(self, state):
@@ -242,137 +357,186 @@ class MaxTracker(object):
         self.__dict__.update(state)
 
         self.seen_inputs = None
-        self.all_max_vals = None
+
+        # trackers saved by older versions have no statistics
+        if 'channel_stats' not in state:
+            self.channel_stats = None
 
     def __repr__(self):
         return str(self.__dict__.copy())
 
+    def init_patches(self, patch_shape):
+        n_channels = self.max_vals.shape[0]
+        self.max_patches = np.zeros((n_channels, self.n_top) + tuple(patch_shape), dtype=np.float32)
+        if self.search_min:
+            self.min_patches = np.zeros((n_channels, self.n_top) + tuple(patch_shape), dtype=np.float32)
+
     def update(self, data, image_idx, selected_input_index, layer_unique_input_source, layer_name):
 
-        # if unique_input_source already exist, we can skip the update since we've already seen it
-        if layer_unique_input_source in self.seen_inputs:
+        self.update_batch(data[np.newaxis], [image_idx], selected_input_index, [layer_unique_input_source],
+                          layer_name)
+
+    def update_batch(self, data, image_indices, selected_input_index, layer_unique_input_sources, layer_name,
+                     patch_extractor=None):
+        '''
+        Updates the tops with a whole batch of inputs.
+        The result is identical to calling update() once per input, in batch order.
+        :param data: activations of the batch, (batch, C, H, W) or (batch, C)
+        :param image_indices: image_idx of each input in the batch
+        :param selected_input_index:
+        :param layer_unique_input_sources: unique identifier of each input in the batch
+        :param layer_name:
+        :param patch_extractor: function (batch index, ii, jj) -> input patch, required if patches are captured
+        :return:
+        '''
+
+        # skip inputs we've already seen, including repetitions inside the batch
+        rows = []
+        for row, layer_unique_input_source in enumerate(layer_unique_input_sources):
+            if layer_unique_input_source in self.seen_inputs:
+                continue
+            self.seen_inputs.add(layer_unique_input_source)
+            rows.append(row)
+
+        if len(rows) == 0:
             return
 
-        # add input identifier to seen inputs set
-        self.seen_inputs.add(layer_unique_input_source)
+        if len(rows) != data.shape[0]:
+            data = data[rows]
+        image_indices = np.asarray(image_indices)[rows]
+        layer_unique_input_sources = [layer_unique_input_sources[row] for row in rows]
 
-        n_channels = data.shape[0]
-        data_unroll = data.reshape((n_channels, -1))  # Note: no copy eg (96,3025). Does nothing if not is_spatial
+        n_inputs, n_channels = data.shape[0:2]
+        data_unroll = data.reshape((n_inputs, n_channels, -1))  # Note: no copy eg (10,96,3025)
 
-        max_indexes = data_unroll.argmax(1)  # maxes for each channel, eg. (96,)
+        max_indexes = data_unroll.argmax(2)  # maxes for each input and channel, eg. (10,96)
+        maxes = data_unroll[np.arange(n_inputs)[:, np.newaxis], np.arange(n_channels), max_indexes]
 
-        # add maxes for all channels to a list, bounded to avoid consuming too much memory
-        maxes = data_unroll[range(n_channels), max_indexes]
-        MAX_LIST_SIZE = 10000
-        if len(self.all_max_vals) < MAX_LIST_SIZE:
-            self.all_max_vals.append(maxes)
+        # add maxes for all channels to the statistics
+        self.channel_stats.update(maxes)
 
-        produced_warning = False
+        # nan values are skipped, warn once per input
+        for row in np.flatnonzero(np.isnan(maxes).any(1)):
+            print 'WARNING: got NAN activation on input', str(layer_unique_input_sources[row])
 
-        # insertion_idx = zeros((n_channels,))
-        # pdb.set_trace()
-        for ii in xrange(n_channels):
+        # location of each new candidate, eg. (10,96,4)
+        locs = [np.broadcast_to(image_indices[:, np.newaxis], maxes.shape),
+                np.broadcast_to(selected_input_index, maxes.shape)]
+        if self.is_spatial:
+            locs += list(np.unravel_index(max_indexes, data.shape[2:]))
+        locs = np.stack(locs, axis=2)
 
-            max_value = data_unroll[ii, max_indexes[ii]]
+        self.max_vals, self.max_locs, order = merge_top_values(self.max_vals, self.max_locs, maxes, locs,
+                                                               keep_largest=True)
+        if self.max_patches is not None:
+            update_top_patches(self.max_patches, order, locs, rows, self.is_spatial, patch_extractor)
 
-            # skip nan
-            if np.isnan(max_value):
-                # only warn once
-                if not produced_warning:
-                    print 'WARNING: got NAN activation on input', str(layer_unique_input_source)
-                    produced_warning = True
+        if self.search_min:
+            self.min_vals, self.min_locs, order = merge_top_values(self.min_vals, self.min_locs, maxes, locs,
+                                                                   keep_largest=False)
+            if self.min_patches is not None:
+                update_top_patches(self.min_patches, order, locs, rows, self.is_spatial, patch_extractor)
+
+    def save_patches(self, layer_name, outdir, settings, image_filenames):
+
+        for search_min, vals, locs, patches in [(False, self.max_vals, self.max_locs, self.max_patches),
+                                                (True, self.min_vals, self.min_locs, self.min_patches)]:
+            if patches is None:
                 continue
 
-            idx = np.searchsorted(self.max_vals[ii], max_value)
-            # if not smaller than all elements
-            if idx != 0:
-                # Store new value in the proper order. Update both arrays:
-                # self.max_vals:
-                self.max_vals[ii, :idx - 1] = self.max_vals[ii, 1:idx]  # shift lower values
-                self.max_vals[ii, idx - 1] = max_value  # store new max value
-                # self.max_locs
-                self.max_locs[ii, :idx - 1] = self.max_locs[ii, 1:idx]  # shift lower location data
-                # store new location
-                if self.is_spatial:
-                    self.max_locs[ii, idx - 1] = (image_idx, selected_input_index) + np.unravel_index(max_indexes[ii],
-                                                                                                      data.shape[1:])
-                else:
-                    self.max_locs[ii, idx - 1] = (image_idx, selected_input_index)
-
-            if self.search_min:
-                idx = np.searchsorted(self.min_vals[ii], max_value)
-                # if not bigger than all elements
-                if idx != self.n_top:
-                    # Store new value in the proper order. Update both arrays:
-                    # self.min_vals:
-                    self.min_vals[ii, (idx + 1):(self.n_top)] = self.min_vals[ii,
-                                                                idx:(self.n_top - 1)]  # shift upper values
-                    self.min_vals[ii, idx] = max_value  # store new value
-                    # self.min_locs
-                    self.min_locs[ii, (idx + 1):(self.n_top)] = self.min_locs[ii,
-                                                                idx:(self.n_top - 1)]  # shift upper location data
-                    # store new location
-                    if self.is_spatial:
-                        self.min_locs[ii, idx] = (image_idx, selected_input_index) + np.unravel_index(max_indexes[ii],
-                                                                                                      data.shape[1:])
-                    else:
-                        self.min_locs[ii, idx] = (image_idx, selected_input_index)
-
-    def calculate_histogram(self, layer_name, outdir):
-
-        # convert list of arrays to numpy array
-        all_max_array = np.vstack(self.all_max_vals)
-
-        def channel_to_histogram_values(channel_idx):
-            # get values
-            max_for_single_channel = all_max_array[:, channel_idx]
-
-            # create histogram
-            hist, bin_edges = np.histogram(max_for_single_channel, bins=50)
+            for channel_idx in xrange(vals.shape[0]):
+                unit_dir = os.path.join(outdir, layer_name, 'unit_%04d' % channel_idx)
+                mkdir_p(unit_dir)
+                info_filename, maxim_filenames = generate_output_names(unit_dir, self.n_top, True, True, False,
+                                                                       False, False, False, search_min)[:2]
+                save_unit_info(info_filename[0], self.is_spatial, vals, locs, channel_idx, self.n_top,
+                               image_filenames)
+
+                # same order as crop_max_patches.py, from highest (at end) to lowest
+                for max_idx_0 in range(self.n_top):
+                    max_idx = self.n_top - 1 - max_idx_0
+
+                    # no data for this "top" image
+                    if locs[channel_idx, max_idx, 0] < 0:
+                        continue
+
+                    save_caffe_image(patches[channel_idx, max_idx], maxim_filenames[max_idx_0],
+                                     autoscale=False, autoscale_center=0, channel_swap=settings.channel_swap)
+
+        self.max_patches = None
+        self.min_patches = None
+
+    def calculate_histogram(self, layer_name, outdir, renderer, force=False):
+        '''
+        Submits the histogram plots of the layer to renderer.
+        :return: (layer_dir, key, digest) to save once the plots are written, None if nothing was submitted
+        '''
+
+        if self.channel_stats is None:
+            print 'no statistics for layer %s, the tracker was saved by an older version' % layer_name
+            return None
+
+        n_channels = self.channel_stats.n_channels
+        layer_dir = os.path.join(outdir, layer_name)
+        layer_filename = os.path.join(layer_dir, 'layer_inactivity.png')
+        channel_filenames = [os.path.join(layer_dir, 'unit_%04d' % channel_idx, 'max_histogram.png')
+                             for channel_idx in xrange(n_channels)]
+
+        digest = stats_digest(self.channel_stats, 'histograms', renderer.backend)
+        if not force and layer_plots_are_current(layer_dir, 'histograms', digest,
+                                                 channel_filenames + [layer_filename]):
+            print 'skipped histograms of layer %s since its statistics did not change' % layer_name
+            return None
+
+        channel_histograms = []
+        for channel_idx in xrange(n_channels):
+
+            if channel_idx % 100 == 0:
+                print "calculating histogram for channel %d out of %d" % (channel_idx, n_channels)
+
+            mkdir_p(os.path.dirname(channel_filenames[channel_idx]))
+
+            # get histogram
+            hist, bin_edges = self.channel_stats.histogram(channel_idx)
 
             # save histogram values
             self.channel_to_histogram[channel_idx] = (hist, bin_edges)
 
-            return hist, bin_edges
+            channel_histograms.append((channel_idx, hist, bin_edges, channel_filenames[channel_idx]))
 
-        def process_channel_figure(channel_idx, fig):
-            unit_dir = os.path.join(outdir, layer_name, 'unit_%04d' % channel_idx)
-            mkdir_p(unit_dir)
-            filename = os.path.join(unit_dir, 'max_histogram.png')
-            fig.savefig(filename)
-            pass
+        render_max_histograms(renderer, layer_name, channel_histograms, layer_filename)
 
-        def process_layer_figure(fig):
-            filename = os.path.join(outdir, layer_name, 'layer_inactivity.png')
-            fig.savefig(filename)
-            pass
+        return layer_dir, 'histograms', digest
 
-        n_channels = all_max_array.shape[1]
-        prepare_max_histogram(layer_name, n_channels, channel_to_histogram_values, process_channel_figure,
-                              process_layer_figure)
+    def calculate_correlation(self, layer_name, outdir, renderer, force=False):
+        '''
+        Submits the correlation matrix plot of the layer to renderer.
+        :return: (layer_dir, key, digest) to save once the plot is written, None if nothing was submitted
+        '''
 
-        pass
+        if self.channel_stats is None or not self.channel_stats.track_correlation:
+            print 'no channel correlation for layer %s, see max_tracker_channel_correlation' % layer_name
+            return None
 
-    def calculate_correlation(self, layer_name, outdir):
+        # skip layers with only one channel
+        if self.channel_stats.n_channels == 1:
+            return None
 
-        # convert list of arrays to numpy array
-        all_max_array = np.vstack(self.all_max_vals)
+        layer_dir = os.path.join(outdir, layer_name)
+        filename = os.path.join(layer_dir, 'channels_correlation.png')
 
-        # skip layers with only one channel
-        if all_max_array.shape[1] == 1:
-            return
+        digest = stats_digest(self.channel_stats, 'correlation', renderer.backend)
+        if not force and layer_plots_are_current(layer_dir, 'correlation', digest, [filename]):
+            print 'skipped correlation of layer %s since its statistics did not change' % layer_name
+            return None
 
-        corr = np.corrcoef(all_max_array.transpose())
+        corr = self.channel_stats.correlation()
 
         # fix possible NANs
         corr = np.nan_to_num(corr)
         np.fill_diagonal(corr, 1)
 
         # sort correlation matrix
-        # import cPickle as pickle
-        #  with open('corr_%s.pickled' % layer_name, 'wb') as ff:
-        #     pickle.dump(corr, ff, protocol=2)
-
         # alternative sorting
         # values = np.dot(corr, np.arange(corr.shape[0]))
         # indexes = np.argsort(values)
@@ -380,93 +544,181 @@ class MaxTracker(object):
         indexes = np.lexsort(corr)
         sorted_corr = corr[indexes, :][:, indexes]
 
-        # plot correlation matrix
-        import matplotlib.pyplot as plt
-        fig = plt.figure(figsize=(10, 10))
-        plt.subplot(1, 1, 1)
-        plt.imshow(sorted_corr, interpolation='nearest', vmin=-1, vmax=1)
-        plt.colorbar()
-        plt.title('channels activations correlation matrix for layer %s' % (layer_name))
-        plt.tight_layout()
-
         # save correlation matrix
-        layer_dir = os.path.join(outdir, layer_name)
         mkdir_p(layer_dir)
-        filename = os.path.join(layer_dir, 'channels_correlation.png')
-        fig.savefig(filename, bbox_inches='tight')
-
-        plt.close()
+        renderer.submit(render_correlation_matrix, renderer.backend, filename, sorted_corr.astype(np.float32),
+                        'channels activations correlation matrix for layer %s' % (layer_name))
 
-        return
+        return layer_dir, 'correlation', digest
 
 
-def prepare_max_histogram(layer_name, n_channels, channel_to_histogram_values, process_channel_figure,
-                          process_layer_figure):
-    import matplotlib.pyplot as plt
-
-    fig = plt.figure(figsize=(10, 10))
-    ax = fig.add_subplot(111)
-
-    # for each channel
-    percent_dead = np.zeros((n_channels), dtype=np.float32)
-    for channel_idx in xrange(n_channels):
-
-        if channel_idx % 100 == 0:
-            print "calculating histogram for channel %d out of %d" % (channel_idx, n_channels)
-
-        hist, bin_edges = channel_to_histogram_values(channel_idx)
-
-        # generate histogram image file
-        width = 0.7 * (bin_edges[1] - bin_edges[0])
-        center = (bin_edges[:-1] + bin_edges[1:]) / 2
+def merge_top_values(top_vals, top_locs, new_vals, new_locs, keep_largest):
+    '''
+    Merges a batch of new candidates into sorted top arrays, for all channels at once.
+    Ties are resolved like sequential insertion does: for maxes the earlier input wins, for mins the later one.
+    :param top_vals: current tops sorted in ascending order, (C, n_top)
+    :param top_locs: locations of the current tops, (C, n_top, L)
+    :param new_vals: candidate values in input order, (batch, C). nan values are skipped
+    :param new_locs: locations of the candidates, (batch, C, L)
+    :param keep_largest: True to keep the maxes, False to keep the mins
+    :return: merged (top_vals, top_locs, order). order holds the indices of the kept tops among the candidates of
+    each channel, the new values newest first followed by the current tops, see update_top_patches()
+    '''
+    n_channels, n_top = top_vals.shape
 
-        barlist = ax.bar(center, hist, align='center', width=width, color='g')
+    # newest candidate first, so that a stable sort ranks newer values below older equal values
+    candidate_vals = np.concatenate((new_vals.T[:, ::-1].astype(top_vals.dtype), top_vals), axis=1)
+    candidate_locs = np.concatenate((new_locs.transpose((1, 0, 2))[:, ::-1], top_locs), axis=1)
 
-        for i in range(len(hist)):
-            if 0 >= bin_edges[i] and 0 < bin_edges[i + 1]:
-                # mark dead bar in red
-                barlist[i].set_color('r')
+    if keep_largest:
+        # nan must never win. As -inf it ends up below everything already stored
+        candidate_vals[np.isnan(candidate_vals)] = -np.inf
+        order = np.argsort(candidate_vals, axis=1, kind='mergesort')[:, -n_top:]
+    else:
+        # nan is sorted to the end, after everything already stored
+        order = np.argsort(candidate_vals, axis=1, kind='mergesort')[:, :n_top]
 
-                # save percent dead
-                percent_dead[channel_idx] = 100.0 * hist[i] / sum(hist)
+    channels = np.arange(n_channels)[:, np.newaxis]
+    return candidate_vals[channels, order], candidate_locs[channels, order].astype(top_locs.dtype), order
 
-                break
 
-        fig.suptitle('max activations histgoram of layer %s channel %d' % (layer_name, channel_idx))
-        ax.xaxis.label.set_text('max activation value')
-        ax.yaxis.label.set_text('inputs count')
+def update_top_patches(top_patches, order, new_locs, rows, is_spatial, patch_extractor):
+    '''
+    Updates the patches of the tops in place after merge_top_values().
+    Patches that were displaced are dropped, only patches of new tops are extracted.
+    :param top_patches: patches of the tops before the merge, (C, n_top, 3, H, W)
+    :param order: candidate indices kept by merge_top_values()
+    :param new_locs: locations of the candidates, (batch, C, L)
+    :param rows: index in the net batch of each candidate input
+    :param is_spatial:
+    :param patch_extractor: function (batch index, ii, jj) -> input patch
+    :return:
+    '''
+    n_inputs = new_locs.shape[0]
+    n_top = top_patches.shape[1]
 
-        process_channel_figure(channel_idx, fig)
+    # only channels whose tops changed need any work
+    for channel_idx in np.flatnonzero((order != np.arange(n_inputs, n_inputs + n_top)).any(1)):
+        kept = order[channel_idx]
+        is_old = kept >= n_inputs
+        top_patches[channel_idx, is_old] = top_patches[channel_idx, kept[is_old] - n_inputs]
 
-        ax.cla()
+        for top_idx in np.flatnonzero(~is_old):
+            # candidates are ordered newest first
+            input_idx = n_inputs - 1 - kept[top_idx]
+            ii, jj = new_locs[input_idx, channel_idx, 2:4] if is_spatial else (0, 0)
+            top_patches[channel_idx, top_idx] = patch_extractor(rows[input_idx], ii, jj)
 
-    # generate histogram for layer
-    num_bins = 20
-    hist, bin_edges = np.histogram(100 - percent_dead, bins=num_bins, range=(0, 100))
-    width = 0.7 * (bin_edges[1] - bin_edges[0])
-    center = (bin_edges[:-1] + bin_edges[1:]) / 2
 
-    bar_colors = [None] * num_bins
-    begin_color = np.array([1.0, 0, 0])
-    end_color = np.array([0, 1.0, 0])
-    color_step = (end_color - begin_color) / (num_bins - 1)
-    current_color = begin_color
-    for i in range(num_bins):
-        bar_colors[i] = tuple(current_color)
-        current_color += color_step
+def merge_top_records(top_vals_list, top_locs_list, keep_largest):
+    '''
+    Merges the tops of several trackers that saw disjoint inputs, for all channels at once.
+    The image_idx in the locations must refer to the same file list. Ties are resolved by image_idx the way a
+    single scan over that list would, so the result does not depend on the order of the inputs.
+    :param top_vals_list: list of sorted tops, each (C, n_top)
+    :param top_locs_list: list of the locations of the tops, each (C, n_top, L)
+    :param keep_largest: True to keep the maxes, False to keep the mins
+    :return: merged (top_vals, top_locs)
+    '''
+    n_channels, n_top = top_vals_list[0].shape
 
-    ax.bar(center, hist, align='center', width=width, color=bar_colors)
+    candidate_vals = np.concatenate(top_vals_list, axis=1)
+    candidate_locs = np.concatenate(top_locs_list, axis=1)
+    image_indices = candidate_locs[:, :, 0]
+    is_valid = image_indices >= 0
 
-    fig.suptitle('activity of layer %s' % (layer_name))
-    ax.xaxis.label.set_text('activity percent')
-    ax.yaxis.label.set_text('channels count')
+    if keep_largest:
+        # ascending rank: lower value, then empty entries, then later images
+        order = np.lexsort((-image_indices, is_valid, candidate_vals), axis=1)[:, -n_top:]
+    else:
+        # ascending rank: lower value, then later images, then empty entries
+        order = np.lexsort((-image_indices, ~is_valid, candidate_vals), axis=1)[:, :n_top]
 
-    process_layer_figure(fig)
+    channels = np.arange(n_channels)[:, np.newaxis]
+    return candidate_vals[channels, order], candidate_locs[channels, order]
 
-    fig.clf()
-    plt.close(fig)
 
-    pass
+def merge_net_max_trackers(net_max_trackers, image_filenames=None):
+    '''
+    Merges NetMaxTrackers that scanned disjoint sets of files into a single tracker.
+    Merging is associative and does not depend on the order of the trackers.
+    :param net_max_trackers: list of NetMaxTracker, all tracking the same layers with the same n_top
+    :param image_filenames: file list of the merged tracker, must contain all files of the trackers.
+                            Default: the sorted union of their file lists. Pass the file list of an unsharded
+                            scan to get its image indices, see merge_max_trackers.py
+    :return: merged NetMaxTracker
+    '''
+    first = net_max_trackers[0]
+    for net_max_tracker in net_max_trackers:
+        assert net_max_tracker.image_filenames is not None, 'Tracker has no file list, it was saved by an older version'
+        assert sorted(net_max_tracker.layers) == sorted(first.layers), 'Trackers must track the same layers'
+        assert net_max_tracker.n_top == first.n_top, 'Trackers must have the same n_top'
+        assert net_max_tracker.search_min == first.search_min, 'Trackers must have the same search_min'
+
+    # global file list, image_idx of the merged tracker is the index in this list
+    all_filenames = [filename for net_max_tracker in net_max_trackers for filename in net_max_tracker.image_filenames]
+    assert len(set(all_filenames)) == len(all_filenames), 'Trackers must have scanned disjoint sets of files'
+    if image_filenames is None:
+        image_filenames = sorted(all_filenames)
+    filename_to_global_idx = dict((filename, idx) for idx, filename in enumerate(image_filenames))
+
+    merged = NetMaxTracker(None, layers=first.layers, n_top=first.n_top, initial_val=first.initial_val,
+                           search_min=first.search_min, image_filenames=image_filenames,
+                           channel_correlation=getattr(first, 'channel_correlation', True))
+    merged.max_trackers = {}
+
+    # maps the image_idx of each tracker to the global one
+    global_indices = [np.array([filename_to_global_idx[filename] for filename in net_max_tracker.image_filenames],
+                               dtype='int')
+                      for net_max_tracker in net_max_trackers]
+
+    for layer_name in first.layers:
+
+        max_trackers = [net_max_tracker.max_trackers[layer_name] for net_max_tracker in net_max_trackers]
+
+        n_channels = max_trackers[0].max_vals.shape[0]
+        merged_tracker = MaxTracker(max_trackers[0].is_spatial, n_channels, n_top=first.n_top,
+                                    initial_val=first.initial_val, dtype=max_trackers[0].max_vals.dtype,
+                                    search_min=first.search_min)
+
+        merged_tracker.max_vals, merged_tracker.max_locs = merge_top_records(
+            [max_tracker.max_vals for max_tracker in max_trackers],
+            [remap_image_indices(max_tracker.max_locs, indices)
+             for max_tracker, indices in zip(max_trackers, global_indices)],
+            keep_largest=True)
+
+        if first.search_min:
+            merged_tracker.min_vals, merged_tracker.min_locs = merge_top_records(
+                [max_tracker.min_vals for max_tracker in max_trackers],
+                [remap_image_indices(max_tracker.min_locs, indices)
+                 for max_tracker, indices in zip(max_trackers, global_indices)],
+                keep_largest=False)
+
+        for max_tracker in max_trackers:
+            if max_tracker.seen_inputs:
+                merged_tracker.seen_inputs.update(max_tracker.seen_inputs)
+
+        # statistics are only complete if every tracker has them
+        merged_tracker.channel_stats = None
+        if all(max_tracker.channel_stats is not None for max_tracker in max_trackers):
+            merged_tracker.channel_stats = ChannelStats(n_channels, max_trackers[0].channel_stats.n_bins,
+                                                        max_trackers[0].channel_stats.track_correlation)
+            for max_tracker in max_trackers:
+                merged_tracker.channel_stats.merge(max_tracker.channel_stats)
+
+        merged.max_trackers[layer_name] = merged_tracker
+
+    merged.init_done = True
+    return merged
+
+
+def remap_image_indices(locs, global_indices):
+    '''Returns a copy of the locations with image_idx mapped through global_indices. Empty entries stay -1.'''
+    locs = locs.copy()
+    image_indices = locs[:, :, 0]
+    is_valid = image_indices >= 0
+    image_indices[is_valid] = global_indices[image_indices[is_valid]]
+    return locs
 
 
 def generate_output_names(unit_dir, num_top, do_info, do_maxes, do_deconv, do_deconv_norm, do_backprop,
@@ -505,323 +757,337 @@ def generate_output_names(unit_dir, num_top, do_info, do_maxes, do_deconv, do_de
         backpropnorm_filenames)
 
 
-class InfoFileMetadata(object):
+def save_unit_info(info_filename, is_spatial, vals, locs, channel_idx, num_top, image_filenames):
+    '''Writes the info file of one unit, its top records from highest to lowest.'''
 
-    def __init__(self, info_file=None, ref_count=None):
-        self.info_file = info_file
-        self.ref_count = ref_count
+    num_top_in_mt = locs.shape[1]
+    with open(info_filename, 'w') as info_file:
+        print >> info_file, '# is_spatial val image_idx selected_input_index i(if is_spatial) j(if is_spatial) filename'
+
+        for max_idx_0 in range(num_top):
+            max_idx = num_top_in_mt - 1 - max_idx_0
+
+            # no data for this "top" image
+            if locs[channel_idx, max_idx, 0] < 0:
+                continue
+
+            print >> info_file, 1 if is_spatial else 0, '%.6f' % vals[channel_idx, max_idx],
+            if is_spatial:
+                print >> info_file, '%d %d %d %d' % tuple(locs[channel_idx, max_idx]),
+            else:
+                print >> info_file, '%d %d' % tuple(locs[channel_idx, max_idx]),
+            print >> info_file, image_filenames[locs[channel_idx, max_idx, 0]]
+
+
+class MaxPatchesJob(object):
+    '''The units idx_begin:idx_end of one layer that output_max_patches() should work on.'''
+
+    def __init__(self, layer_name=None, max_tracker=None, idx_begin=None, idx_end=None, search_min=False):
+        self.layer_name = layer_name
+        self.max_tracker = max_tracker
+        self.idx_begin = idx_begin
+        self.idx_end = idx_end
+        self.search_min = search_min
+
+
+def plan_max_patches(settings, net, jobs, num_top, outdir, do_which, image_filenames):
+    '''
+    Collects the top records of all jobs and groups them by image. Writes the info files on the way.
+    Units whose outputs all exist already are skipped.
+    :return: dict image_idx -> list of MaxTrackerCropBatchRecord
+    '''
+    do_maxes, do_deconv, do_deconv_norm, do_backprop, do_backprop_norm, do_info = do_which
+
+    receptive_field_table = get_receptive_field_table(net, settings)
+
+    image_to_records = dict()
+
+    for job in jobs:
+
+        mt = job.max_tracker
+        layer_name = job.layer_name
+
+        locs = mt.min_locs if job.search_min else mt.max_locs
+        vals = mt.min_vals if job.search_min else mt.max_vals
+
+        num_top_in_mt = locs.shape[1]
+        assert num_top <= num_top_in_mt, 'Requested %d top images but MaxTracker contains only %d' % (
+            num_top, num_top_in_mt)
+        assert job.idx_end >= job.idx_begin, 'Range error'
+
+        # minor fix for backwards compatability
+        if hasattr(mt, 'is_conv'):
+            mt.is_spatial = mt.is_conv
+
+        # fix for backward compatability
+        if (mt.is_spatial and locs.shape[2] == 5) or (not mt.is_spatial and locs.shape[2] == 3):
+            # remove second column
+            locs = np.delete(locs, 1, 2)
+
+        size_ii, size_jj = get_max_data_extent(net, settings, layer_name, mt.is_spatial)
+        top_name = layer_name_to_top_name(net, layer_name)
+
+        for channel_idx in range(job.idx_begin, job.idx_end):
+
+            unit_dir = os.path.join(outdir, layer_name, 'unit_%04d' % channel_idx)
+            mkdir_p(unit_dir)
+
+            # check if all required outputs exist, in which case skip this iteration
+            [info_filename,
+             maxim_filenames,
+             deconv_filenames,
+             deconvnorm_filenames,
+             backprop_filenames,
+             backpropnorm_filenames] = generate_output_names(unit_dir, num_top, do_info, do_maxes, do_deconv,
+                                                             do_deconv_norm, do_backprop, do_backprop_norm,
+                                                             job.search_min)
+
+            relevant_outputs = info_filename + \
+                               maxim_filenames + \
+                               deconv_filenames + \
+                               deconvnorm_filenames + \
+                               backprop_filenames + \
+                               backpropnorm_filenames
+
+            relevant_outputs_exist = [os.path.exists(file_name) for file_name in relevant_outputs]
+            if all(relevant_outputs_exist):
+                print "skipped generation of channel %d in layer %s since files already exist" % (channel_idx, layer_name)
+                continue
+
+            if do_info:
+                save_unit_info(info_filename[0], mt.is_spatial, vals, locs, channel_idx, num_top, image_filenames)
+
+            # e.g. patches captured by find_max_act.py, only the images of the other outputs are needed
+            unit_do_maxes = do_maxes and not all(os.path.exists(file_name) for file_name in maxim_filenames)
+            if not unit_do_maxes:
+                maxim_filenames = []
+
+            # iterate through maxes from highest (at end) to lowest
+            for max_idx_0 in range(num_top):
+                record = MaxTrackerCropBatchRecord(channel_idx=channel_idx, info_filename=info_filename,
+                                                   maxim_filenames=maxim_filenames,
+                                                   deconv_filenames=deconv_filenames,
+                                                   deconvnorm_filenames=deconvnorm_filenames,
+                                                   backprop_filenames=backprop_filenames,
+                                                   backpropnorm_filenames=backpropnorm_filenames,
+                                                   max_idx_0=max_idx_0, max_idx=num_top_in_mt - 1 - max_idx_0,
+                                                   denormalized_layer_name=layer_name,
+                                                   denormalized_top_name=top_name,
+                                                   layer_format='normal')  # non-siamese
+
+                if mt.is_spatial:
+                    record.im_idx, record.selected_input_index, record.ii, record.jj = locs[
+                        record.channel_idx, record.max_idx]
+                else:
+                    record.im_idx, record.selected_input_index = locs[record.channel_idx, record.max_idx]
+                    record.ii, record.jj = 0, 0
+
+                # if the image is invalid then there is no data for this "top" image, so we can skip it
+                if record.im_idx < 0:
+                    continue
+
+                record.recorded_val = vals[record.channel_idx, record.max_idx]
+                record.filename = image_filenames[record.im_idx]
+                record.size_ii, record.size_jj = size_ii, size_jj
+
+                [record.out_ii_start,
+                 record.out_ii_end,
+                 record.out_jj_start,
+                 record.out_jj_end,
+                 record.data_ii_start,
+                 record.data_ii_end,
+                 record.data_jj_start,
+                 record.data_jj_end] = \
+                    receptive_field_table.focus_area(layer_name, mt.is_spatial, record.ii, record.jj)
+
+                if not (unit_do_maxes or do_deconv or do_deconv_norm or do_backprop or do_backprop_norm):
+                    continue
+
+                image_to_records.setdefault(record.im_idx, []).append(record)
+
+    return image_to_records
 
 
-def output_max_patches(settings, max_tracker, net, layer_name, idx_begin, idx_end, num_top, datadir, outdir,
-                       search_min, do_which):
+def get_tracker_files_list(net_max_tracker, datadir):
     '''
+    File list the image_idx of the tracker refer to. Trackers of older versions don't keep it, their indices refer
+    to the flat listing of datadir at the time of the scan, see get_legacy_files_list().
+    '''
+    image_filenames = getattr(net_max_tracker, 'image_filenames', None)
+    if image_filenames is None:
+        print 'WARNING: the tracker has no file list, using the images directly in %s. If files were added or ' \
+              'removed since the scan, the patches are of the wrong images: rescan with find_max_act.py' % (datadir,)
+        image_filenames = get_legacy_files_list(datadir)
+    return image_filenames
+
 
+def output_max_patches(settings, net, jobs, num_top, datadir, outdir, do_which, image_filenames=None):
+    '''
+    Outputs the patches of the top images of the units in jobs.
+    The work is planned per image: every top image is loaded and forwarded only once, no matter how many
+    units, layers or tops (max or min) it belongs to.
     :param settings:
-    :param max_tracker:
     :param net:
-    :param layer_name:
-    :param idx_begin:
-    :param idx_end:
+    :param jobs: list of MaxPatchesJob
     :param num_top:
     :param datadir:
     :param outdir:
-    :param search_min:
     :param do_which: do_info must be True
+    :param image_filenames: file list the image_idx of the tracker refer to, see get_tracker_files_list()
     :return:
     '''
     do_maxes, do_deconv, do_deconv_norm, do_backprop, do_backprop_norm, do_info = do_which
     assert do_maxes or do_deconv or do_deconv_norm or do_backprop or do_backprop_norm or do_info, 'nothing to do'
 
-    sys.path.insert(0, os.path.join(settings.caffevis_caffe_root, 'python'))
-    import caffe
+    if image_filenames is None:
+        image_filenames = get_legacy_files_list(datadir)
 
-    mt = max_tracker
+    print 'Loaded filenames and labels for %d files' % len(image_filenames)
+    print '  First file', get_image_path(datadir, image_filenames[0])
 
-    locs = mt.min_locs if search_min else mt.max_locs
-    vals = mt.min_vals if search_min else mt.max_vals
+    image_to_records = plan_max_patches(settings, net, jobs, num_top, outdir, do_which, image_filenames)
 
-    image_filenames, image_labels = get_files_list(datadir)
+    # sorted, to read the dataset in order
+    image_indices = sorted(image_to_records.keys())
+    n_records = sum(len(records) for records in image_to_records.values())
+    print 'Outputting %d patches from %d distinct images' % (n_records, len(image_indices))
 
-    print 'Loaded filenames and labels for %d files' % len(image_filenames)
-    print '  First file', os.path.join(datadir, image_filenames[0])
+    net_input_dims = net.blobs['data'].data.shape[2:4]
 
-    num_top_in_mt = locs.shape[1]
-    assert num_top <= num_top_in_mt, 'Requested %d top images but MaxTracker contains only %d' % (
-        num_top, num_top_in_mt)
-    assert idx_end >= idx_begin, 'Range error'
+    # no need to run the layers above the ones of the jobs
+    end_layer = get_forward_end_layer(net, settings, [job.layer_name for job in jobs])
 
-    # minor fix for backwards compatability
-    if hasattr(mt, 'is_conv'):
-        mt.is_spatial = mt.is_conv
+    loader = ImageBatchLoader(settings.caffevis_caffe_root, net_input_dims,
+                              num_workers=settings.max_tracker_decode_workers,
+                              queue_depth=settings.max_tracker_prefetch_batches,
+                              fast_decode=settings.max_tracker_fast_decode)
 
-    size_ii, size_jj = get_max_data_extent(net, settings, layer_name, mt.is_spatial)
-    data_size_ii, data_size_jj = net.blobs['data'].data.shape[2:4]
+    progress = ProgressReporter('images', len(image_indices), interval=settings.max_tracker_progress_seconds)
+    # bad inputs are skipped, so the progress is taken from the position of the last image
+    image_positions = dict((image_idx, position) for position, image_idx in enumerate(image_indices))
 
-    net_input_dims = net.blobs['data'].data.shape[2:4]
+    with loader:
+        loaded_batches = loader.iter_batches(datadir, image_filenames, settings.max_tracker_batch_size,
+                                             image_indices=image_indices)
+        for loaded_batch in profiler.iter_timed('load', loaded_batches):
 
-    # prepare variables used for batches
-    batch = [None] * settings.max_tracker_batch_size
-    for i in range(0, settings.max_tracker_batch_size):
-        batch[i] = MaxTrackerCropBatchRecord()
-
-    batch_index = 0
-
-    channel_to_info_file = dict()
-
-    n_total_images = (idx_end - idx_begin) * num_top
-    for cc, channel_idx in enumerate(range(idx_begin, idx_end)):
-
-        unit_dir = os.path.join(outdir, layer_name, 'unit_%04d' % channel_idx)
-        mkdir_p(unit_dir)
-
-        # check if all required outputs exist, in which case skip this iteration
-        [info_filename,
-         maxim_filenames,
-         deconv_filenames,
-         deconvnorm_filenames,
-         backprop_filenames,
-         backpropnorm_filenames] = generate_output_names(unit_dir, num_top, do_info, do_maxes, do_deconv,
-                                                         do_deconv_norm, do_backprop, do_backprop_norm, search_min)
-
-        relevant_outputs = info_filename + \
-                           maxim_filenames + \
-                           deconv_filenames + \
-                           deconvnorm_filenames + \
-                           backprop_filenames + \
-                           backpropnorm_filenames
-
-        # we skip generation if:
-        # 1. all outputs exist, AND
-        # 2.1.   (not last iteration OR
-        # 2.2.    last iteration, but batch is empty)
-        relevant_outputs_exist = [os.path.exists(file_name) for file_name in relevant_outputs]
-        if all(relevant_outputs_exist) and \
-                ((channel_idx != idx_end - 1) or ((channel_idx == idx_end - 1) and (batch_index == 0))):
-            print "skipped generation of channel %d in layer %s since files already exist" % (channel_idx, layer_name)
-            continue
-
-        if do_info:
-            channel_to_info_file[channel_idx] = InfoFileMetadata()
-            channel_to_info_file[channel_idx].info_file = open(info_filename[0], 'w')
-            channel_to_info_file[channel_idx].ref_count = num_top
-
-            print >> channel_to_info_file[
-                channel_idx].info_file, '# is_spatial val image_idx selected_input_index i(if is_spatial) j(if is_spatial) filename'
-
-        # iterate through maxes from highest (at end) to lowest
-        for max_idx_0 in range(num_top):
-            batch[batch_index].cc = cc
-            batch[batch_index].channel_idx = channel_idx
-            batch[batch_index].info_filename = info_filename
-            batch[batch_index].maxim_filenames = maxim_filenames
-            batch[batch_index].deconv_filenames = deconv_filenames
-            batch[batch_index].deconvnorm_filenames = deconvnorm_filenames
-            batch[batch_index].backprop_filenames = backprop_filenames
-            batch[batch_index].backpropnorm_filenames = backpropnorm_filenames
-            batch[batch_index].info_file = channel_to_info_file[channel_idx].info_file
-
-            batch[batch_index].max_idx_0 = max_idx_0
-            batch[batch_index].max_idx = num_top_in_mt - 1 - batch[batch_index].max_idx_0
-
-            if mt.is_spatial:
-
-                # fix for backward compatability
-                if locs.shape[2] == 5:
-                    # remove second column
-                    locs = np.delete(locs, 1, 2)
-
-                batch[batch_index].im_idx, batch[batch_index].selected_input_index, batch[batch_index].ii, batch[
-                    batch_index].jj = locs[batch[batch_index].channel_idx, batch[batch_index].max_idx]
-            else:
-                # fix for backward compatability
-                if locs.shape[2] == 3:
-                    # remove second column
-                    locs = np.delete(locs, 1, 2)
+            with profiler.timer('predict'):
+                im_batch = [im for image_idx, filename, im in loaded_batch]
+                predict_to_layer(net, im_batch, end_layer)
 
-                batch[batch_index].im_idx, batch[batch_index].selected_input_index = locs[
-                    batch[batch_index].channel_idx, batch[batch_index].max_idx]
-                batch[batch_index].ii, batch[batch_index].jj = 0, 0
+            records_per_row = [image_to_records[image_idx] for image_idx, filename, im in loaded_batch]
 
-            # if ii and jj are invalid then there is no data for this "top" image, so we can skip it
-            if (batch[batch_index].ii, batch[batch_index].jj) == (-1, -1):
-                continue
+            for i, records in enumerate(records_per_row):
+                for record in records:
+                    output_record_maxim(settings, net, i, record, do_maxes)
 
-            batch[batch_index].recorded_val = vals[batch[batch_index].channel_idx, batch[batch_index].max_idx]
-            batch[batch_index].filename = image_filenames[batch[batch_index].im_idx]
-            do_print = (batch[batch_index].max_idx_0 == 0)
-            if do_print:
-                print '%s   Output file/image(s) %d/%d   layer %s channel %d' % (
-                    datetime.now().ctime(), batch[batch_index].cc * num_top, n_total_images, layer_name,
-                    batch[batch_index].channel_idx)
-
-            # print "DEBUG: (mt.is_spatial, batch[batch_index].ii, batch[batch_index].jj, layer_name, size_ii, size_jj, data_size_ii, data_size_jj)", str((mt.is_spatial, batch[batch_index].ii, batch[batch_index].jj, rc, layer_name, size_ii, size_jj, data_size_ii, data_size_jj))
-
-            [batch[batch_index].out_ii_start,
-             batch[batch_index].out_ii_end,
-             batch[batch_index].out_jj_start,
-             batch[batch_index].out_jj_end,
-             batch[batch_index].data_ii_start,
-             batch[batch_index].data_ii_end,
-             batch[batch_index].data_jj_start,
-             batch[batch_index].data_jj_end] = \
-                compute_data_layer_focus_area(mt.is_spatial, batch[batch_index].ii, batch[batch_index].jj, settings,
-                                              layer_name,
-                                              size_ii, size_jj, data_size_ii, data_size_jj)
-
-            # print "DEBUG: channel:%d out_ii_start:%d out_ii_end:%d out_jj_start:%d out_jj_end:%d data_ii_start:%d data_ii_end:%d data_jj_start:%d data_jj_end:%d" % \
-            #       (channel_idx,
-            #        batch[batch_index].out_ii_start, batch[batch_index].out_ii_end,
-            #        batch[batch_index].out_jj_start, batch[batch_index].out_jj_end,
-            #        batch[batch_index].data_ii_start, batch[batch_index].data_ii_end,
-            #        batch[batch_index].data_jj_start, batch[batch_index].data_jj_end)
+            if do_deconv or do_deconv_norm:
+                output_gradient_patches(settings, net, records_per_row, 'deconv', do_deconv, do_deconv_norm)
 
-            if do_info:
-                print >> batch[batch_index].info_file, 1 if mt.is_spatial else 0, '%.6f' % vals[
-                    batch[batch_index].channel_idx, batch[batch_index].max_idx],
-                if mt.is_spatial:
-                    print >> batch[batch_index].info_file, '%d %d %d %d' % tuple(
-                        locs[batch[batch_index].channel_idx, batch[batch_index].max_idx]),
-                else:
-                    print >> batch[batch_index].info_file, '%d %d' % tuple(
-                        locs[batch[batch_index].channel_idx, batch[batch_index].max_idx]),
-                print >> batch[batch_index].info_file, batch[batch_index].filename
+            if do_backprop or do_backprop_norm:
+                output_gradient_patches(settings, net, records_per_row, 'backprop', do_backprop, do_backprop_norm)
 
-            if not (do_maxes or do_deconv or do_deconv_norm or do_backprop or do_backprop_norm):
-                continue
+            progress.update(image_positions[loaded_batch[-1][0]] + 1 - progress.n_done)
 
-            with WithTimer('Load image', quiet=not do_print):
-                # load image
-                batch[batch_index].im = caffe.io.load_image(os.path.join(datadir, batch[batch_index].filename),
-                                                            color=True)
 
-                # resize images according to input dimension
-                batch[batch_index].im = resize_without_fit(batch[batch_index].im, net_input_dims)
+def output_record_maxim(settings, net, i, record, do_maxes):
+    '''Checks the reproduced value of one top record and outputs its image patch, from row i of the current net batch.'''
 
-                # convert to float to avoid caffe destroying the image in the scaling phase
-                batch[batch_index].im = batch[batch_index].im.astype(np.float32)
+    if len(net.blobs[record.denormalized_top_name].data.shape) == 4:
+        reproduced_val = net.blobs[record.denormalized_top_name].data[i, record.channel_idx, record.ii, record.jj]
 
-            batch_index += 1
+    else:
+        reproduced_val = net.blobs[record.denormalized_top_name].data[i, record.channel_idx]
 
-            # if current batch is full
-            if batch_index == settings.max_tracker_batch_size \
-                    or ((channel_idx == idx_end - 1) and (max_idx_0 == num_top - 1)):  # or last iteration
+    if abs(reproduced_val - record.recorded_val) > .1:
+        print 'Warning: recorded value %s is suspiciously different from reproduced value %s. Is the filelist the same?' % (
+            record.recorded_val, reproduced_val)
 
-                with WithTimer('Predict on batch  ', quiet=not do_print):
-                    im_batch = [record.im for record in batch]
-                    net.predict(im_batch, oversample=False)
-
-                # go over batch and update statistics
-                for i in range(0, batch_index):
-
-                    batch[i].denormalized_layer_name = layer_name
-                    batch[i].denormalized_top_name = layer_name_to_top_name(net, batch[i].denormalized_layer_name)
-                    batch[i].layer_format = 'normal'  # non-siamese
-
-                    if len(net.blobs[batch[i].denormalized_top_name].data.shape) == 4:
-                        reproduced_val = net.blobs[batch[i].denormalized_top_name].data[
-                                i, batch[i].channel_idx, batch[i].ii, batch[i].jj]
-
-                    else:
-                        reproduced_val = net.blobs[batch[i].denormalized_top_name].data[i, batch[i].channel_idx]
-
-                    if abs(reproduced_val - batch[i].recorded_val) > .1:
-                        print 'Warning: recorded value %s is suspiciously different from reproduced value %s. Is the filelist the same?' % (
-                            batch[i].recorded_val, reproduced_val)
-
-                    if do_maxes:
-                        # grab image from data layer, not from im (to ensure preprocessing / center crop details match between image and deconv/backprop)
-
-                        out_arr = extract_patch_from_image(net.blobs['data'].data[i], net,
-                                                           batch[i].selected_input_index, settings,
-                                                           batch[i].data_ii_end, batch[i].data_ii_start,
-                                                           batch[i].data_jj_end, batch[i].data_jj_start,
-                                                           batch[i].out_ii_end, batch[i].out_ii_start,
-                                                           batch[i].out_jj_end, batch[i].out_jj_start, size_ii, size_jj)
-
-                        with WithTimer('Save img  ', quiet=not do_print):
-                            save_caffe_image(out_arr, batch[i].maxim_filenames[batch[i].max_idx_0],
-                                             autoscale=False, autoscale_center=0,
-                                             channel_swap=settings.channel_swap)
-
-                if do_deconv or do_deconv_norm:
-
-                    # TODO: we can improve performance by doing batch of deconv_from_layer, but only if we group
-                    # together instances which have the same selected_input_index, this can be done by holding two
-                    # separate batches
-
-                    for i in range(0, batch_index):
-                        diffs = net.blobs[batch[i].denormalized_top_name].diff * 0
-
-                        if len(diffs.shape) == 4:
-                                diffs[i, batch[i].channel_idx, batch[i].ii, batch[i].jj] = 1.0
-                        else:
-                            diffs[i, batch[i].channel_idx] = 1.0
-
-                        with WithTimer('Deconv    ', quiet=not do_print):
-                            net.deconv_from_layer(batch[i].denormalized_layer_name, diffs, zero_higher=True,
-                                                  deconv_type='Guided Backprop')
-
-                        out_arr = extract_patch_from_image(net.blobs['data'].diff[i], net,
-                                                           batch[i].selected_input_index, settings,
-                                                           batch[i].data_ii_end, batch[i].data_ii_start,
-                                                           batch[i].data_jj_end, batch[i].data_jj_start,
-                                                           batch[i].out_ii_end, batch[i].out_ii_start,
-                                                           batch[i].out_jj_end, batch[i].out_jj_start, size_ii, size_jj)
-
-                        if out_arr.max() == 0:
-                            print 'Warning: Deconv out_arr in range', out_arr.min(), 'to', out_arr.max(), 'ensure force_backward: true in prototxt'
-
-                        if do_deconv:
-                            with WithTimer('Save img  ', quiet=not do_print):
-                                save_caffe_image(out_arr, batch[i].deconv_filenames[batch[i].max_idx_0],
-                                                 autoscale=False, autoscale_center=0,
-                                                 channel_swap=settings.channel_swap)
-                        if do_deconv_norm:
-                            out_arr = np.linalg.norm(out_arr, axis=0)
-                            with WithTimer('Save img  ', quiet=not do_print):
-                                save_caffe_image(out_arr, batch[i].deconvnorm_filenames[batch[i].max_idx_0],
-                                                 channel_swap=settings.channel_swap)
-
-                if do_backprop or do_backprop_norm:
-
-                    for i in range(0, batch_index):
-                        diffs = net.blobs[batch[i].denormalized_top_name].diff * 0
-
-                        if len(diffs.shape) == 4:
-                            diffs[i, batch[i].channel_idx, batch[i].ii, batch[i].jj] = 1.0
-                        else:
-                            diffs[i, batch[i].channel_idx] = 1.0
-
-                    with WithTimer('Backward batch  ', quiet=not do_print):
-                        net.backward_from_layer(batch[i].denormalized_layer_name, diffs)
-
-                    for i in range(0, batch_index):
-
-                        out_arr = extract_patch_from_image(net.blobs['data'].diff[i], net,
-                                                           batch[i].selected_input_index, settings,
-                                                           batch[i].data_ii_end, batch[i].data_ii_start,
-                                                           batch[i].data_jj_end, batch[i].data_jj_start,
-                                                           batch[i].out_ii_end, batch[i].out_ii_start,
-                                                           batch[i].out_jj_end, batch[i].out_jj_start, size_ii, size_jj)
-
-                        if out_arr.max() == 0:
-                            print 'Warning: Deconv out_arr in range', out_arr.min(), 'to', out_arr.max(), 'ensure force_backward: true in prototxt'
-                        if do_backprop:
-                            with WithTimer('Save img  ', quiet=not do_print):
-                                save_caffe_image(out_arr, batch[i].backprop_filenames[batch[i].max_idx_0],
-                                                 autoscale=False, autoscale_center=0,
-                                                 channel_swap=settings.channel_swap)
-                        if do_backprop_norm:
-                            out_arr = np.linalg.norm(out_arr, axis=0)
-                            with WithTimer('Save img  ', quiet=not do_print):
-                                save_caffe_image(out_arr, batch[i].backpropnorm_filenames[batch[i].max_idx_0],
-                                                 channel_swap=settings.channel_swap)
-
-                # close info files
-                for i in range(0, batch_index):
-                    channel_to_info_file[batch[i].channel_idx].ref_count -= 1
-                    if channel_to_info_file[batch[i].channel_idx].ref_count == 0:
-                        if do_info:
-                            channel_to_info_file[batch[i].channel_idx].info_file.close()
-
-                batch_index = 0
+    # the units whose patches exist have no maxim file names, see plan_max_patches()
+    if do_maxes and record.maxim_filenames:
+        # grab image from data layer, not from im (to ensure preprocessing / center crop details match between image and deconv/backprop)
+        out_arr = extract_record_patch(net.blobs['data'].data[i], net, settings, record)
+
+        with profiler.timer('save'):
+            save_caffe_image(out_arr, record.maxim_filenames[record.max_idx_0],
+                             autoscale=False, autoscale_center=0, channel_swap=settings.channel_swap)
+
+
+def output_gradient_patches(settings, net, records_per_row, backward_type, do_patch, do_norm):
+    '''
+    Outputs the deconv or backprop patches of the top records of the current net batch.
+    The rows of a batch don't interact in the backward pass, so every pass seeds one unit in each row and the
+    input gradient of a row is read from net.blobs['data'].diff[i]. A batch of B records of the same layer costs
+    a single backward pass, instead of B.
+    :param settings:
+    :param net:
+    :param records_per_row: list of records lists, one per batch row
+    :param backward_type: 'deconv' (Guided Backprop) or 'backprop'
+    :param do_patch: output the patch
+    :param do_norm: output the norm of the patch
+    :return:
+    '''
+
+    # a pass starts at a single layer, so group the records by layer first
+    layer_names = []
+    layer_to_rows = dict()
+    for i, records in enumerate(records_per_row):
+        for record in records:
+            if record.denormalized_layer_name not in layer_to_rows:
+                layer_names.append(record.denormalized_layer_name)
+                layer_to_rows[record.denormalized_layer_name] = [[] for _ in records_per_row]
+            layer_to_rows[record.denormalized_layer_name][i].append(record)
+
+    for layer_name in layer_names:
+        rows = layer_to_rows[layer_name]
+        top_name = layer_name_to_top_name(net, layer_name)
+
+        for pass_idx in range(max(len(row) for row in rows)):
+            pass_records = [(i, row[pass_idx]) for i, row in enumerate(rows) if pass_idx < len(row)]
+
+            diffs = net.blobs[top_name].diff * 0
+            for i, record in pass_records:
+                seed_record_diff(diffs, i, record)
+
+            if backward_type == 'deconv':
+                with profiler.timer('deconv'):
+                    net.deconv_from_layer(layer_name, diffs, zero_higher=True, deconv_type='Guided Backprop')
+            else:
+                with profiler.timer('backprop'):
+                    net.backward_from_layer(layer_name, diffs)
+
+            for i, record in pass_records:
+                out_arr = extract_record_patch(net.blobs['data'].diff[i], net, settings, record)
+
+                if out_arr.max() == 0:
+                    print 'Warning: Deconv out_arr in range', out_arr.min(), 'to', out_arr.max(), 'ensure force_backward: true in prototxt'
+
+                if backward_type == 'deconv':
+                    patch_filenames, norm_filenames = record.deconv_filenames, record.deconvnorm_filenames
+                else:
+                    patch_filenames, norm_filenames = record.backprop_filenames, record.backpropnorm_filenames
+
+                if do_patch:
+                    with profiler.timer('save'):
+                        save_caffe_image(out_arr, patch_filenames[record.max_idx_0],
+                                         autoscale=False, autoscale_center=0, channel_swap=settings.channel_swap)
+                if do_norm:
+                    out_arr = np.linalg.norm(out_arr, axis=0)
+                    with profiler.timer('save'):
+                        save_caffe_image(out_arr, norm_filenames[record.max_idx_0],
+                                         channel_swap=settings.channel_swap)
+
+
+def seed_record_diff(diffs, i, record):
+    if len(diffs.shape) == 4:
+        diffs[i, record.channel_idx, record.ii, record.jj] = 1.0
+    else:
+        diffs[i, record.channel_idx] = 1.0
+
+
+def extract_record_patch(data, net, settings, record):
+    return extract_patch_from_image(data, net, record.selected_input_index, settings,
+                                    record.data_ii_end, record.data_ii_start,
+                                    record.data_jj_end, record.data_jj_start,
+                                    record.out_ii_end, record.out_ii_start,
+                                    record.out_jj_end, record.out_jj_start, record.size_ii, record.size_jj)
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+
+import argparse
+import glob
+from jby_misc import WithTimer
+from max_tracker import merge_net_max_trackers
+from find_max_act import load_max_tracker_from_file, save_max_tracker_to_file, save_manifest_of_tracker
+from tracker_store import is_tracker_dir
+from misc import get_files_list
+
+# add parent folder to search path, to enable import of core modules like settings
+import os, sys, inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Settings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merges the NetMaxTrackers of shards scanned by find_max_act.py --num-shards into one tracker of the whole dataset.')
+    parser.add_argument('--model')
+    parser.add_argument('--output', default=None, help='Merged tracker file (default: the find_max_act.py output file).')
+    parser.add_argument('shard_files', nargs='*',
+                        help='Tracker files to merge (default: all shard files in the deepvis outputs path).')
+    args = parser.parse_args()
+    settings = Settings.Settings()
+    settings.load_settings(args.model)
+
+    shard_files = args.shard_files
+    if not shard_files:
+        base, ext = os.path.splitext(settings.find_maxes_output_file)
+        # skip text dumps and unfinished saves next to the shards
+        shard_files = sorted(filename for filename in glob.glob('%s.shard_*_of_*%s' % (base, ext))
+                             if is_tracker_dir(filename))
+    assert len(shard_files) > 0, 'No shard files found'
+
+    net_max_trackers = []
+    for shard_file in shard_files:
+        print 'Loading %s' % shard_file
+        net_max_trackers.append(load_max_tracker_from_file(shard_file))
+
+    image_filenames = get_merged_files_list(settings, net_max_trackers)
+
+    with WithTimer('Merging %d trackers' % len(net_max_trackers)):
+        merged = merge_net_max_trackers(net_max_trackers, image_filenames=image_filenames)
+
+    if args.output:
+        save_max_tracker_to_file(args.output, merged, save_text=settings.max_tracker_save_text)
+    else:
+        save_max_tracker_to_file(settings.find_maxes_output_file, merged, save_text=settings.max_tracker_save_text)
+        save_manifest_of_tracker(settings, merged)
+
+
+def get_merged_files_list(settings, net_max_trackers):
+    '''
+    Lists the files of the trackers in the order of get_files_list(), the order of an unsharded scan, so that
+    the merged tracker has the same image indices as that scan.
+    :param settings:
+    :param net_max_trackers:
+    :return: file names relative to data_dir
+    '''
+    tracker_filenames = set(filename for net_max_tracker in net_max_trackers
+                            for filename in net_max_tracker.image_filenames)
+    available_files = get_files_list(settings.data_dir, settings.dataset_index_file)[0]
+    image_filenames = [filename for filename in available_files if filename in tracker_filenames]
+    missing_files = sorted(tracker_filenames.difference(image_filenames))
+    if missing_files:
+        print 'WARNING: %d scanned files are not in %s anymore, they are put at the end' % (len(missing_files),
+                                                                                           settings.data_dir)
+    return image_filenames + missing_files
+
+
+if __name__ == '__main__':
+    main()
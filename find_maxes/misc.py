@@ -1,13 +1,19 @@
 import cv2
 import os
 import sys
-import re
 import numpy as np
 import errno
+import hashlib
 import skimage
 
 
-def load_network(settings):
+def load_network(settings, processed_prototxt=None):
+    '''
+    :param settings:
+    :param processed_prototxt: result of process_network_proto(), e.g. processed once for a pool of processes.
+                               Default: process settings.prototxt
+    :return: the net
+    '''
     sys.path.insert(0, os.path.join(settings.caffevis_caffe_root, 'python'))
     import caffe
 
@@ -19,7 +25,8 @@ def load_network(settings):
         caffe.set_mode_cpu()
         print 'Loaded caffe in CPU mode'
 
-    processed_prototxt = process_network_proto(settings.prototxt, settings.caffevis_caffe_root)
+    if processed_prototxt is None:
+        processed_prototxt = process_network_proto(settings.prototxt, settings.caffevis_caffe_root)
 
     read_network_dag(settings, processed_prototxt)
 
@@ -40,17 +47,21 @@ def process_network_proto(prototxt, caffevis_caffe_root):
                 found_force_backwards = True
                 break
 
+    # write to a temp file of this process first, other processes may be reading the processed file
+    temp_prototxt = '%s.%d.tmp' % (processed_prototxt, os.getpid())
+
     # write file, adding force_backward if needed
     with open(prototxt, 'r') as proto_file:
-        with open(processed_prototxt, 'w') as new_proto_file:
+        with open(temp_prototxt, 'w') as new_proto_file:
             if not found_force_backwards:
                 new_proto_file.write('force_backward: true\n')
             for line in proto_file:
                 new_proto_file.write(line)
 
     # run upgrade tool on new file name (same output file)
-    upgrade_tool_command_line = caffevis_caffe_root + '/build/tools/upgrade_net_proto_text.bin ' + processed_prototxt + ' ' + processed_prototxt
+    upgrade_tool_command_line = caffevis_caffe_root + '/build/tools/upgrade_net_proto_text.bin ' + temp_prototxt + ' ' + temp_prototxt
     os.system(upgrade_tool_command_line)
+    os.rename(temp_prototxt, processed_prototxt)
 
     return processed_prototxt
 
@@ -106,6 +117,8 @@ def read_network_dag(settings, processed_prototxt):
     # keep helper variables in settings
     settings._network_def = network_def
     settings._layer_name_to_record = layer_name_to_record
+    settings._processed_prototxt = processed_prototxt
+    settings._receptive_field_table = None
 
     return
 
@@ -180,24 +193,45 @@ def mkdir_p(path):
             raise
 
 
-def get_files_list(data_dir):
+def get_files_list(data_dir, index_filename=None, rescan=False):
+    '''
+    Lists the images in data_dir and its subdirectories, in a stable order.
+    :param data_dir:
+    :param index_filename: where the list is cached between runs, see dataset_index.py
+    :param rescan: list data_dir even if the cached list is current
+    :return: (file names relative to data_dir, labels)
+    '''
+    from dataset_index import get_dataset_files
+
     print 'Getting image list...'
     # available_files - local list of files
-    available_files = get_files_from_directory(data_dir)
+    available_files = get_dataset_files(data_dir, index_filename, rescan).filenames
     labels = None
     print 'Getting image list... Done.'
     return available_files, labels
 
 
-def get_files_from_directory(data_dir):
-    # returns list of files in requested directory
+def get_legacy_files_list(data_dir):
+    '''
+    Lists the images directly in data_dir in the order of os.listdir(), like versions before the dataset index.
+    The image indices of trackers saved by these versions refer to this list, they have no file list of their own.
+    :param data_dir:
+    :return: file names relative to data_dir
+    '''
+    from data_sources import is_shard_source
+
+    assert not is_shard_source(data_dir) and os.path.isdir(data_dir), 'The tracker has no file list and %s is not a directory, rescan the dataset ' \
+                                    'with find_max_act.py' % (data_dir,)
+    return [filename for filename in os.listdir(data_dir)
+            if os.path.splitext(filename)[1].lower() in ('.jpg', '.jpeg', '.png')]
 
-    available_files = []
-    match_flags = re.IGNORECASE
-    for filename in os.listdir(data_dir):
-        if re.match('.*\.(jpg|jpeg|png)$', filename, match_flags):
-            available_files.append(filename)
-    return available_files
+
+def set_net_batch_size(net, batch_size):
+    '''Reshapes the input blob of the net to batch_size inputs, and the other blobs accordingly.'''
+    current_input_shape = net.blobs[net.inputs[0]].shape
+    current_input_shape[0] = batch_size
+    net.blobs[net.inputs[0]].reshape(*current_input_shape)
+    net.reshape()
 
 
 def layer_name_to_top_name(net, layer_name):
@@ -208,6 +242,126 @@ def layer_name_to_top_name(net, layer_name):
         return None
 
 
+def get_forward_end_layer(net, settings, layer_names):
+    '''
+    Finds the deepest layer the forward pass has to reach so that the top blobs of layer_names hold their final
+    values. This includes in-place layers, like the ReLU that writes to the top of a convolution.
+    :param net:
+    :param settings: with the DAG of read_network_dag()
+    :param layer_names:
+    :return: the name of the last layer to run, or None if the whole net must run
+    '''
+    layer_name_to_record = getattr(settings, '_layer_name_to_record', None)
+    if not layer_name_to_record:
+        return None
+
+    needed_tops = set()
+    for layer_name in layer_names:
+        if layer_name not in layer_name_to_record:
+            return None
+        needed_tops.update(layer_name_to_record[layer_name].tops)
+
+    # layers run in the order of net._layer_names, the last one that writes to a needed top ends the pass
+    end_layer = None
+    for layer_name in net._layer_names:
+        if layer_name in layer_name_to_record and needed_tops.intersection(layer_name_to_record[layer_name].tops):
+            end_layer = layer_name
+
+    return end_layer
+
+
+def predict_to_layer(net, im_batch, end_layer=None):
+    '''
+    Same as net.predict(im_batch, oversample=False), but the forward pass stops after end_layer.
+    With end_layer None the whole net runs.
+    '''
+    if can_preprocess_batch(net, im_batch):
+        preprocess_batch(net, im_batch)
+
+    else:
+        # caffe expects float images in [0, 1]
+        im_batch = [im.astype(np.float32) / 255 if im.dtype == np.uint8 else im for im in im_batch]
+
+        if end_layer is None:
+            net.predict(im_batch, oversample=False)
+            return
+
+        import caffe
+
+        # resize and take the center crop, like caffe.Classifier.predict
+        input_ = np.zeros((len(im_batch), net.image_dims[0], net.image_dims[1], im_batch[0].shape[2]),
+                          dtype=np.float32)
+        for ix, im in enumerate(im_batch):
+            input_[ix] = caffe.io.resize_image(im, net.image_dims)
+        center = np.array(net.image_dims) / 2.0
+        crop = np.tile(center, (1, 2))[0] + np.concatenate([-net.crop_dims / 2.0, net.crop_dims / 2.0])
+        crop = crop.astype(int)
+        input_ = input_[:, crop[0]:crop[2], crop[1]:crop[3], :]
+
+        # rows after the batch stay zero, like the padding of forward_all
+        data = net.blobs[net.inputs[0]].data
+        data[...] = 0
+        for ix, in_ in enumerate(input_):
+            data[ix] = net.transformer.preprocess(net.inputs[0], in_)
+
+    net.forward(end=end_layer)
+
+
+def can_preprocess_batch(net, im_batch):
+    '''
+    True if preprocess_batch() gives the same input as Classifier.predict: the images are already at the net input
+    size (as after resize_without_fit), so there is nothing to resize or crop.
+    '''
+    in_ = net.inputs[0]
+    data_shape = net.blobs[in_].data.shape
+    if not (0 < len(im_batch) <= data_shape[0]):
+        return False
+    if any(im.dtype != im_batch[0].dtype for im in im_batch):
+        return False
+    if net.transformer.transpose.get(in_) != (2, 0, 1):
+        return False
+    if tuple(net.image_dims) != tuple(data_shape[2:4]) or tuple(net.crop_dims) != tuple(data_shape[2:4]):
+        return False
+    return all(im.shape == (data_shape[2], data_shape[3], data_shape[1]) for im in im_batch)
+
+
+def preprocess_batch(net, im_batch):
+    '''
+    Writes the preprocessed batch straight into the input blob, with the channel swap, raw scale, mean and input
+    scale of net.transformer. Works on the whole batch at once instead of one Transformer.preprocess call per image.
+    Rows after the batch are zeroed, like the padding of forward_all.
+    The images are float in [0, 1], like from caffe.io.load_image, or uint8 in [0, 255], see image_loader.py.
+    '''
+    in_ = net.inputs[0]
+    transformer = net.transformer
+    data = net.blobs[in_].data
+    n = len(im_batch)
+
+    channel_swap = transformer.channel_swap.get(in_)
+    if channel_swap is None:
+        channel_swap = range(data.shape[1])
+
+    # HWC -> CHW with the channel swap, one strided copy per channel
+    for out_channel, in_channel in enumerate(channel_swap):
+        for ix, im in enumerate(im_batch):
+            data[ix, out_channel] = im[:, :, in_channel]
+    data[n:] = 0
+
+    batch = data[:n]
+    raw_scale = transformer.raw_scale.get(in_)
+    if im_batch[0].dtype == np.uint8:
+        # raw_scale is for images in [0, 1]
+        raw_scale = (raw_scale if raw_scale is not None else 1.0) / 255.0
+    if raw_scale is not None and raw_scale != 1.0:
+        batch *= raw_scale
+    mean = transformer.mean.get(in_)
+    if mean is not None:
+        batch -= mean
+    input_scale = transformer.input_scale.get(in_)
+    if input_scale is not None:
+        batch *= input_scale
+
+
 def resize_without_fit(img, out_max_shape,
                 dtype_out = None,
                 shrink_interpolation = cv2.INTER_LINEAR,
@@ -240,15 +394,10 @@ def resize_without_fit(img, out_max_shape,
     if convert_early:
         img = np.array(img, dtype=dtype_out)
 
-    if len(img.shape) == 3:
-        out = np.stack([cv2.resize(img[:,:,i],  # 0,0), fx=scale_1, fy=scale_0,
-                                   (int(round(img.shape[1] * scale_1)), int(round(img.shape[0] * scale_0))),  # in (c,r) order
-                                   interpolation=grow_interpolation if min(scale_0, scale_1) > 1 else shrink_interpolation)
-                        for i in range(img.shape[2])], axis=2)
-    else:
-        out = cv2.resize(img,  # 0,0), fx=scale_1, fy=scale_0,
-                         (int(round(img.shape[1] * scale_1)), int(round(img.shape[0] * scale_0))),  # in (c,r) order
-                         interpolation=grow_interpolation if min(scale_0, scale_1) > 1 else shrink_interpolation)
+    # all channels in one call, same result as resizing them one by one
+    out = cv2.resize(img,  # 0,0), fx=scale_1, fy=scale_0,
+                     (int(round(img.shape[1] * scale_1)), int(round(img.shape[0] * scale_0))),  # in (c,r) order
+                     interpolation=grow_interpolation if min(scale_0, scale_1) > 1 else shrink_interpolation)
 
     if convert_late:
         out = np.array(out, dtype=dtype_out)
@@ -263,20 +412,174 @@ def resize_without_fit(img, out_max_shape,
 def get_max_data_extent(net, settings, layer_name, is_spatial):
     '''Gets the maximum size of the data layer that can influence a unit on layer.'''
 
-    data_size = net.blobs['data'].data.shape[2:4]  # e.g. (227,227) for fc6,fc7,fc8,prop
-
     if is_spatial:
-        top_name = layer_name_to_top_name(net, layer_name)
-        conv_size = net.blobs[top_name].data.shape[2:4]        # e.g. (13,13) for conv5
-        layer_slice_middle = (conv_size[0]/2,conv_size[0]/2+1, conv_size[1]/2,conv_size[1]/2+1)   # e.g. (6,7,6,7,), the single center unit
-        data_slice = RegionComputer.convert_region_dag(settings, layer_name, 'input', layer_slice_middle)
-        data_slice_size = data_slice[1]-data_slice[0], data_slice[3]-data_slice[2]   # e.g. (163, 163) for conv5
-        # crop data slice size to data size
-        data_slice_size = min(data_slice_size[0], data_size[0]), min(data_slice_size[1], data_size[1])
-        return data_slice_size
+        return get_receptive_field_table(net, settings).max_data_extent(layer_name)
     else:
         # Whole data region
-        return data_size
+        return net.blobs['data'].data.shape[2:4]  # e.g. (227,227) for fc6,fc7,fc8,prop
+
+
+def get_receptive_field_table(net, settings):
+    '''
+    Returns the ReceptiveFieldTable of the network. It is built once and cached next to the processed prototxt, so
+    later runs of the offline scripts only load it.
+    '''
+
+    data_size = tuple(net.blobs['data'].data.shape[2:4])
+
+    table = getattr(settings, '_receptive_field_table', None)
+    if table is not None and table.data_size == data_size:
+        return table
+
+    processed_prototxt = getattr(settings, '_processed_prototxt', None)
+    cache_filename = None
+    key = None
+    if processed_prototxt is not None:
+        cache_filename = processed_prototxt + '.receptive_fields.npz'
+        key = ReceptiveFieldTable.get_key(processed_prototxt, data_size)
+        table = ReceptiveFieldTable.load(cache_filename, key)
+
+    if table is None:
+        table = ReceptiveFieldTable.build(net, settings, key)
+        if cache_filename is not None:
+            table.save(cache_filename)
+
+    settings._receptive_field_table = table
+    return table
+
+
+class ReceptiveFieldTable(object):
+    '''
+    Receptive fields of the units of all spatial layers, in coordinates of the data layer.
+
+    The regions of RegionComputer are separable: the rows of the region of unit (ii, jj) only depend on ii and the
+    columns only on jj. So each layer keeps one array per axis, indexed by the coordinate on that axis, and looking
+    up the focus area of a unit takes two array accesses instead of a walk through the DAG.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, key, data_size):
+        self.key = key
+        self.data_size = data_size
+        self.max_data_extents = dict()  # layer_name -> (size_ii, size_jj)
+        self.row_areas = dict()  # layer_name -> array (height, 4) of out_ii_start, out_ii_end, data_ii_start, data_ii_end
+        self.col_areas = dict()  # layer_name -> array (width, 4) of out_jj_start, out_jj_end, data_jj_start, data_jj_end
+
+    @staticmethod
+    def get_key(processed_prototxt, data_size):
+        '''Identifies the network the table was built for.'''
+        sha1 = hashlib.sha1()
+        with open(processed_prototxt, 'rb') as proto_file:
+            sha1.update(proto_file.read())
+        sha1.update(repr((ReceptiveFieldTable.VERSION, tuple(data_size))))
+        return sha1.hexdigest()
+
+    @staticmethod
+    def build(net, settings, key=None):
+        data_size = tuple(net.blobs['data'].data.shape[2:4])
+        table = ReceptiveFieldTable(key, data_size)
+
+        for layer_name in settings._layer_name_to_record:
+            top_name = layer_name_to_top_name(net, layer_name)
+            if top_name is None or top_name not in net.blobs or len(net.blobs[top_name].data.shape) != 4:
+                continue
+            layer_size = net.blobs[top_name].data.shape[2:4]
+
+            # convert the regions of all rows and columns at once
+            ii = np.arange(layer_size[0])
+            jj = np.arange(layer_size[1])
+            data_region = RegionComputer.convert_region_dag(settings, layer_name, 'input', (ii, ii + 1, jj, jj + 1))
+            data_ii_starts, data_ii_ends, data_jj_starts, data_jj_ends = \
+                [np.broadcast_to(bound, axis.shape) for bound, axis in zip(data_region, [ii, ii, jj, jj])]
+
+            # size of the region of the single center unit, cropped to data size
+            middle_ii, middle_jj = layer_size[0] / 2, layer_size[1] / 2
+            size_ii = min(data_ii_ends[middle_ii] - data_ii_starts[middle_ii], data_size[0])
+            size_jj = min(data_jj_ends[middle_jj] - data_jj_starts[middle_jj], data_size[1])
+
+            table.max_data_extents[layer_name] = (int(size_ii), int(size_jj))
+            table.row_areas[layer_name] = compute_focus_area_on_axis(data_ii_starts, data_ii_ends, size_ii,
+                                                                     data_size[0])
+            table.col_areas[layer_name] = compute_focus_area_on_axis(data_jj_starts, data_jj_ends, size_jj,
+                                                                     data_size[1])
+
+        return table
+
+    @staticmethod
+    def load(filename, key):
+        '''Loads the table saved in filename, None if there is none or it was built for another network.'''
+        if not os.path.exists(filename):
+            return None
+
+        with np.load(filename) as arrays:
+            if str(arrays['key']) != key:
+                return None
+
+            table = ReceptiveFieldTable(key, tuple(arrays['data_size']))
+            for layer_idx, layer_name in enumerate(arrays['layer_names']):
+                layer_name = str(layer_name)
+                table.max_data_extents[layer_name] = tuple(int(size)
+                                                           for size in arrays['max_data_extent_%d' % layer_idx])
+                table.row_areas[layer_name] = arrays['row_areas_%d' % layer_idx]
+                table.col_areas[layer_name] = arrays['col_areas_%d' % layer_idx]
+        return table
+
+    def save(self, filename):
+        # layer names may contain '/', so the arrays are numbered
+        layer_names = sorted(self.row_areas.keys())
+        arrays = {'key': np.array(self.key), 'data_size': np.array(self.data_size),
+                  'layer_names': np.array(layer_names)}
+        for layer_idx, layer_name in enumerate(layer_names):
+            arrays['max_data_extent_%d' % layer_idx] = np.array(self.max_data_extents[layer_name])
+            arrays['row_areas_%d' % layer_idx] = self.row_areas[layer_name]
+            arrays['col_areas_%d' % layer_idx] = self.col_areas[layer_name]
+
+        # save to a temp file first, a table left by an interrupted save would not load. The temp file is of this
+        # process, the workers of launch_crop_max_patches.py may build the table at the same time
+        temp_filename = '%s.%d.tmp.npz' % (filename, os.getpid())
+        np.savez(temp_filename, **arrays)
+        os.rename(temp_filename, filename)
+
+    def max_data_extent(self, layer_name):
+        return self.max_data_extents[layer_name]
+
+    def focus_area(self, layer_name, is_spatial, ii, jj):
+        '''
+        Returns [out_ii_start, out_ii_end, out_jj_start, out_jj_end, data_ii_start, data_ii_end, data_jj_start,
+        data_jj_end]: the region of the data layer that influences unit (ii, jj), and where it goes in a patch of
+        max_data_extent(layer_name).
+        '''
+
+        if not is_spatial:
+            size_ii, size_jj = self.data_size
+            return [0, size_ii, 0, size_jj, 0, size_ii, 0, size_jj]
+
+        out_ii_start, out_ii_end, data_ii_start, data_ii_end = self.row_areas[layer_name][ii]
+        out_jj_start, out_jj_end, data_jj_start, data_jj_end = self.col_areas[layer_name][jj]
+        return [int(out_ii_start), int(out_ii_end), int(out_jj_start), int(out_jj_end),
+                int(data_ii_start), int(data_ii_end), int(data_jj_start), int(data_jj_end)]
+
+
+def compute_focus_area_on_axis(data_starts, data_ends, size, data_size):
+    '''
+    Crops the regions of one axis to the data and places them in a patch of the given size.
+    :return: array (n, 4) of out_start, out_end, data_start, data_end
+    '''
+
+    # safe guard edges
+    data_starts = np.maximum(data_starts, 0)
+    data_ends = np.minimum(data_ends, data_size)
+
+    # Compute how much of the data slice falls outside the actual data [0,max] range
+    outside = size - (data_ends - data_starts)  # possibly 0
+
+    # regions cut at the start go to the end of the patch, the others to its start
+    touching_min = (data_starts == 0)
+    out_starts = np.where(touching_min, outside, 0)
+    out_ends = np.where(touching_min, size, size - outside)
+
+    return np.stack([out_starts, out_ends, data_starts, data_ends], axis=1).astype(np.int32)
 
 
 class RegionComputer(object):
@@ -328,10 +631,11 @@ class RegionComputer(object):
         region1_x_start, region1_x_end, region1_y_start, region1_y_end = region1
         region2_x_start, region2_x_end, region2_y_start, region2_y_end = region2
 
-        merged_x_start = min(region1_x_start, region2_x_start)
-        merged_x_end = max(region1_x_end, region2_x_end)
-        merged_y_start = min(region1_y_start, region2_y_start)
-        merged_y_end = max(region1_y_end, region2_y_end)
+        # elementwise, so that regions of many units can be merged at once
+        merged_x_start = np.minimum(region1_x_start, region2_x_start)
+        merged_x_end = np.maximum(region1_x_end, region2_x_end)
+        merged_y_start = np.minimum(region1_y_start, region2_y_start)
+        merged_y_end = np.maximum(region1_y_end, region2_y_end)
 
         merged_region = (merged_x_start, merged_x_end, merged_y_start, merged_y_end)
 
@@ -387,49 +691,6 @@ class RegionComputer(object):
         return total_region
 
 
-def compute_data_layer_focus_area(is_spatial, ii, jj, settings, layer_name, size_ii, size_jj, data_size_ii, data_size_jj):
-
-    if is_spatial:
-
-        # Compute the focus area of the data layer
-        layer_indices = (ii, ii + 1, jj, jj + 1)
-
-        data_indices = RegionComputer.convert_region_dag(settings, layer_name, 'input', layer_indices)
-        data_ii_start, data_ii_end, data_jj_start, data_jj_end = data_indices
-
-        # safe guard edges
-        data_ii_start = max(data_ii_start, 0)
-        data_jj_start = max(data_jj_start, 0)
-        data_ii_end = min(data_ii_end, data_size_ii)
-        data_jj_end = min(data_jj_end, data_size_jj)
-
-        touching_imin = (data_ii_start == 0)
-        touching_jmin = (data_jj_start == 0)
-
-        # Compute how much of the data slice falls outside the actual data [0,max] range
-        ii_outside = size_ii - (data_ii_end - data_ii_start)  # possibly 0
-        jj_outside = size_jj - (data_jj_end - data_jj_start)  # possibly 0
-
-        if touching_imin:
-            out_ii_start = ii_outside
-            out_ii_end = size_ii
-        else:
-            out_ii_start = 0
-            out_ii_end = size_ii - ii_outside
-        if touching_jmin:
-            out_jj_start = jj_outside
-            out_jj_end = size_jj
-        else:
-            out_jj_start = 0
-            out_jj_end = size_jj - jj_outside
-
-    else:
-        data_ii_start, out_ii_start, data_jj_start, out_jj_start = 0, 0, 0, 0
-        data_ii_end, out_ii_end, data_jj_end, out_jj_end = size_ii, size_ii, size_jj, size_jj
-
-    return [out_ii_start, out_ii_end, out_jj_start, out_jj_end, data_ii_start, data_ii_end, data_jj_start, data_jj_end]
-
-
 def extract_patch_from_image(data, net, selected_input_index, settings,
                              data_ii_end, data_ii_start, data_jj_end, data_jj_start,
                              out_ii_end, out_ii_start, out_jj_end, out_jj_start, size_ii, size_jj):
@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+
+# this import must comes first to make sure we use the non-display backend
+import matplotlib
+
+matplotlib.use('Agg')
+
+import argparse
+from jby_misc import WithTimer
+from find_max_act import load_max_tracker_from_file
+
+# add parent folder to search path, to enable import of core modules like settings
+import os, sys, inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Settings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Loads a saved NetMaxTracker and plots the statistics collected during the scan: the max activation histogram of each unit, the activity of each layer and the correlation of its channels.')
+    parser.add_argument('--model')
+    parser.add_argument('--no-histograms', action='store_true', help='Skip the histograms.')
+    parser.add_argument('--no-correlation', action='store_true', help='Skip the correlation matrices.')
+    parser.add_argument('--backend', default=None,
+                        help='matplotlib or opencv (default: max_tracker_plot_backend of the settings).')
+    parser.add_argument('--force', action='store_true',
+                        help='Plot all layers, also those whose statistics did not change since the last run.')
+    args = parser.parse_args()
+    settings = Settings.Settings()
+    settings.load_settings(args.model)
+
+    backend = args.backend if args.backend is not None else settings.max_tracker_plot_backend
+
+    nmt = load_max_tracker_from_file(settings.find_maxes_output_file)
+
+    if not args.no_histograms:
+        with WithTimer('Plotted histograms'):
+            nmt.calculate_histograms(settings.deepvis_outputs_path, backend=backend,
+                                     num_workers=settings.max_tracker_plot_workers, force=args.force)
+
+    if not args.no_correlation:
+        with WithTimer('Plotted correlation'):
+            nmt.calculate_correlation(settings.deepvis_outputs_path, backend=backend,
+                                      num_workers=settings.max_tracker_plot_workers, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import os
+import math
+import time
+import json
+import atexit
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+# durations are counted in logarithmic bins from MIN_SECONDS on, each BIN_RATIO times wider than the one before.
+# Percentiles are exact to about half a bin, 2.5%
+MIN_SECONDS = 1e-6
+BIN_RATIO = 1.05
+LOG_BIN_RATIO = math.log(BIN_RATIO)
+
+REPORT_VERSION = 1
+
+
+class TimerStats(object):
+    '''Count, total, min, max and a histogram of the durations of a timer. Adding a duration is O(1).'''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.bins = dict()
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        bin_idx = int(math.log(seconds / MIN_SECONDS) / LOG_BIN_RATIO) if seconds > MIN_SECONDS else 0
+        self.bins[bin_idx] = self.bins.get(bin_idx, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for value in [other.min, other.max]:
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        for bin_idx, n in other.bins.items():
+            self.bins[bin_idx] = self.bins.get(bin_idx, 0) + n
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        '''Duration below which percent of the durations are, from the center of its bin.'''
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100.0 * self.count
+        n_below = 0
+        for bin_idx in sorted(self.bins):
+            n_below += self.bins[bin_idx]
+            if n_below >= rank:
+                seconds = MIN_SECONDS * BIN_RATIO ** (bin_idx + 0.5)
+                return min(max(seconds, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return OrderedDict([('count', self.count), ('total', self.total), ('mean', self.mean),
+                            ('min', self.min), ('max', self.max), ('p50', self.percentile(50)),
+                            ('p95', self.percentile(95)), ('p99', self.percentile(99))])
+
+
+class Timer(object):
+    '''Times a with block into the stats of its profiler, see Profiler.timer().'''
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.stack.append(self.name)
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.time() - self.start_time
+        self.profiler.add('/'.join(self.profiler.stack), seconds)
+        self.profiler.stack.pop()
+
+
+class Profiler(object):
+    '''
+    Named timers that can be nested, and counters. A timer started inside another one is named after both, e.g.
+    'load/resize', so that the time of the inner one is part of the outer one.
+    With decode workers, the timers of the workers are merged under 'workers/', e.g. 'workers/resize'. Their time
+    is spent in parallel, the calling process only waits for them in 'load'.
+    '''
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.stats = OrderedDict()
+        self.counters = OrderedDict()
+        self.stack = []
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def add(self, name, seconds):
+        if name not in self.stats:
+            self.stats[name] = TimerStats()
+        self.stats[name].add(seconds)
+
+    def merge(self, stats, prefix=''):
+        '''Adds the timer stats of another profiler, e.g. of a worker process, with prefix before their names.'''
+        for name, timer_stats in stats.items():
+            if prefix + name not in self.stats:
+                self.stats[prefix + name] = TimerStats()
+            self.stats[prefix + name].merge(timer_stats)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def iter_timed(self, name, iterable):
+        '''Yields the items of iterable, timing how long each one takes to produce.'''
+        iterator = iter(iterable)
+        while True:
+            with self.timer(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self, names=None):
+        '''Mean duration of the timers in ms, e.g. 'predict 35.1 ms, update 3.2 ms'. Default: the outermost timers.'''
+        if names is None:
+            names = [name for name in self.stats if '/' not in name]
+        return ', '.join('%s %.1f ms' % (name, self.stats[name].mean * 1000) for name in names if name in self.stats)
+
+    def report(self):
+        seconds = time.time() - self.start_time
+        return OrderedDict([('version', REPORT_VERSION),
+                            ('started', datetime.fromtimestamp(self.start_time).isoformat()),
+                            ('seconds', seconds),
+                            ('counters', OrderedDict((name, OrderedDict([('count', n), ('per_sec', n / seconds)]))
+                                                     for name, n in self.counters.items())),
+                            ('timers', OrderedDict((name, stats.to_dict()) for name, stats in self.stats.items()))])
+
+    def save_report(self, filename, **extra):
+        '''Writes the report as JSON, with the extra items at the top level, e.g. the name of the script.'''
+        report = self.report()
+        report.update(extra)
+        dir_name = os.path.dirname(filename)
+        if dir_name and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        with open(filename, 'wt') as report_file:
+            json.dump(report, report_file, indent=1)
+
+
+# the profiler of this process, used by the offline scripts
+profiler = Profiler()
+
+
+def save_report_at_exit(reports_path, script_name):
+    '''
+    Saves the report of the profiler to reports_path/<script_name>_<start time>.json when the process exits,
+    also after errors and interrupts. Does nothing if reports_path is None.
+    '''
+    if reports_path is None:
+        return
+
+    filename = os.path.join(reports_path, '%s_%s.json' % (
+        script_name, datetime.fromtimestamp(profiler.start_time).strftime('%Y%m%d_%H%M%S')))
+
+    def save_report():
+        profiler.save_report(filename, script=script_name)
+        print 'Saved timing report to %s' % filename
+
+    atexit.register(save_report)
+
+
+class ProgressReporter(object):
+    '''
+    Counts the items of a loop in the profiler, and prints progress, throughput, time left and the mean durations
+    of the timers every interval seconds.
+    '''
+
+    def __init__(self, name, n_total, n_done=0, interval=30):
+        self.name = name
+        self.n_total = n_total
+        self.n_done = n_done
+        self.interval = interval
+        self.start_time = time.time()
+        self.n_start = n_done
+        self.last_print_time = self.start_time
+
+    def update(self, n_new):
+        self.n_done += n_new
+        profiler.count(self.name, n_new)
+
+        now = time.time()
+        if now - self.last_print_time < self.interval and self.n_done < self.n_total:
+            return
+        self.last_print_time = now
+
+        per_sec = (self.n_done - self.n_start) / (now - self.start_time) if now > self.start_time else 0
+        seconds_left = (self.n_total - self.n_done) / per_sec if per_sec > 0 else 0
+        print '%s   %s %d/%d, %.1f %s/sec, %s left | %s' % (
+            datetime.now().ctime(), self.name, self.n_done, self.n_total, per_sec, self.name,
+            timedelta(seconds=int(seconds_left)), profiler.summary())
@@ -0,0 +1,278 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+import cv2
+
+PLOT_BACKENDS = ['matplotlib', 'opencv']
+
+# number of channel histograms rendered by one job of the pool
+HISTOGRAMS_PER_JOB = 64
+
+DIGEST_FILENAME = 'max_stats_digest.json'
+
+
+class PlotRenderer(object):
+    '''
+    Renders plots with the given backend, in a pool of worker processes if num_workers > 0.
+    Jobs are queued by submit() and finished by wait().
+    Create it before the calling process draws anything with matplotlib, workers forked from a process that
+    already rendered text inherit its font state and can garble labels.
+    '''
+
+    def __init__(self, backend='matplotlib', num_workers=0):
+        assert backend in PLOT_BACKENDS, 'Unknown plot backend %s, use one of %s' % (backend, PLOT_BACKENDS)
+        self.backend = backend
+        self.pool = multiprocessing.Pool(num_workers) if num_workers > 0 else None
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def submit(self, function, *args):
+        if self.pool is None:
+            function(*args)
+        else:
+            self.pending.append(self.pool.apply_async(function, args))
+
+    def wait(self):
+        '''Waits for all submitted jobs, errors of the jobs are raised here.'''
+        for result in self.pending:
+            result.get()
+        self.pending = []
+
+
+def stats_digest(channel_stats, *extra):
+    '''Digest of the statistics and of any extra plot options, changes whenever the plots would change.'''
+    sha1 = hashlib.sha1()
+    for array in [channel_stats.hist_counts, channel_stats.hist_exponents, channel_stats.hist_offsets,
+                  channel_stats.mean, channel_stats.comoment]:
+        sha1.update(np.ascontiguousarray(array).tostring())
+    sha1.update(repr((channel_stats.count,) + extra))
+    return sha1.hexdigest()
+
+
+def layer_plots_are_current(layer_dir, key, digest, filenames):
+    '''True if the plots of key were rendered from statistics with this digest and all of their files exist.'''
+    digest_filename = os.path.join(layer_dir, DIGEST_FILENAME)
+    if not os.path.exists(digest_filename):
+        return False
+    with open(digest_filename, 'rt') as digest_file:
+        digests = json.load(digest_file)
+    return digests.get(key) == digest and all(os.path.exists(filename) for filename in filenames)
+
+
+def save_layer_digest(layer_dir, key, digest):
+    digest_filename = os.path.join(layer_dir, DIGEST_FILENAME)
+    digests = dict()
+    if os.path.exists(digest_filename):
+        with open(digest_filename, 'rt') as digest_file:
+            digests = json.load(digest_file)
+    digests[key] = digest
+    with open(digest_filename, 'wt') as digest_file:
+        json.dump(digests, digest_file)
+
+
+def find_dead_bin(hist, bin_edges):
+    '''Index of the bin that holds zero, None if there is none.'''
+    for i in range(len(hist)):
+        if 0 >= bin_edges[i] and 0 < bin_edges[i + 1]:
+            return i
+    return None
+
+
+def render_max_histograms(renderer, layer_name, channel_histograms, layer_filename):
+    '''
+    Renders the max histogram of each channel and the activity histogram of the layer.
+    :param renderer: PlotRenderer
+    :param layer_name:
+    :param channel_histograms: list of (channel_idx, hist, bin_edges, filename)
+    :param layer_filename:
+    :return:
+    '''
+    percent_dead = np.zeros(len(channel_histograms), dtype=np.float32)
+    for i, (channel_idx, hist, bin_edges, filename) in enumerate(channel_histograms):
+        dead_bin = find_dead_bin(hist, bin_edges)
+        if dead_bin is not None:
+            percent_dead[i] = 100.0 * hist[dead_bin] / sum(hist)
+
+    for begin in range(0, len(channel_histograms), HISTOGRAMS_PER_JOB):
+        renderer.submit(render_channel_histograms, renderer.backend, layer_name,
+                        channel_histograms[begin:begin + HISTOGRAMS_PER_JOB])
+
+    # generate histogram for layer
+    num_bins = 20
+    hist, bin_edges = np.histogram(100 - percent_dead, bins=num_bins, range=(0, 100))
+
+    bar_colors = [None] * num_bins
+    begin_color = np.array([1.0, 0, 0])
+    end_color = np.array([0, 1.0, 0])
+    color_step = (end_color - begin_color) / (num_bins - 1)
+    current_color = begin_color
+    for i in range(num_bins):
+        bar_colors[i] = tuple(current_color)
+        current_color += color_step
+
+    renderer.submit(render_bar_chart, renderer.backend, layer_filename, hist, bin_edges, bar_colors,
+                    'activity of layer %s' % (layer_name), 'activity percent', 'channels count')
+
+
+def render_channel_histograms(backend, layer_name, channel_histograms):
+    '''Renders a list of (channel_idx, hist, bin_edges, filename), the dead bar is marked in red.'''
+
+    fig = None
+    if backend == 'matplotlib':
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(10, 10))
+
+    for channel_idx, hist, bin_edges, filename in channel_histograms:
+        colors = [(0, 0.5, 0)] * len(hist)
+        dead_bin = find_dead_bin(hist, bin_edges)
+        if dead_bin is not None:
+            # mark dead bar in red
+            colors[dead_bin] = (1.0, 0, 0)
+
+        render_bar_chart(backend, filename, hist, bin_edges, colors,
+                         'max activations histgoram of layer %s channel %d' % (layer_name, channel_idx),
+                         'max activation value', 'inputs count', fig=fig)
+
+    if fig is not None:
+        import matplotlib.pyplot as plt
+        plt.close(fig)
+
+
+def render_bar_chart(backend, filename, hist, bin_edges, colors, title, xlabel, ylabel, fig=None):
+    '''Renders a histogram as bar chart, colors are RGB tuples in [0, 1], one per bar.'''
+
+    width = 0.7 * (bin_edges[1] - bin_edges[0])
+    center = (bin_edges[:-1] + bin_edges[1:]) / 2
+
+    if backend == 'opencv':
+        image = raster_bar_chart(center, hist, width, colors, title, xlabel, ylabel)
+        cv2.imwrite(filename, image)
+        return
+
+    import matplotlib.pyplot as plt
+
+    own_fig = fig is None
+    if own_fig:
+        fig = plt.figure(figsize=(10, 10))
+    ax = fig.add_subplot(111)
+
+    ax.bar(center, hist, align='center', width=width, color=colors)
+
+    fig.suptitle(title)
+    ax.xaxis.label.set_text(xlabel)
+    ax.yaxis.label.set_text(ylabel)
+
+    fig.savefig(filename)
+
+    if own_fig:
+        plt.close(fig)
+    else:
+        fig.clf()
+
+
+def render_correlation_matrix(backend, filename, matrix, title):
+    '''Renders a matrix of values in [-1, 1] with a color bar.'''
+
+    if backend == 'opencv':
+        cv2.imwrite(filename, raster_matrix(matrix, title))
+        return
+
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(10, 10))
+    plt.subplot(1, 1, 1)
+    plt.imshow(matrix, interpolation='nearest', vmin=-1, vmax=1)
+    plt.colorbar()
+    plt.title(title)
+    plt.tight_layout()
+    fig.savefig(filename, bbox_inches='tight')
+    plt.close(fig)
+
+
+def to_bgr(color):
+    return tuple(int(round(255 * channel)) for channel in reversed(color))
+
+
+def raster_bar_chart(center, hist, width, colors, title, xlabel, ylabel, size=(600, 800)):
+    '''Draws a bar chart with OpenCV, returns the BGR image.'''
+
+    height, image_width = size
+    left, right, top, bottom = 70, 30, 70, 60
+    image = np.full((height, image_width, 3), 255, dtype=np.uint8)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    black = (0, 0, 0)
+
+    plot_width = image_width - left - right
+    plot_height = height - top - bottom
+    x_min, x_max = center[0] - width, center[-1] + width
+    if x_max <= x_min:
+        x_max = x_min + 1
+    y_max = max(float(np.max(hist)), 1.0)
+
+    def to_x(value):
+        return int(round(left + (value - x_min) / (x_max - x_min) * plot_width))
+
+    def to_y(value):
+        return int(round(top + plot_height - value / y_max * plot_height))
+
+    for value, count, color in zip(center, hist, colors):
+        cv2.rectangle(image, (to_x(value - width / 2), to_y(count)), (to_x(value + width / 2), to_y(0)),
+                      to_bgr(color), thickness=-1)
+
+    # axes and tick labels
+    cv2.line(image, (left, top), (left, top + plot_height), black)
+    cv2.line(image, (left, top + plot_height), (left + plot_width, top + plot_height), black)
+    for value in [center[0], (center[0] + center[-1]) / 2, center[-1]]:
+        cv2.line(image, (to_x(value), top + plot_height), (to_x(value), top + plot_height + 5), black)
+        cv2.putText(image, '%.4g' % value, (to_x(value) - 20, top + plot_height + 20), font, 0.4, black)
+    for value in [0, y_max / 2, y_max]:
+        cv2.line(image, (left - 5, to_y(value)), (left, to_y(value)), black)
+        cv2.putText(image, '%.4g' % value, (5, to_y(value) + 4), font, 0.4, black)
+
+    cv2.putText(image, title, (left, 25), font, 0.5, black)
+    cv2.putText(image, xlabel, (left + plot_width / 2 - 60, height - 15), font, 0.45, black)
+    cv2.putText(image, ylabel, (5, top - 20), font, 0.45, black)
+
+    return image
+
+
+def raster_matrix(matrix, title, min_size=512, max_size=2048):
+    '''Draws a matrix of values in [-1, 1] with OpenCV, in the jet color map with a color bar. Returns the BGR image.'''
+
+    n = matrix.shape[0]
+    scaled = np.clip((np.nan_to_num(matrix) + 1) * 127.5, 0, 255).astype(np.uint8)
+
+    # integer upscaling keeps every entry visible, large matrices are averaged down
+    if n < min_size:
+        factor = int(np.ceil(float(min_size) / n))
+        scaled = cv2.resize(scaled, (n * factor, n * factor), interpolation=cv2.INTER_NEAREST)
+    elif n > max_size:
+        scaled = cv2.resize(scaled, (max_size, max_size), interpolation=cv2.INTER_AREA)
+    plot = cv2.applyColorMap(scaled, cv2.COLORMAP_JET)
+
+    size = plot.shape[0]
+    top, margin, bar_width, labels_width = 40, 10, 20, 40
+    image = np.full((size + top + margin, size + 2 * margin + bar_width + labels_width, 3), 255, dtype=np.uint8)
+    image[top:top + size, margin:margin + size] = plot
+
+    # color bar from 1 (top) to -1 (bottom)
+    bar = np.linspace(255, 0, size).astype(np.uint8)[:, np.newaxis].repeat(bar_width, axis=1)
+    bar_left = 2 * margin + size
+    image[top:top + size, bar_left:bar_left + bar_width] = cv2.applyColorMap(bar, cv2.COLORMAP_JET)
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    black = (0, 0, 0)
+    for value, y in [(1, top + 10), (0, top + size / 2 + 4), (-1, top + size - 2)]:
+        cv2.putText(image, '%d' % value, (bar_left + bar_width + 5, y), font, 0.4, black)
+    cv2.putText(image, title, (margin, 25), font, 0.5, black)
+
+    return image
@@ -0,0 +1,225 @@
+import os
+import json
+import shutil
+import numpy as np
+from max_tracker import NetMaxTracker, MaxTracker
+from channel_stats import ChannelStats
+
+TRACKER_FORMAT = 'deepvis_max_tracker'
+TRACKER_FORMAT_VERSION = 1
+HEADER_FILENAME = 'header.json'
+
+# arrays of a MaxTracker and the dtype they are stored with, None keeps the dtype
+MAX_TRACKER_ARRAYS = [('max_vals', None), ('max_locs', np.int32), ('min_vals', None), ('min_locs', np.int32)]
+
+# arrays of a ChannelStats
+CHANNEL_STATS_ARRAYS = [('hist_counts', None), ('hist_exponents', np.int32), ('hist_offsets', None),
+                        ('hist_has_range', None), ('mean', None), ('comoment', None)]
+
+
+def is_tracker_dir(filename):
+    return os.path.isfile(os.path.join(get_complete_tracker_dir(filename), HEADER_FILENAME))
+
+
+def get_complete_tracker_dir(dirname):
+    '''
+    Returns the directory to load instead of dirname if save_tracker_dir() crashed between its two renames: the
+    new <dirname>.tmp if it is complete, else the previous <dirname>.old. The header is written last, so a
+    directory with a header is complete.
+    '''
+    if os.path.exists(dirname):
+        return dirname
+    for candidate in [dirname + '.tmp', dirname + '.old']:
+        if os.path.isfile(os.path.join(candidate, HEADER_FILENAME)):
+            return candidate
+    return dirname
+
+
+def save_tracker_dir(dirname, net_max_tracker):
+    '''
+    Saves a NetMaxTracker as a directory with a JSON header and one .npy file per array and layer.
+    Locations are stored as int32. The new directory is written to <dirname>.tmp and then swapped in with two
+    renames. If a crash between them leaves no <dirname>, load_tracker_dir() reads the complete one of
+    <dirname>.tmp and <dirname>.old, and the next save cleans up. Captured patches and seen inputs are not saved,
+    like in the pickled trackers.
+    '''
+    temp_dirname = dirname + '.tmp'
+    if os.path.exists(temp_dirname):
+        shutil.rmtree(temp_dirname)
+    os.makedirs(temp_dirname)
+
+    header = {'format': TRACKER_FORMAT,
+              'version': TRACKER_FORMAT_VERSION,
+              'layers': list(net_max_tracker.layers),
+              'n_top': net_max_tracker.n_top,
+              'search_min': net_max_tracker.search_min,
+              'initial_val': net_max_tracker.initial_val,
+              'channel_correlation': getattr(net_max_tracker, 'channel_correlation', True),
+              'image_filenames': getattr(net_max_tracker, 'image_filenames', None),
+              'layer_records': {}}
+
+    for layer_idx, layer_name in enumerate(net_max_tracker.layers):
+        max_tracker = net_max_tracker.max_trackers[layer_name]
+
+        # layer names may contain '/', so the directories are numbered
+        layer_dir = 'layer_%03d' % layer_idx
+        os.mkdir(os.path.join(temp_dirname, layer_dir))
+
+        # minor fix for backwards compatability
+        is_spatial = max_tracker.is_conv if hasattr(max_tracker, 'is_conv') else max_tracker.is_spatial
+
+        layer_record = {'dir': layer_dir,
+                        'is_spatial': bool(is_spatial),
+                        'n_top': max_tracker.n_top,
+                        'search_min': max_tracker.search_min,
+                        'arrays': save_arrays(os.path.join(temp_dirname, layer_dir), max_tracker,
+                                              MAX_TRACKER_ARRAYS)}
+
+        channel_stats = getattr(max_tracker, 'channel_stats', None)
+        if channel_stats is not None:
+            layer_record['channel_stats'] = {'n_channels': channel_stats.n_channels,
+                                             'n_bins': channel_stats.n_bins,
+                                             'track_correlation': channel_stats.track_correlation,
+                                             'count': channel_stats.count,
+                                             'arrays': save_arrays(os.path.join(temp_dirname, layer_dir),
+                                                                   channel_stats, CHANNEL_STATS_ARRAYS,
+                                                                   prefix='stats_')}
+
+        header['layer_records'][layer_name] = layer_record
+
+    with open(os.path.join(temp_dirname, HEADER_FILENAME), 'wt') as header_file:
+        json.dump(header, header_file, indent=1)
+
+    # replace the old directory, a crash in between leaves the old or the new one, see get_complete_tracker_dir
+    old_dirname = dirname + '.old'
+    if os.path.exists(dirname):
+        if os.path.exists(old_dirname):
+            shutil.rmtree(old_dirname)
+        os.rename(dirname, old_dirname)
+    os.rename(temp_dirname, dirname)
+    if os.path.exists(old_dirname):
+        shutil.rmtree(old_dirname)
+
+
+def save_arrays(dirname, obj, array_names_and_dtypes, prefix=''):
+    '''Saves the array attributes of obj that are not None, returns their file names.'''
+    array_filenames = {}
+    for name, dtype in array_names_and_dtypes:
+        array = getattr(obj, name, None)
+        if array is None:
+            continue
+        if dtype is not None:
+            if array.size > 0:
+                assert np.abs(array).max() <= np.iinfo(dtype).max, \
+                    '%s does not fit into %s' % (name, np.dtype(dtype).name)
+            array = array.astype(dtype)
+        array_filenames[name] = prefix + name + '.npy'
+        np.save(os.path.join(dirname, array_filenames[name]), array)
+    return array_filenames
+
+
+def load_tracker_dir(dirname, layers=None, mmap_mode=None):
+    '''
+    Loads a NetMaxTracker saved by save_tracker_dir().
+    :param dirname:
+    :param layers: layers to load, default: all. The tracker only contains these layers
+    :param mmap_mode: e.g. 'r' to map the arrays instead of reading them, see np.load
+    :return: NetMaxTracker
+    '''
+    complete_dirname = get_complete_tracker_dir(dirname)
+    if complete_dirname != dirname:
+        print 'WARNING: %s is missing, the last save was interrupted. Loading %s' % (dirname, complete_dirname)
+        dirname = complete_dirname
+
+    with open(os.path.join(dirname, HEADER_FILENAME), 'rt') as header_file:
+        header = json.load(header_file)
+
+    assert header.get('format') == TRACKER_FORMAT, '%s is not a max tracker directory' % dirname
+    assert header['version'] <= TRACKER_FORMAT_VERSION, \
+        'Max tracker format version %d is newer than this code (%d)' % (header['version'], TRACKER_FORMAT_VERSION)
+
+    # json gives unicode strings, the rest of the code uses byte strings
+    header = to_byte_strings(header)
+
+    if layers is None:
+        layers = header['layers']
+    for layer_name in layers:
+        assert layer_name in header['layer_records'], 'Layer %s is not in %s' % (layer_name, dirname)
+
+    net_max_tracker = NetMaxTracker(None, layers, n_top=header['n_top'], initial_val=header['initial_val'],
+                                    search_min=header['search_min'], image_filenames=header['image_filenames'],
+                                    channel_correlation=header['channel_correlation'])
+    net_max_tracker.max_trackers = {}
+
+    for layer_name in layers:
+        layer_record = header['layer_records'][layer_name]
+        layer_dir = os.path.join(dirname, layer_record['dir'])
+
+        # the arrays are loaded from the files, so skip the allocations of __init__
+        max_tracker = MaxTracker.__new__(MaxTracker)
+        max_tracker.is_spatial = layer_record['is_spatial']
+        max_tracker.n_top = layer_record['n_top']
+        max_tracker.search_min = layer_record['search_min']
+        max_tracker.seen_inputs = None
+        max_tracker.max_patches = None
+        max_tracker.min_patches = None
+        max_tracker.min_vals = None
+        max_tracker.min_locs = None
+        load_arrays(layer_dir, max_tracker, layer_record['arrays'], mmap_mode)
+        max_tracker.channel_to_histogram = [None] * max_tracker.max_vals.shape[0]
+
+        max_tracker.channel_stats = None
+        stats_record = layer_record.get('channel_stats')
+        if stats_record is not None:
+            channel_stats = ChannelStats.__new__(ChannelStats)
+            channel_stats.n_channels = stats_record['n_channels']
+            channel_stats.n_bins = stats_record['n_bins']
+            channel_stats.track_correlation = stats_record['track_correlation']
+            channel_stats.count = stats_record['count']
+            load_arrays(layer_dir, channel_stats, stats_record['arrays'], mmap_mode)
+            channel_stats.hist_exponents = channel_stats.hist_exponents.astype(np.int64)
+            max_tracker.channel_stats = channel_stats
+
+        net_max_tracker.max_trackers[layer_name] = max_tracker
+
+    net_max_tracker.init_done = True
+    return net_max_tracker
+
+
+def load_arrays(dirname, obj, array_filenames, mmap_mode):
+    for name, filename in array_filenames.items():
+        setattr(obj, name, np.load(os.path.join(dirname, filename), mmap_mode=mmap_mode))
+
+
+def to_byte_strings(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    if isinstance(data, list):
+        return [to_byte_strings(item) for item in data]
+    if isinstance(data, dict):
+        return dict((to_byte_strings(key), to_byte_strings(value)) for key, value in data.items())
+    return data
+
+
+def save_tracker_text(filename, net_max_tracker):
+    '''Writes the tops of all units as text, for debugging.'''
+
+    with open(filename, 'wt') as text_file:
+        print >> text_file, '# layer channel max/min rank val image_idx selected_input_index i(if is_spatial) j(if is_spatial) filename'
+        for layer_name in net_max_tracker.layers:
+            max_tracker = net_max_tracker.max_trackers[layer_name]
+
+            tops = [('max', max_tracker.max_vals, max_tracker.max_locs)]
+            if max_tracker.search_min:
+                tops.append(('min', max_tracker.min_vals, max_tracker.min_locs))
+
+            for channel_idx in xrange(max_tracker.max_vals.shape[0]):
+                for kind, vals, locs in tops:
+                    # from highest (at end) to lowest
+                    for rank, top_idx in enumerate(reversed(xrange(vals.shape[1]))):
+                        loc = locs[channel_idx, top_idx]
+                        if loc[0] < 0:
+                            continue
+                        filename = net_max_tracker.image_filenames[loc[0]] if net_max_tracker.image_filenames else ''
+                        print >> text_file, layer_name, channel_idx, kind, rank, '%.6f' % vals[channel_idx, top_idx], \
+                            ' '.join(str(value) for value in loc), filename